@@ -3,19 +3,66 @@ Backend Server for System Utility Assignment
 - Receives system health data from clients
 - Stores machine ID, timestamps, and check results
 - Provides APIs for listing/filtering/exporting machine statuses
+
+Serves the same API as flask_backend_sqlite.py from the same SQLite storage
+(storage.py), through its asyncio front end: ingest is queued to a single
+writer task and reads run on a small thread pool, so one event loop can
+hold thousands of concurrent requests.
 """
 
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Dict, Optional
+from typing import Optional
+from contextlib import asynccontextmanager
 from datetime import datetime
-import uuid
+import asyncio
+import json
+import time
+
+import metrics
+import storage
+from storage import (
+    EVENTS_KEEPALIVE_INTERVAL, EXPORT_FORMATS, HISTORY_BUCKETS, MAX_BATCH_REPORTS,
+    MAX_HISTORY_DAYS, MAX_PAGE_SIZE, SECTION_FIELDS, AsyncSubscription, InvalidReport, StaleReport,
+    buffered, change_broker, collection_time, gzipped, iter_machines, merge_delta, observe_timings, prepare_record,
+    report_schedule, response_cache, sse_event,
+)
+
+store = storage.AsyncStorage()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    await store.start()
+    try:
+        yield
+    finally:
+        await store.stop()
 
-# In-memory storage for demonstration (replace with DB for production)
-machines: Dict[str, dict] = {}
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+
+@app.middleware("http")
+async def shed_ingest_load(request: Request, call_next):
+    # Refuse reports while the writer is behind; agents retry after Retry-After
+    if request.method == 'POST' and request.url.path.startswith('/report'):
+        retry_after = storage.ingest_retry_after(store.depth())
+        if retry_after is not None:
+            return JSONResponse({"status": "busy", "retry_after": retry_after}, status_code=503,
+                                headers={'Retry-After': str(retry_after)})
+    return await call_next(request)
+
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    # Streamed bodies are timed up to their first byte; exports also record
+    # their full duration in export_duration_seconds
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get('route')
+    metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, request.method,
+                                         route.path if route else 'unmatched', str(response.status_code))
+    return response
 
 class SystemData(BaseModel):
     os: str
@@ -25,42 +72,233 @@ class SystemData(BaseModel):
     sleep_settings: dict
     machine_id: Optional[str] = None
     timestamp: Optional[datetime] = None
+    content_hash: Optional[str] = None
+    timings: Optional[dict] = None
+
+def validated_record(data, now):
+    try:
+        return prepare_record(data, now)
+    except InvalidReport as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def json_body(request: Request):
+    try:
+        return await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+
+def resync(machine_id):
+    # The client must fall back to a full /report
+    return JSONResponse({"status": "resync", "machine_id": machine_id}, status_code=409)
+
+async def cached_json(request: Request, build):
+    """JSON response served from the shared response cache, with ETag/304 and gzip.
+
+    `build` is a blocking function producing the payload on a miss; it runs
+    together with the serialization and compression on the read executor.
+    """
+    key = (request.url.path, tuple(sorted(request.query_params.multi_items())))
+
+    def lookup():
+        # Read the version before the data; see flask_backend_sqlite.cached_json
+        version = storage.data_version()
+        entry = response_cache.get(key, version)
+        if entry is None:
+            body = (json.dumps(build(), sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+            entry = response_cache.put(key, version, body)
+        return entry
+
+    entry = await store.read(lookup)
+    use_gzip = 'gzip' in request.headers.get('accept-encoding', '')
+    etag = f'"{entry.gzip_etag if use_gzip else entry.etag}"'
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+    if_none_match = request.headers.get('if-none-match', '')
+    if etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+        return Response(status_code=304, headers=headers)
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(entry.gzip_body, media_type='application/json', headers=headers)
+    return Response(entry.body, media_type='application/json', headers=headers)
 
 @app.post("/report")
-def report_system_data(data: SystemData):
-    # Assign machine_id if not provided
-    machine_id = data.machine_id or str(uuid.uuid4())
-    now = datetime.utcnow()
-    record = data.dict()
-    record['machine_id'] = machine_id
-    record['timestamp'] = now
-    machines[machine_id] = record
-    return {"status": "ok", "machine_id": machine_id, "timestamp": now}
+async def report_system_data(data: SystemData):
+    now = datetime.utcnow().isoformat()
+    record = validated_record(data.dict(), now)
+    await store.save_machine(record)
+    return {"status": "ok", "machine_id": record['machine_id'], "timestamp": now,
+            **report_schedule(record['machine_id'])}
+
+@app.post("/report/batch")
+async def report_batch(request: Request):
+    data = await json_body(request)
+    reports = data.get('reports') if isinstance(data, dict) else data
+    if not isinstance(reports, list) or not reports:
+        raise HTTPException(status_code=400, detail="Expected a non-empty list of reports")
+    if len(reports) > MAX_BATCH_REPORTS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_REPORTS} reports per batch")
+    now = datetime.utcnow().isoformat()
+    # Queued reports are recorded as of when they were collected, not when they arrived
+    records = [validated_record(r, collection_time(r, now)) for r in reports]
+    await store.save_machines(records)
+    return {
+        "status": "ok",
+        "count": len(records),
+        "machine_ids": [r['machine_id'] for r in records],
+        "timestamp": now,
+        # Batches come from one agent's queue; schedule it by its latest report
+        **report_schedule(records[-1]['machine_id']),
+    }
+
+@app.post("/report/heartbeat")
+async def report_heartbeat(request: Request):
+    data = await json_body(request)
+    machine_id = data.get('machine_id') if isinstance(data, dict) else None
+    content_hash = data.get('content_hash') if isinstance(data, dict) else None
+    if not isinstance(machine_id, str) or not machine_id or not content_hash:
+        raise HTTPException(status_code=400, detail="machine_id and content_hash are required")
+    observe_timings(data)
+    exists, stored_hash = await store.read(storage.get_content_hash, machine_id)
+    if not exists or stored_hash != content_hash:
+        return resync(machine_id)
+    now = datetime.utcnow().isoformat()
+    try:
+        # Only applied if the hash still matches when the write commits
+        await store.touch_machine(machine_id, content_hash, now)
+    except StaleReport:
+        return resync(machine_id)
+    return {"status": "unchanged", "machine_id": machine_id, "timestamp": now, **report_schedule(machine_id)}
+
+@app.post("/report/delta")
+async def report_delta(request: Request):
+    data = await json_body(request)
+    if not isinstance(data, dict):
+        data = {}
+    machine_id = data.get('machine_id')
+    sections = data.get('sections')
+    if (not isinstance(machine_id, str) or not machine_id or not data.get('content_hash')
+            or not isinstance(sections, dict)):
+        raise HTTPException(status_code=400, detail="machine_id, content_hash and sections are required")
+    if data.get('os') is not None and not isinstance(data['os'], str):
+        raise HTTPException(status_code=400, detail="os must be a string")
+    unknown = set(sections) - set(SECTION_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown sections: {', '.join(sorted(unknown))}")
+    exists, stored_hash = await store.read(storage.get_content_hash, machine_id)
+    if not exists or stored_hash is None or stored_hash != data.get('base_hash'):
+        return resync(machine_id)
+    now = datetime.utcnow().isoformat()
+    record = await store.read(storage.get_machine_by_id, machine_id)
+    try:
+        # A full report may land between the check above and this write; the
+        # base hash is checked again inside the write transaction
+        await store.save_machine(merge_delta(record, data, now), base_hash=stored_hash)
+    except StaleReport:
+        return resync(machine_id)
+    return {"status": "ok", "machine_id": machine_id, "timestamp": now, **report_schedule(machine_id)}
 
 @app.get("/machines")
-def list_machines(os: Optional[str] = None, issue: Optional[str] = None):
-    results = list(machines.values())
-    if os:
-        results = [m for m in results if m['os'].lower() == os.lower()]
-    if issue:
-        # Example: filter by unencrypted disk, outdated OS, etc.
-        if issue == 'unencrypted_disk':
-            results = [m for m in results if not m['disk_encryption'].get('encrypted')]
-        elif issue == 'outdated_os':
-            results = [m for m in results if not m['os_update'].get('up_to_date')]
-        elif issue == 'no_antivirus':
-            results = [m for m in results if not m['antivirus'].get('antivirus_present')]
-        elif issue == 'sleep_noncompliant':
-            results = [m for m in results if not m['sleep_settings'].get('compliant')]
-    return results
+async def list_machines(request: Request):
+    def build():
+        try:
+            return storage.machines_payload(dict(request.query_params))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return await cached_json(request, build)
 
 @app.get("/machine/{machine_id}")
-def get_machine(machine_id: str):
-    if machine_id not in machines:
+async def get_machine(machine_id: str, request: Request):
+    def build():
+        machine = storage.get_machine_by_id(machine_id)
+        if not machine:
+            raise HTTPException(status_code=404, detail="Machine not found")
+        return machine
+    return await cached_json(request, build)
+
+@app.get("/export/{fmt}")
+def export(fmt: str, os: Optional[str] = None, issue: Optional[str] = None, gzip: Optional[str] = None):
+    # Streamed from a dedicated connection; the sync generator runs in Starlette's threadpool
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=404, detail="Unknown export format")
+    if fmt == 'json' and storage.snapshot_writer:
+        # Bring machines_data.json up to date without waiting out SNAPSHOT_MIN_INTERVAL
+        storage.snapshot_writer.mark_stale(urgent=True)
+    encoder, media_type = EXPORT_FORMATS[fmt]
+    body = buffered(encoder(iter_machines(os, issue)))
+    filename = f'machines_data.{fmt}'
+    if gzip in ('1', 'true'):
+        body = gzipped(body)
+        media_type = 'application/gzip'
+        filename += '.gz'
+    return StreamingResponse(metrics.timed_stream(body, fmt), media_type=media_type,
+                             headers={'Content-Disposition': f'attachment;filename={filename}'})
+
+@app.get("/events")
+async def machine_events(request: Request, since: Optional[str] = None):
+    start = request.headers.get('last-event-id') or since
+    try:
+        start = int(start) if start else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since must be an integer")
+
+    def feed_position():
+        with storage.read_pool.connection() as conn:
+            return storage.current_change_seq(conn)
+
+    def feed_page(seq):
+        with storage.read_pool.connection() as conn:
+            return storage.changed_machines(conn, seq, limit=MAX_PAGE_SIZE)
+
+    async def stream(last_seq):
+        # Subscribe before reading so a commit landing during the catch-up still wakes us
+        subscription = change_broker.subscribe(AsyncSubscription(asyncio.get_running_loop()))
+        try:
+            if last_seq is None:
+                last_seq = await store.read(feed_position)
+            yield f'retry: 5000\n: connected at {last_seq}\n\n'
+            while True:
+                # Drain the feed page by page; wake-ups (and idle timeouts, which also pick up
+                # writes from other processes) only say it is worth reading again
+                while True:
+                    page = await store.read(feed_page, last_seq)
+                    if not page:
+                        break
+                    for machine in page:
+                        last_seq = machine['change_seq']
+                        yield sse_event(machine)
+                if not await subscription.wait(EVENTS_KEEPALIVE_INTERVAL):
+                    yield ': keep-alive\n\n'
+        finally:
+            change_broker.unsubscribe(subscription)
+
+    return StreamingResponse(stream(start), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.get("/stats")
+async def fleet_stats():
+    return await store.read(storage.get_fleet_stats)
+
+@app.get("/machine/{machine_id}/history")
+async def machine_history(machine_id: str, since: Optional[str] = None, until: Optional[str] = None,
+                          limit: Optional[int] = None):
+    transitions = await store.read(storage.get_machine_history, machine_id, since, until, limit)
+    if not transitions and await store.read(storage.get_content_hash, machine_id) == (False, None):
         raise HTTPException(status_code=404, detail="Machine not found")
-    return machines[machine_id]
+    return {"machine_id": machine_id, "transitions": transitions}
+
+@app.get("/history/compliance")
+async def history_compliance(bucket: str = 'day', days: int = 30, os: Optional[str] = None):
+    if bucket not in HISTORY_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"bucket must be one of: {', '.join(HISTORY_BUCKETS)}")
+    days = max(min(days, MAX_HISTORY_DAYS), 1)
+    try:
+        series = await store.read(storage.fleet_compliance, days, bucket, os)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"bucket": bucket, "days": days, "series": series}
 
-# Optional: CSV export endpoint can be added here
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
 
 if __name__ == "__main__":
     import uvicorn
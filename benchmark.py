@@ -0,0 +1,372 @@
+"""
+Load simulator and benchmark for the backends.
+
+Starts flask_backend_sqlite.py or backend.py (in-process or as a local
+subprocess, in a scratch directory so the real machines.db is untouched),
+or targets an already running server with --url. It then generates a
+synthetic fleet and drives concurrent traffic against it, scenario by
+scenario. Results (throughput and latency percentiles) are printed as JSON
+so runs can be compared between commits:
+
+    python benchmark.py --backend flask --machines 50000 --output before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Share of the fleet per OS and probability of each failing check
+OS_MIX = {'Windows': 0.6, 'Darwin': 0.25, 'Linux': 0.15}
+ISSUE_RATES = {
+    'disk_encryption': 0.15,
+    'os_update': 0.30,
+    'antivirus': 0.10,
+    'sleep_settings': 0.20,
+}
+# Probability that a check could not produce a verdict (None)
+UNKNOWN_RATE = 0.03
+# Size range (bytes) of the raw command output kept in `details`
+DETAILS_SIZE = (512, 8 * 1024)
+BATCH_SIZE = 500
+READY_TIMEOUT = 30
+
+# --- Synthetic fleet -------------------------------------------------------
+
+def _verdict(rng, check):
+    if rng.random() < UNKNOWN_RATE:
+        return None
+    return rng.random() >= ISSUE_RATES[check]
+
+_detail_lines = {}
+
+def _details(rng, os_name):
+    """Command-output-like text, e.g. a list of pending package upgrades."""
+    # Lines come from a per-OS pool so generating load stays cheap next to sending it
+    pool = _detail_lines.get(os_name)
+    if pool is None:
+        pool_rng = random.Random(os_name)
+        pool = _detail_lines[os_name] = [
+            f"{''.join(pool_rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(pool_rng.randint(4, 14)))}"
+            f'/{os_name.lower()}-updates {pool_rng.randint(1, 9)}.{pool_rng.randint(0, 40)}-{pool_rng.randint(1, 9)} '
+            f'amd64 [upgradable from: {pool_rng.randint(1, 9)}.{pool_rng.randint(0, 40)}]'
+            for _ in range(2000)
+        ]
+    size = rng.randint(*DETAILS_SIZE)
+    lines, length = [], 0
+    while length < size:
+        line = rng.choice(pool)
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines)[:size]
+
+def make_report(rng, machine_id, os_name):
+    encrypted = _verdict(rng, 'disk_encryption')
+    up_to_date = _verdict(rng, 'os_update')
+    antivirus = _verdict(rng, 'antivirus')
+    compliant = _verdict(rng, 'sleep_settings')
+    minutes = None if compliant is None else (rng.choice([5, 10]) if compliant else rng.choice([15, 30, 60]))
+    return {
+        'machine_id': machine_id,
+        'os': os_name,
+        'disk_encryption': {'encrypted': encrypted, 'details': _details(rng, os_name)},
+        'os_update': {'up_to_date': up_to_date, 'details': _details(rng, os_name)},
+        'antivirus': {'antivirus_present': antivirus, 'status': 'active' if antivirus else 'inactive'},
+        'sleep_settings': {'sleep_timeout_minutes': minutes, 'compliant': compliant, 'details': str(minutes)},
+    }
+
+def make_fleet(size, seed):
+    """[(machine_id, os)] for `size` machines, deterministic for a seed."""
+    rng = random.Random(seed)
+    names, weights = zip(*OS_MIX.items())
+    return [
+        (str(uuid.UUID(int=rng.getrandbits(128), version=4)), rng.choices(names, weights)[0])
+        for _ in range(size)
+    ]
+
+# --- Backends --------------------------------------------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_ready(url, timeout=READY_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'{url}/machines', params={'limit': 1}, timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'Backend at {url} did not become ready within {timeout}s')
+
+def start_subprocess(backend, port, workdir):
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    if backend == 'flask':
+        cmd = [sys.executable, '-c',
+               'import flask_backend_sqlite as b; '
+               f'b.app.run(host="127.0.0.1", port={port}, threaded=True)']
+    else:
+        cmd = [sys.executable, '-m', 'uvicorn', 'backend:app', '--host', '127.0.0.1',
+               '--port', str(port), '--log-level', 'warning']
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def stop():
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return stop
+
+def start_inprocess(backend, port, workdir):
+    # The backends create their database files in the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    if backend == 'flask':
+        from werkzeug.serving import make_server
+        import flask_backend_sqlite
+        server = make_server('127.0.0.1', port, flask_backend_sqlite.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server.shutdown
+    import uvicorn
+    import backend as fastapi_backend
+    server = uvicorn.Server(uvicorn.Config(fastapi_backend.app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    def stop():
+        server.should_exit = True
+        thread.join(timeout=10)
+    return stop
+
+# --- Load generation -------------------------------------------------------
+
+_local = threading.local()
+
+def session():
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(int(round(pct / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+def summarize(latencies, errors, elapsed, statuses):
+    latencies.sort()
+    count = len(latencies)
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        'requests': count,
+        'errors': errors,
+        'status_codes': statuses,
+        'duration_s': round(elapsed, 3),
+        'throughput_rps': round(count / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'mean': ms(sum(latencies) / count) if count else None,
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'max': ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+def run_scenario(url, requests_iter, concurrency):
+    """Send (method, path, kwargs) requests with `concurrency` workers and time each one."""
+    latencies, statuses, errors = [], {}, 0
+    lock = threading.Lock()
+    jobs = iter(requests_iter)
+
+    def worker():
+        nonlocal errors
+        while True:
+            with lock:
+                job = next(jobs, None)
+            if job is None:
+                return
+            method, path, kwargs = job
+            start = time.perf_counter()
+            try:
+                resp = session().request(method, url + path, timeout=120, **kwargs)
+                resp.content  # Include the full body transfer (exports stream)
+                elapsed = time.perf_counter() - start
+                ok = resp.status_code < 400
+                code = str(resp.status_code)
+            except requests.RequestException:
+                elapsed, ok, code = time.perf_counter() - start, False, 'error'
+            with lock:
+                latencies.append(elapsed)
+                statuses[code] = statuses.get(code, 0) + 1
+                if not ok:
+                    errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return summarize(latencies, errors, time.perf_counter() - start, statuses)
+
+def supported(url, method, path, **kwargs):
+    try:
+        return requests.request(method, url + path, timeout=30, **kwargs).status_code not in (404, 405)
+    except requests.RequestException:
+        return False
+
+def scenarios(args, fleet):
+    """Scenario name -> (probe request or None, iterable of requests)."""
+    rng = random.Random(args.seed + 1)
+    ids = [machine_id for machine_id, _ in fleet]
+    os_names = list(OS_MIX)
+    issues = ['unencrypted_disk', 'outdated_os', 'no_antivirus', 'sleep_noncompliant']
+
+    def reports(seed):
+        report_rng = random.Random(seed)
+        for machine_id, os_name in fleet:
+            yield 'POST', '/report', {'json': make_report(report_rng, machine_id, os_name)}
+
+    def batches(seed):
+        report_rng = random.Random(seed)
+        for i in range(0, len(fleet), BATCH_SIZE):
+            chunk = fleet[i:i + BATCH_SIZE]
+            yield 'POST', '/report/batch', {'json': {'reports': [make_report(report_rng, m, o) for m, o in chunk]}}
+
+    def lists():
+        for _ in range(args.reads):
+            params = {'limit': 100, 'fields': 'summary'}
+            if rng.random() < 0.5:
+                params['os'] = rng.choice(os_names)
+            if rng.random() < 0.5:
+                params['issue'] = rng.choice(issues)
+            yield 'GET', '/machines', {'params': params}
+
+    def machine_reads():
+        for _ in range(args.reads):
+            yield 'GET', f'/machine/{rng.choice(ids)}', {}
+
+    def exports():
+        for i in range(args.exports):
+            fmt = ('json', 'csv', 'ndjson')[i % 3]
+            yield 'GET', f'/export/{fmt}', {}
+
+    def mixed():
+        # A fleet re-reporting while the dashboard and scripts read
+        report_rng = random.Random(args.seed + 2)
+        for _ in range(args.reads):
+            roll = rng.random()
+            if roll < 0.7:
+                machine_id, os_name = rng.choice(fleet)
+                yield 'POST', '/report', {'json': make_report(report_rng, machine_id, os_name)}
+            elif roll < 0.9:
+                yield 'GET', f'/machine/{rng.choice(ids)}', {}
+            else:
+                yield 'GET', '/machines', {'params': {'limit': 100, 'fields': 'summary'}}
+
+    return {
+        'ingest_report': (None, reports(args.seed)),
+        'ingest_batch': (('POST', '/report/batch', {'json': {'reports': []}}), batches(args.seed + 3)),
+        'list_machines': (None, lists()),
+        'get_machine': (None, machine_reads()),
+        'export': (('GET', '/export/ndjson', {'stream': True}), exports()),
+        'mixed': (None, mixed()),
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--backend', choices=('flask', 'fastapi'), default='flask')
+    parser.add_argument('--mode', choices=('subprocess', 'inprocess'), default='subprocess',
+                        help='in-process servers share the GIL with the load generator')
+    parser.add_argument('--url', help='benchmark a server that is already running instead')
+    parser.add_argument('--machines', type=int, default=5000, help='fleet size')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--reads', type=int, default=2000, help='requests per read and mixed scenario')
+    parser.add_argument('--exports', type=int, default=6)
+    parser.add_argument('--scenarios', help='comma-separated subset of scenarios to run')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    started_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    stop = None
+    url = args.url
+    workdir = None
+    cwd = os.getcwd()
+    try:
+        if not url:
+            workdir = tempfile.mkdtemp(prefix='solsphere-bench-')
+            port = free_port()
+            url = f'http://127.0.0.1:{port}'
+            start = start_inprocess if args.mode == 'inprocess' else start_subprocess
+            stop = start(args.backend, port, workdir)
+        wait_ready(url)
+        fleet = make_fleet(args.machines, args.seed)
+        selected = set(args.scenarios.split(',')) if args.scenarios else None
+        results = {}
+        for name, (probe, jobs) in scenarios(args, fleet).items():
+            if selected is not None and name not in selected:
+                continue
+            if probe is not None and not supported(url, probe[0], probe[1], **probe[2]):
+                results[name] = {'skipped': 'endpoint not supported by this backend'}
+                continue
+            print(f'Running {name}...', file=sys.stderr)
+            results[name] = run_scenario(url, jobs, args.concurrency)
+            print(f"  {results[name]['throughput_rps']} req/s, p95 {results[name]['latency_ms']['p95']} ms",
+                  file=sys.stderr)
+    finally:
+        if stop:
+            stop()
+        # In-process servers chdir into the scratch directory; --output is relative to the caller's
+        os.chdir(cwd)
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'backend': args.backend if not args.url else None,
+            'mode': args.mode if not args.url else 'external',
+            'url': args.url,
+            'commit': git_commit(),
+            'machines': args.machines,
+            'concurrency': args.concurrency,
+            'reads': args.reads,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'started_at': started_at,
+        },
+        'scenarios': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
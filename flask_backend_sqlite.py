@@ -1,173 +1,312 @@
 """
 Flask Backend Server for System Utility Assignment (with SQLite persistent storage)
+
+Storage, filters and exports live in storage.py, shared with backend.py.
 """
-from flask import Flask, request, jsonify, abort, send_file
+from flask import Flask, request, jsonify, abort, g
 from flask_cors import CORS
 from datetime import datetime
-import uuid
-import json
-import os
-import sqlite3
+import time
+
+import metrics
+
+from storage import (
+    EVENTS_KEEPALIVE_INTERVAL, HISTORY_BUCKETS, MAX_BATCH_REPORTS, MAX_HISTORY_DAYS, MAX_PAGE_SIZE,
+    SECTION_FIELDS, EXPORT_FORMATS, InvalidReport, StaleReport, buffered, change_broker, changed_machines, collection_time,
+    current_change_seq, data_version, fleet_compliance, get_content_hash, get_fleet_stats,
+    get_machine_by_id, get_machine_history, gzipped, ingest_retry_after, init_db, iter_machines, machines_payload,
+    merge_delta, observe_timings, prepare_record, read_pool, report_schedule, response_cache,
+    save_machine, save_machines, snapshot_writer, sse_event, touch_machine, write_queue,
+)
 
 app = Flask(__name__)
 CORS(app) 
 
-DB_PATH = 'machines.db'
-
-def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS machines (
-                machine_id TEXT PRIMARY KEY,
-                timestamp TEXT,
-                os TEXT,
-                disk_encryption TEXT,
-                os_update TEXT,
-                antivirus TEXT,
-                sleep_settings TEXT
-            )
-        ''')
-        conn.commit()
 init_db()
 
-def save_machine(record):
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('''
-            INSERT OR REPLACE INTO machines (machine_id, timestamp, os, disk_encryption, os_update, antivirus, sleep_settings)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            record['machine_id'],
-            record['timestamp'],
-            record['os'],
-            json.dumps(record['disk_encryption']),
-            json.dumps(record['os_update']),
-            json.dumps(record['antivirus']),
-            json.dumps(record['sleep_settings'])
-        ))
-        conn.commit()
-
-def get_all_machines():
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('SELECT * FROM machines')
-        rows = c.fetchall()
-        machines = []
-        for row in rows:
-            machines.append({
-                'machine_id': row[0],
-                'timestamp': row[1],
-                'os': row[2],
-                'disk_encryption': json.loads(row[3]),
-                'os_update': json.loads(row[4]),
-                'antivirus': json.loads(row[5]),
-                'sleep_settings': json.loads(row[6]),
-            })
-        return machines
-
-def get_machine_by_id(machine_id):
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('SELECT * FROM machines WHERE machine_id = ?', (machine_id,))
-        row = c.fetchone()
-        if not row:
-            return None
-        return {
-            'machine_id': row[0],
-            'timestamp': row[1],
-            'os': row[2],
-            'disk_encryption': json.loads(row[3]),
-            'os_update': json.loads(row[4]),
-            'antivirus': json.loads(row[5]),
-            'sleep_settings': json.loads(row[6]),
-        }
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.before_request
+def shed_ingest_load():
+    # Refuse reports while the writer is behind; agents retry after Retry-After
+    if request.method == 'POST' and request.path.startswith('/report'):
+        retry_after = ingest_retry_after(write_queue.depth())
+        if retry_after is not None:
+            return jsonify({'status': 'busy', 'retry_after': retry_after}), 503, {'Retry-After': str(retry_after)}
+
+@app.after_request
+def record_latency(response):
+    # Streamed bodies (exports, /events) are timed up to their first byte here;
+    # exports record their full duration in export_duration_seconds
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - g.request_start, request.method, route, str(response.status_code))
+    return response
+
+def cached_json(build):
+    """JSON response for the current request, served from response_cache.
+
+    `build` produces the payload on a miss. Responses carry an ETag and are
+    gzipped when the client accepts it; a matching If-None-Match gets 304.
+    """
+    key = (request.path, tuple(sorted(request.args.items(multi=True))))
+    # Read the version before the data: a body newer than its version is
+    # merely rebuilt once more, an older one would be served stale
+    version = data_version()
+    entry = response_cache.get(key, version)
+    if entry is None:
+        body = f'{app.json.dumps(build())}\n'.encode('utf-8')
+        entry = response_cache.put(key, version, body)
+    response = app.response_class(mimetype='application/json')
+    if request.accept_encodings['gzip']:
+        response.set_data(entry.gzip_body)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(entry.gzip_etag)
+    else:
+        response.set_data(entry.body)
+        response.set_etag(entry.etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Let browsers keep the body but revalidate it on every use
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def validated_record(data, now):
+    try:
+        return prepare_record(data, now)
+    except InvalidReport as e:
+        abort(400, description=str(e))
 
 @app.route('/report', methods=['POST'])
 # Endpoint: Receives system health data from a client utility and stores/updates the latest status for each machine.
+# Like the other /report endpoints it answers with the machine's next report slot (`next_report_in` seconds and
+# `next_report_at`), and with 503 + Retry-After while ingest is overloaded.
 def report_system_data():
     data = request.get_json()
     if not data:
         abort(400, description='Invalid JSON')
-    machine_id = data.get('machine_id') or str(uuid.uuid4())
     now = datetime.utcnow().isoformat()
-    record = data.copy()
-    record['machine_id'] = machine_id
-    record['timestamp'] = now
+    record = validated_record(data, now)
     save_machine(record)
-    # Save all data to a JSON file after each report (optional, for export)
-    all_machines = get_all_machines()
-    with open('machines_data.json', 'w') as f:
-        json.dump({m['machine_id']: m for m in all_machines}, f, indent=2)
-    return jsonify({'status': 'ok', 'machine_id': machine_id, 'timestamp': now})
+    return jsonify({'status': 'ok', 'machine_id': record['machine_id'], 'timestamp': now,
+                    **report_schedule(record['machine_id'])})
+
+@app.route('/report/batch', methods=['POST'])
+# Endpoint: Receives many reports in one request (a JSON list, or {"reports": [...]}) and stores them in one group commit.
+def report_batch():
+    data = request.get_json()
+    reports = data.get('reports') if isinstance(data, dict) else data
+    if not isinstance(reports, list) or not reports:
+        abort(400, description='Expected a non-empty list of reports')
+    if len(reports) > MAX_BATCH_REPORTS:
+        abort(413, description=f'At most {MAX_BATCH_REPORTS} reports per batch')
+    now = datetime.utcnow().isoformat()
+    # Queued reports are recorded as of when they were collected, not when they arrived
+    records = [validated_record(r, collection_time(r, now)) for r in reports]
+    save_machines(records)
+    return jsonify({
+        'status': 'ok',
+        'count': len(records),
+        'machine_ids': [r['machine_id'] for r in records],
+        'timestamp': now,
+        # Batches come from one agent's queue; schedule it by its latest report
+        **report_schedule(records[-1]['machine_id']),
+    })
+
+def resync(machine_id):
+    # The client must fall back to a full /report
+    return jsonify({'status': 'resync', 'machine_id': machine_id}), 409
+
+@app.route('/report/heartbeat', methods=['POST'])
+# Endpoint: Lightweight check-in ({machine_id, content_hash}). If the hash matches the stored one only the
+# timestamp is updated and the answer is "unchanged"; otherwise 409 "resync" asks for a full report.
+def report_heartbeat():
+    data = request.get_json(silent=True) or {}
+    machine_id = data.get('machine_id')
+    content_hash = data.get('content_hash')
+    if not isinstance(machine_id, str) or not machine_id or not content_hash:
+        abort(400, description='machine_id and content_hash are required')
+    observe_timings(data)
+    exists, stored_hash = get_content_hash(machine_id)
+    if not exists or stored_hash != content_hash:
+        return resync(machine_id)
+    now = datetime.utcnow().isoformat()
+    try:
+        # Only applied if the hash still matches when the write commits
+        touch_machine(machine_id, content_hash, now)
+    except StaleReport:
+        return resync(machine_id)
+    return jsonify({'status': 'unchanged', 'machine_id': machine_id, 'timestamp': now,
+                    **report_schedule(machine_id)})
+
+@app.route('/report/delta', methods=['POST'])
+# Endpoint: Partial report ({machine_id, base_hash, content_hash, sections}) carrying only the changed check
+# sections. They are merged into the stored row when base_hash matches it; otherwise 409 "resync".
+def report_delta():
+    data = request.get_json(silent=True) or {}
+    machine_id = data.get('machine_id')
+    sections = data.get('sections')
+    if (not isinstance(machine_id, str) or not machine_id or not data.get('content_hash')
+            or not isinstance(sections, dict)):
+        abort(400, description='machine_id, content_hash and sections are required')
+    if data.get('os') is not None and not isinstance(data['os'], str):
+        abort(400, description='os must be a string')
+    unknown = set(sections) - set(SECTION_FIELDS)
+    if unknown:
+        abort(400, description=f"Unknown sections: {', '.join(sorted(unknown))}")
+    exists, stored_hash = get_content_hash(machine_id)
+    if not exists or stored_hash is None or stored_hash != data.get('base_hash'):
+        return resync(machine_id)
+    now = datetime.utcnow().isoformat()
+    try:
+        # A full report may land between the check above and this write; the
+        # base hash is checked again inside the write transaction
+        save_machine(merge_delta(get_machine_by_id(machine_id), data, now), base_hash=stored_hash)
+    except StaleReport:
+        return resync(machine_id)
+    return jsonify({'status': 'ok', 'machine_id': machine_id, 'timestamp': now, **report_schedule(machine_id)})
+
+def stream_export(fmt):
+    """Streaming download of all (or os/issue filtered) machines; ?gzip=1 compresses on the fly."""
+    encoder, mimetype = EXPORT_FORMATS[fmt]
+    body = buffered(encoder(iter_machines(request.args.get('os'), request.args.get('issue'))))
+    filename = f'machines_data.{fmt}'
+    if request.args.get('gzip') in ('1', 'true'):
+        body = gzipped(body)
+        mimetype = 'application/gzip'
+        filename += '.gz'
+    return app.response_class(
+        metrics.timed_stream(body, fmt),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment;filename={filename}'}
+    )
 
 @app.route('/export/json', methods=['GET'])
-# Endpoint: Exports all machine data as a JSON file download.
+# Endpoint: Exports all machine data as a JSON file download (object keyed by machine_id). Also has the background
+# writer bring machines_data.json up to date without waiting out SNAPSHOT_MIN_INTERVAL.
 def export_json():
-    json_path = 'machines_data.json'
-    # Ensure file exists and is up to date
-    all_machines = get_all_machines()
-    with open(json_path, 'w') as f:
-        json.dump({m['machine_id']: m for m in all_machines}, f, indent=2)
-    return send_file(json_path, mimetype='application/json', as_attachment=True, download_name='machines_data.json')
+    if snapshot_writer:
+        snapshot_writer.mark_stale(urgent=True)
+    return stream_export('json')
 
 @app.route('/export/csv', methods=['GET'])
 # Endpoint: Exports all machine data as a CSV file download.
 def export_csv():
-    import csv
-    from io import StringIO
-    # Prepare CSV in memory
-    si = StringIO()
-    fieldnames = [
-        'machine_id', 'timestamp', 'os',
-        'disk_encryption', 'os_update', 'antivirus', 'sleep_settings'
-    ]
-    writer = csv.DictWriter(si, fieldnames=fieldnames)
-    writer.writeheader()
-    for m in get_all_machines():
-        row = {
-            'machine_id': m.get('machine_id'),
-            'timestamp': m.get('timestamp'),
-            'os': m.get('os'),
-            'disk_encryption': str(m.get('disk_encryption')),
-            'os_update': str(m.get('os_update')),
-            'antivirus': str(m.get('antivirus')),
-            'sleep_settings': str(m.get('sleep_settings')),
-        }
-        writer.writerow(row)
-    si.seek(0)
-    return app.response_class(
-        si.getvalue(),
-        mimetype='text/csv',
-        headers={'Content-Disposition': 'attachment;filename=machines_data.csv'}
-    )
+    return stream_export('csv')
+
+@app.route('/export/ndjson', methods=['GET'])
+# Endpoint: Exports all machine data as newline-delimited JSON, one machine per line.
+def export_ndjson():
+    return stream_export('ndjson')
 
 @app.route('/machines', methods=['GET'])
 # Endpoint: Lists all reporting machines and their latest status. Supports filtering by OS and issue type via query params.
+# With `limit` and/or `cursor` it returns one keyset-paginated page ({items, next_cursor, total, change_cursor}) instead
+# of the full list; with `since=<change_cursor>` it returns summary rows changed since then ({items, change_cursor, has_more}).
+# `sort`/`order`, `status`, `search` (machine_id substring) and `fields` (comma list, or "summary") apply to both forms.
+# Responses are cached until the next ingest and honour If-None-Match.
 def list_machines():
-    os_filter = request.args.get('os')
-    issue = request.args.get('issue')
-    results = get_all_machines()
-    if os_filter:
-        results = [m for m in results if m.get('os', '').lower() == os_filter.lower()]
-    if issue:
-        if issue == 'unencrypted_disk':
-            results = [m for m in results if not m.get('disk_encryption', {}).get('encrypted')]
-        elif issue == 'outdated_os':
-            results = [m for m in results if not m.get('os_update', {}).get('up_to_date')]
-        elif issue == 'no_antivirus':
-            results = [m for m in results if not m.get('antivirus', {}).get('antivirus_present')]
-        elif issue == 'sleep_noncompliant':
-            results = [m for m in results if not m.get('sleep_settings', {}).get('compliant')]
-    return jsonify(results)
+    def build():
+        try:
+            return machines_payload(request.args)
+        except ValueError as e:
+            abort(400, description=str(e))
+    return cached_json(build)
 
 @app.route('/machine/<machine_id>', methods=['GET'])
-# Endpoint: Returns the latest status/details for a specific machine by its machine_id.
+# Endpoint: Returns the latest status/details for a specific machine by its machine_id (cached like /machines).
 def get_machine(machine_id):
-    machine = get_machine_by_id(machine_id)
-    if not machine:
+    def build():
+        machine = get_machine_by_id(machine_id)
+        if not machine:
+            abort(404, description='Machine not found')
+        return machine
+    return cached_json(build)
+
+@app.route('/events', methods=['GET'])
+# Endpoint: Server-Sent Events stream of machine upserts (summary fields) as ingest commits them. Resumes after
+# `since` or the Last-Event-ID header; without either it starts at the current end of the feed.
+def machine_events():
+    start = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        start = int(start) if start else None
+    except ValueError:
+        abort(400, description='since must be an integer')
+
+    def stream(last_seq):
+        # Subscribe before reading so a commit landing during the catch-up still wakes us
+        subscription = change_broker.subscribe()
+        try:
+            if last_seq is None:
+                with read_pool.connection() as conn:
+                    last_seq = current_change_seq(conn)
+            yield f'retry: 5000\n: connected at {last_seq}\n\n'
+            while True:
+                # Drain the feed page by page; wake-ups (and idle timeouts, which also pick up
+                # writes from other processes) only say it is worth reading again
+                while True:
+                    with read_pool.connection() as conn:
+                        page = changed_machines(conn, last_seq, limit=MAX_PAGE_SIZE)
+                    if not page:
+                        break
+                    for machine in page:
+                        last_seq = machine['change_seq']
+                        yield sse_event(machine)
+                if not subscription.wait(EVENTS_KEEPALIVE_INTERVAL):
+                    yield ': keep-alive\n\n'
+        finally:
+            change_broker.unsubscribe(subscription)
+
+    return app.response_class(
+        stream(start),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/stats', methods=['GET'])
+# Endpoint: Fleet summary (totals per OS, per issue and per status) from counters maintained at ingest.
+def fleet_stats():
+    return jsonify(get_fleet_stats())
+
+@app.route('/machine/<machine_id>/history', methods=['GET'])
+# Endpoint: Returns the state transitions (check verdicts and status) of one machine, oldest first.
+# Optional `since`/`until` ISO timestamps and `limit`.
+def machine_history(machine_id):
+    try:
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        abort(400, description='limit must be an integer')
+    transitions = get_machine_history(
+        machine_id, request.args.get('since'), request.args.get('until'), limit)
+    if not transitions and get_content_hash(machine_id) == (False, None):
         abort(404, description='Machine not found')
-    return jsonify(machine)
+    return jsonify({'machine_id': machine_id, 'transitions': transitions})
+
+@app.route('/history/compliance', methods=['GET'])
+# Endpoint: Fleet-wide compliance percentages per time bucket (`bucket`=hour|day|week over the last `days`),
+# optionally for one `os`. Windows longer than MAX_HISTORY_BUCKETS buckets are rejected with 400.
+def history_compliance():
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in HISTORY_BUCKETS:
+        abort(400, description=f"bucket must be one of: {', '.join(HISTORY_BUCKETS)}")
+    try:
+        days = int(request.args.get('days', 30))
+    except ValueError:
+        abort(400, description='days must be an integer')
+    days = max(min(days, MAX_HISTORY_DAYS), 1)
+    try:
+        series = fleet_compliance(days, bucket, request.args.get('os'))
+    except ValueError as e:
+        abort(400, description=str(e))
+    return jsonify({'bucket': bucket, 'days': days, 'series': series})
+
+@app.route('/metrics', methods=['GET'])
+# Endpoint: Prometheus text metrics: request latency per route, SQLite query/commit timings, ingest queue depth,
+# export durations and the check timings collectors report.
+def metrics_endpoint():
+    return app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000, debug=True)
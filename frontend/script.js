@@ -1,6 +1,18 @@
 // Configuration
-const API_BASE_URL = 'http://localhost:8000';
-const REFRESH_INTERVAL = 30000; // 30 seconds
+// serve.py --api sets window.API_BASE_URL to its same-origin proxy
+const API_BASE_URL = window.API_BASE_URL || 'http://localhost:8000';
+const REFRESH_INTERVAL = 30000; // 30 seconds; change-feed poll interval when SSE is unavailable
+const STATS_REFRESH_DELAY = 2000; // Coalesce stat card refreshes after live updates
+const PAGE_SIZE = 50; // Machines fetched per page
+// Fields requested for the table/cards; the raw details are loaded on demand
+const LIST_FIELDS = 'summary';
+// issue filter -> summary flag that fails it (false or unknown), as on the server
+const ISSUE_FLAGS = {
+    unencrypted_disk: 'encrypted',
+    outdated_os: 'up_to_date',
+    no_antivirus: 'antivirus_present',
+    sleep_noncompliant: 'sleep_compliant'
+};
 
 // Global state
 let machines = [];
@@ -9,6 +21,14 @@ let sortColumn = 'timestamp';
 let sortDirection = 'desc';
 let isCardView = false;
 let refreshInterval;
+let eventSource = null;
+let changeCursor = null; // Position in the server's change feed we have applied
+let renderTimer = null;
+let statsTimer = null;
+let pageCursors = [null]; // Cursor used to fetch each page visited so far
+let pageIndex = 0;
+let nextCursor = null;
+let totalMatches = 0;
 
 // DOM elements
 const elements = {
@@ -26,6 +46,9 @@ const elements = {
     
     // Table/Cards
     machineCount: document.getElementById('machineCount'),
+    prevPage: document.getElementById('prevPage'),
+    nextPage: document.getElementById('nextPage'),
+    pageInfo: document.getElementById('pageInfo'),
     machinesTableBody: document.getElementById('machinesTableBody'),
     tableView: document.getElementById('tableView'),
     cardView: document.getElementById('cardView'),
@@ -35,6 +58,7 @@ const elements = {
     refreshBtn: document.getElementById('refreshBtn'),
     exportJson: document.getElementById('exportJson'),
     exportCsv: document.getElementById('exportCsv'),
+    exportNdjson: document.getElementById('exportNdjson'),
     
     // UI states
     loadingIndicator: document.getElementById('loadingIndicator'),
@@ -52,8 +76,7 @@ const elements = {
 // Initialize the application
 document.addEventListener('DOMContentLoaded', function() {
     setupEventListeners();
-    loadMachines();
-    startAutoRefresh();
+    loadMachines().then(startLiveUpdates);
 });
 
 // Event listeners
@@ -74,6 +97,11 @@ function setupEventListeners() {
         exportData('csv');
     });
     
+    elements.exportNdjson.addEventListener('click', (e) => {
+        e.preventDefault();
+        exportData('ndjson');
+    });
+    
     // Filters
     elements.osFilter.addEventListener('change', applyFilters);
     elements.issueFilter.addEventListener('change', applyFilters);
@@ -83,6 +111,10 @@ function setupEventListeners() {
     // View toggle
     elements.toggleView.addEventListener('click', toggleView);
     
+    // Pagination
+    elements.prevPage.addEventListener('click', () => goToPage(pageIndex - 1));
+    elements.nextPage.addEventListener('click', () => goToPage(pageIndex + 1));
+    
     // Sort buttons
     document.addEventListener('click', (e) => {
         if (e.target.closest('.sort-btn')) {
@@ -112,12 +144,16 @@ function setupEventListeners() {
 }
 
 // API functions
-async function fetchMachines(filters = {}) {
+// Fetches one page of machines; the server filters, sorts and paginates.
+// Resolves to {items, next_cursor, total, change_cursor}, or to a change-feed
+// page {items, change_cursor, has_more, head} when `since` is given.
+async function fetchMachines(query = {}) {
     const params = new URLSearchParams();
-    if (filters.os) params.append('os', filters.os);
-    if (filters.issue) params.append('issue', filters.issue);
+    Object.entries(query).forEach(([key, value]) => {
+        if (value !== null && value !== undefined && value !== '') params.append(key, value);
+    });
     
-    const url = `${API_BASE_URL}/machines${params.toString() ? '?' + params.toString() : ''}`;
+    const url = `${API_BASE_URL}/machines?${params.toString()}`;
     
     const response = await fetch(url);
     if (!response.ok) {
@@ -127,6 +163,31 @@ async function fetchMachines(filters = {}) {
     return await response.json();
 }
 
+function currentQuery() {
+    return {
+        os: elements.osFilter.value,
+        issue: elements.issueFilter.value,
+        search: elements.searchFilter.value.trim(),
+        sort: sortColumn,
+        order: sortDirection,
+        fields: LIST_FIELDS,
+        limit: PAGE_SIZE,
+        cursor: pageCursors[pageIndex]
+    };
+}
+
+// Summary rows carry flat check flags; rebuild the nested check objects the
+// render helpers expect.
+function normalizeMachine(machine) {
+    return {
+        ...machine,
+        disk_encryption: machine.disk_encryption || { encrypted: machine.encrypted },
+        os_update: machine.os_update || { up_to_date: machine.up_to_date },
+        antivirus: machine.antivirus || { antivirus_present: machine.antivirus_present },
+        sleep_settings: machine.sleep_settings || { compliant: machine.sleep_compliant }
+    };
+}
+
 async function fetchMachineDetails(machineId) {
     const response = await fetch(`${API_BASE_URL}/machine/${machineId}`);
     if (!response.ok) {
@@ -142,11 +203,18 @@ async function loadMachines() {
         showLoading();
         hideError();
         
-        const data = await fetchMachines();
-        machines = data || [];
+        // The stat cards are best effort: a failed /stats must not hide the list
+        updateStats().catch(error => console.error('Error loading stats:', error));
+        const page = await fetchMachines(currentQuery());
+        machines = (page.items || []).map(normalizeMachine);
+        filteredMachines = machines;
+        nextCursor = page.next_cursor;
+        totalMatches = page.total;
+        changeCursor = page.change_cursor;
         
-        updateStats();
-        applyFilters();
+        renderMachines();
+        updateMachineCount();
+        updatePagination();
         hideLoading();
         
     } catch (error) {
@@ -157,12 +225,22 @@ async function loadMachines() {
 }
 
 // UI update functions
-function updateStats() {
-    const total = machines.length;
-    const healthy = machines.filter(m => getMachineStatus(m) === 'healthy').length;
+async function fetchStats() {
+    const response = await fetch(`${API_BASE_URL}/stats`);
+    if (!response.ok) {
+        throw new Error(`HTTP ${response.status}: ${response.statusText}`);
+    }
+    
+    return await response.json();
+}
+
+async function updateStats() {
+    // Fleet-wide numbers come from counters the server keeps up to date
+    const stats = await fetchStats();
+    const total = stats.total;
+    const healthy = stats.status.healthy;
     const withIssues = total - healthy;
-    const lastUpdate = machines.length > 0 ? 
-        Math.max(...machines.map(m => new Date(m.timestamp).getTime())) : null;
+    const lastUpdate = stats.last_report ? new Date(stats.last_report).getTime() : null;
     
     elements.totalMachines.textContent = total;
     elements.issueCount.textContent = withIssues;
@@ -171,53 +249,29 @@ function updateStats() {
         formatRelativeTime(new Date(lastUpdate)) : '--';
 }
 
+// Filters, search and sorting run on the server; any change restarts paging
 function applyFilters() {
-    const osFilter = elements.osFilter.value;
-    const issueFilter = elements.issueFilter.value;
-    const searchFilter = elements.searchFilter.value.toLowerCase();
-    
-    filteredMachines = machines.filter(machine => {
-        // OS filter
-        if (osFilter && machine.os !== osFilter) return false;
-        
-        // Issue filter
-        if (issueFilter && !hasIssue(machine, issueFilter)) return false;
-        
-        // Search filter
-        if (searchFilter && !machine.machine_id.toLowerCase().includes(searchFilter)) return false;
-        
-        return true;
-    });
-    
-    sortMachines();
-    renderMachines();
-    updateMachineCount();
+    resetPaging();
+    loadMachines();
 }
 
-function sortMachines() {
-    filteredMachines.sort((a, b) => {
-        let aVal = a[sortColumn];
-        let bVal = b[sortColumn];
-        
-        // Handle nested objects
-        if (sortColumn === 'status') {
-            aVal = getMachineStatus(a);
-            bVal = getMachineStatus(b);
-        } else if (sortColumn === 'timestamp') {
-            aVal = new Date(aVal);
-            bVal = new Date(bVal);
-        }
-        
-        // Convert to string for comparison if needed
-        if (typeof aVal === 'string') aVal = aVal.toLowerCase();
-        if (typeof bVal === 'string') bVal = bVal.toLowerCase();
-        
-        let result = 0;
-        if (aVal < bVal) result = -1;
-        else if (aVal > bVal) result = 1;
-        
-        return sortDirection === 'desc' ? -result : result;
-    });
+function resetPaging() {
+    pageCursors = [null];
+    pageIndex = 0;
+}
+
+function goToPage(index) {
+    if (index < 0 || (index > pageIndex && !nextCursor)) return;
+    pageIndex = index;
+    loadMachines();
+}
+
+function updatePagination() {
+    pageCursors[pageIndex + 1] = nextCursor;
+    const pages = Math.max(Math.ceil(totalMatches / PAGE_SIZE), 1);
+    elements.pageInfo.textContent = `Page ${pageIndex + 1} of ${pages}`;
+    elements.prevPage.disabled = pageIndex === 0;
+    elements.nextPage.disabled = !nextCursor;
 }
 
 function renderMachines() {
@@ -334,6 +388,7 @@ function renderCardView() {
 
 // Helper functions for rendering
 function getMachineStatus(machine) {
+    if (machine.status) return machine.status;
     const checks = [
         machine.disk_encryption?.encrypted,
         machine.os_update?.up_to_date,
@@ -400,21 +455,6 @@ function getOSIcon(os) {
     return icons[os] || '<i class="fas fa-desktop"></i>';
 }
 
-function hasIssue(machine, issueType) {
-    switch (issueType) {
-        case 'unencrypted_disk':
-            return machine.disk_encryption?.encrypted === false;
-        case 'outdated_os':
-            return machine.os_update?.up_to_date === false;
-        case 'no_antivirus':
-            return machine.antivirus?.antivirus_present === false;
-        case 'sleep_noncompliant':
-            return machine.sleep_settings?.compliant === false;
-        default:
-            return false;
-    }
-}
-
 // Utility functions
 function formatDateTime(timestamp) {
     return new Date(timestamp).toLocaleString();
@@ -468,8 +508,8 @@ function handleSort(column) {
         icon.className = sortDirection === 'asc' ? 'fas fa-sort-up' : 'fas fa-sort-down';
     }
     
-    sortMachines();
-    renderMachines();
+    resetPaging();
+    loadMachines();
 }
 
 function toggleView() {
@@ -496,7 +536,7 @@ function clearFilters() {
 }
 
 function updateMachineCount() {
-    const count = filteredMachines.length;
+    const count = totalMatches;
     elements.machineCount.textContent = `${count} machine${count !== 1 ? 's' : ''}`;
 }
 
@@ -619,20 +659,128 @@ function exportData(format) {
     document.body.removeChild(link);
 }
 
-// Auto-refresh
-function startAutoRefresh() {
-    refreshInterval = setInterval(() => {
-        loadMachines();
-    }, REFRESH_INTERVAL);
+// Live updates: apply only the machines that changed instead of re-fetching.
+// Server-Sent Events push changes as they are committed; without EventSource
+// support (or if the stream fails) the change feed is polled with since=.
+function startLiveUpdates() {
+    stopLiveUpdates();
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+    const since = changeCursor !== null ? `?since=${changeCursor}` : '';
+    eventSource = new EventSource(`${API_BASE_URL}/events${since}`);
+    eventSource.addEventListener('machine', (e) => applyChange(JSON.parse(e.data)));
+    eventSource.onerror = () => {
+        // EventSource retries by itself unless the connection was refused outright
+        if (eventSource && eventSource.readyState === EventSource.CLOSED) {
+            eventSource = null;
+            startPolling();
+        }
+    };
 }
 
-function stopAutoRefresh() {
+function stopLiveUpdates() {
+    if (eventSource) {
+        eventSource.close();
+        eventSource = null;
+    }
     if (refreshInterval) {
         clearInterval(refreshInterval);
         refreshInterval = null;
     }
 }
 
+function startPolling() {
+    refreshInterval = setInterval(pollChanges, REFRESH_INTERVAL);
+}
+
+async function pollChanges() {
+    if (changeCursor === null) {
+        loadMachines();
+        return;
+    }
+    try {
+        let feed;
+        do {
+            feed = await fetchMachines({ since: changeCursor, limit: PAGE_SIZE });
+            feed.items.forEach(applyChange);
+            changeCursor = feed.change_cursor;
+        } while (feed.has_more);
+    } catch (error) {
+        console.error('Error polling changes:', error);
+    }
+}
+
+// Whether a summary row passes the active os/issue/search filters, tested the
+// way the server's /machines query does
+function matchesFilters(machine) {
+    const os = elements.osFilter.value;
+    const flag = ISSUE_FLAGS[elements.issueFilter.value];
+    const search = elements.searchFilter.value.trim().toLowerCase();
+    return (!os || (machine.os || '').toLowerCase() === os.toLowerCase()) &&
+        (!flag || machine[flag] !== true) &&
+        (!search || machine.machine_id.toLowerCase().includes(search));
+}
+
+// Merge one changed machine (summary fields) into the current page
+function applyChange(change) {
+    if (change.change_seq <= changeCursor) return;
+    changeCursor = change.change_seq;
+    
+    const machine = normalizeMachine(change);
+    const index = machines.findIndex(m => m.machine_id === machine.machine_id);
+    const followsRecency = pageIndex === 0 && sortColumn === 'timestamp' && sortDirection === 'desc' &&
+        !elements.osFilter.value && !elements.issueFilter.value && !elements.searchFilter.value.trim();
+    
+    if (index >= 0) machines.splice(index, 1);
+    if (!matchesFilters(change)) {
+        // It left the filtered list (e.g. its issue was fixed): drop its row
+        if (index >= 0) {
+            totalMatches = Math.max(totalMatches - 1, 0);
+            updateMachineCount();
+            scheduleRender();
+        }
+        scheduleStatsRefresh();
+        return;
+    }
+    if (followsRecency) {
+        // Newest check-in first: the changed machine moves to the top
+        machines.unshift(machine);
+        if (machines.length > PAGE_SIZE) machines.pop();
+    } else if (index >= 0) {
+        machines.splice(index, 0, machine);
+    } else {
+        // Not on this page; only the summary numbers change
+        scheduleStatsRefresh();
+        return;
+    }
+    
+    scheduleRender();
+    scheduleStatsRefresh();
+}
+
+function scheduleRender() {
+    if (renderTimer) return;
+    renderTimer = setTimeout(() => {
+        renderTimer = null;
+        filteredMachines = machines;
+        renderMachines();
+    }, 200);
+}
+
+function scheduleStatsRefresh() {
+    if (statsTimer) return;
+    statsTimer = setTimeout(async () => {
+        statsTimer = null;
+        try {
+            await updateStats();
+        } catch (error) {
+            console.error('Error refreshing stats:', error);
+        }
+    }, STATS_REFRESH_DELAY);
+}
+
 // UI state management
 function showLoading() {
     elements.loadingIndicator.style.display = 'block';
@@ -654,9 +802,8 @@ function hideError() {
 // Handle page visibility for performance
 document.addEventListener('visibilitychange', () => {
     if (document.hidden) {
-        stopAutoRefresh();
+        stopLiveUpdates();
     } else {
-        startAutoRefresh();
-        loadMachines(); // Refresh when page becomes visible
+        startLiveUpdates(); // Resumes from changeCursor, replaying what was missed
     }
 });
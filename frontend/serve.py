@@ -1,50 +1,345 @@
 #!/usr/bin/env python3
 """
-Simple HTTP server to serve the frontend dashboard
+HTTP server for the frontend dashboard
+
+- Serves requests concurrently (one thread per connection, keep-alive)
+- Keeps the assets in memory with gzip (and brotli, if installed) variants
+  compressed once at startup; files are re-read only when they change
+- Sends ETag/Last-Modified and answers conditional requests with 304
+- index.html links content-hashed asset URLs (script.<hash>.js) that are
+  cached by browsers as immutable
+- With --api, proxies /api/* to the backend so the dashboard and its data
+  come from one origin
 """
 
+import argparse
+import gzip
+import hashlib
+import http.client
 import http.server
-import socketserver
-import webbrowser
-import os
+import json
+import mimetypes
+import re
 import sys
+import threading
+import time
+import webbrowser
+from email.utils import formatdate, parsedate_to_datetime
 from pathlib import Path
+from urllib.parse import urlsplit
+
+try:
+    import brotli
+except ImportError:  # Optional: pip install brotli
+    brotli = None
 
 PORT = 3000
 FRONTEND_DIR = Path(__file__).parent
+# Files served from FRONTEND_DIR, and the ones worth compressing
+ASSET_SUFFIXES = ('.html', '.js', '.css', '.svg', '.ico', '.png', '.json')
+COMPRESSIBLE_SUFFIXES = ('.html', '.js', '.css', '.svg', '.json')
+# Hashed asset URLs never change content, so browsers may keep them for a year
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Seconds between checks of the asset files for changes
+RELOAD_CHECK_INTERVAL = 1
+# Path prefix proxied to the backend when --api is given
+API_PREFIX = '/api'
+# Seconds to wait for the backend before answering 502
+PROXY_TIMEOUT = 30
+# Headers that describe a single connection and must not be forwarded
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade', 'host',
+}
+# Backend response headers not relayed because send_response() writes its own
+REPLACED_RESPONSE_HEADERS = {'server', 'date'}
+# Methods safe to resend when the backend connection fails mid-request
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+class Asset:
+    """One file's content, its compressed variants and validators."""
+
+    def __init__(self, body, content_type, mtime, compress):
+        self.content_type = content_type
+        self.mtime = int(mtime)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.digest = hashlib.sha256(body).hexdigest()[:12]
+        self.etag = f'"{self.digest}"'
+        # Content-Encoding -> body, best first
+        self.variants = {}
+        if compress:
+            if brotli is not None:
+                self.variants['br'] = brotli.compress(body, quality=11)
+            self.variants['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+        self.variants['identity'] = body
+
+    def negotiate(self, accept_encoding):
+        """(encoding, body) for an Accept-Encoding header."""
+        accepted = set()
+        for part in (accept_encoding or '').split(','):
+            name, _, params = part.strip().partition(';')
+            if name and not re.search(r'q=0(\.0*)?\s*$', params):
+                accepted.add(name.strip().lower())
+        for encoding, body in self.variants.items():
+            if encoding in accepted or encoding == 'identity':
+                return encoding, body
+
+class AssetCache:
+    """In-memory copy of the dashboard's files, rebuilt when any of them changes.
+
+    index.html is rewritten to reference the other assets by content-hashed
+    name (styles.css -> styles.<hash>.css) and, when proxying, to point the
+    dashboard at API_PREFIX.
+    """
+
+    def __init__(self, directory, api_base=None):
+        self.directory = Path(directory)
+        self.api_base = api_base
+        self._assets = {}
+        self._stamp = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self.refresh()
+
+    def _scan(self):
+        return {
+            path.name: path.stat().st_mtime_ns for path in sorted(self.directory.iterdir())
+            if path.is_file() and path.suffix in ASSET_SUFFIXES
+        }
+
+    def refresh(self):
+        """Reload the files if any was added, removed or modified."""
+        stamp = self._scan()
+        if stamp == self._stamp:
+            return
+        assets = {}
+        for name in stamp:
+            if name == 'index.html':
+                continue
+            path = self.directory / name
+            content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            if content_type.startswith('text/'):
+                content_type += '; charset=utf-8'
+            assets[name] = Asset(path.read_bytes(), content_type, path.stat().st_mtime,
+                                 path.suffix in COMPRESSIBLE_SUFFIXES)
+        entries = {name: (asset, False) for name, asset in assets.items()}
+        for name, asset in assets.items():
+            stem, _, suffix = name.rpartition('.')
+            entries[f'{stem}.{asset.digest}.{suffix}'] = (asset, True)
+        if 'index.html' in stamp:
+            path = self.directory / 'index.html'
+            html = path.read_text(encoding='utf-8')
+            for name, asset in assets.items():
+                stem, _, suffix = name.rpartition('.')
+                html = re.sub(rf'(\b(?:src|href)=["\']){re.escape(name)}(["\'])',
+                              rf'\g<1>{stem}.{asset.digest}.{suffix}\g<2>', html)
+            if self.api_base is not None:
+                html = html.replace(
+                    '<script', f'<script>window.API_BASE_URL = {json.dumps(self.api_base)};</script>\n    <script', 1)
+            # Changes whenever an asset it links changes
+            mtime = max(stamp.values()) / 1e9
+            entries['index.html'] = (Asset(html.encode('utf-8'), 'text/html; charset=utf-8', mtime, True), False)
+        with self._lock:
+            self._assets = entries
+            self._stamp = stamp
+
+    def get(self, name):
+        """(asset, immutable) for a file name, or None."""
+        now = time.monotonic()
+        if now - self._checked >= RELOAD_CHECK_INTERVAL and self._refresh_lock.acquire(blocking=False):
+            try:
+                self._checked = now
+                self.refresh()
+            except OSError as e:
+                print(f'⚠️  Could not reload assets: {e}')
+            finally:
+                self._refresh_lock.release()
+        with self._lock:
+            return self._assets.get(name)
+
+class DashboardHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    assets = None
+    api_url = None
+    _backend = threading.local()
 
-class CORSHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         super().end_headers()
 
+    def do_GET(self):
+        self.handle_request()
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_OPTIONS(self):
+        if self.is_api_request():
+            return self.proxy()
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def is_api_request(self):
+        path = urlsplit(self.path).path
+        return self.api_url is not None and (path == API_PREFIX or path.startswith(API_PREFIX + '/'))
+
+    def handle_request(self, send_body=True):
+        if self.is_api_request():
+            return self.proxy()
+        if self.command == 'POST':
+            return self.send_error(405)
+        name = urlsplit(self.path).path.lstrip('/') or 'index.html'
+        entry = self.assets.get(name) if '/' not in name else None
+        if entry is None:
+            return self.send_error(404)
+        asset, immutable = entry
+        self.send_asset(asset, immutable, send_body)
+
+    def not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            return etag in tags or '*' in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= mtime
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_asset(self, asset, immutable, send_body=True):
+        encoding, body = asset.negotiate(self.headers.get('Accept-Encoding'))
+        # Each encoding is a different representation, so it gets its own ETag
+        etag = asset.etag if encoding == 'identity' else f'"{asset.digest}-{encoding}"'
+        if self.not_modified(etag, asset.mtime):
+            self.send_response(304)
+            body = b''
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', asset.content_type)
+            if encoding != 'identity':
+                self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', asset.last_modified)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Cache-Control', IMMUTABLE_CACHE_CONTROL if immutable else 'no-cache')
+        self.end_headers()
+        if send_body:
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+
+    def backend_connection(self, fresh=False):
+        """Keep-alive connection to the backend, one per server thread."""
+        conn = getattr(self._backend, 'conn', None)
+        if conn is None or fresh:
+            if conn is not None:
+                conn.close()
+            target = urlsplit(self.api_url)
+            conn_class = http.client.HTTPSConnection if target.scheme == 'https' else http.client.HTTPConnection
+            conn = self._backend.conn = conn_class(target.netloc, timeout=PROXY_TIMEOUT)
+        return conn
+
+    def proxy(self):
+        """Forward the request under API_PREFIX to the backend and relay its response."""
+        target = urlsplit(self.api_url)
+        path = target.path.rstrip('/') + self.path[len(API_PREFIX):]
+        if not path.startswith('/'):
+            path = '/' + path
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        headers = {name: value for name, value in self.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+        headers['X-Forwarded-For'] = self.client_address[0]
+        for attempt in (0, 1):
+            conn = self.backend_connection(fresh=attempt > 0)
+            sent = False
+            try:
+                conn.request(self.command, path, body=body, headers=headers)
+                sent = True
+                response = conn.getresponse()
+                break
+            except (ConnectionError, http.client.HTTPException, OSError) as e:
+                # A kept-alive connection the backend closed is retried once, unless the
+                # backend may already have acted on a request that is not safe to repeat
+                if attempt or (sent and self.command not in IDEMPOTENT_METHODS):
+                    self.backend_connection(fresh=True)
+                    return self.send_error(502, f'Backend unavailable: {e}')
+        self.send_response(response.status, response.reason)
+        for name, value in response.getheaders():
+            name_lower = name.lower()
+            if (name_lower not in HOP_BY_HOP_HEADERS and name_lower not in REPLACED_RESPONSE_HEADERS
+                    and not name_lower.startswith('access-control-')):
+                self.send_header(name, value)
+        length = response.getheader('Content-Length')
+        if length is None:
+            # Streamed body (exports, /events): relay it until the backend closes
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        try:
+            if self.command == 'HEAD':
+                return
+            while True:
+                chunk = response.read1(64 * 1024)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The browser went away (e.g. closed the /events stream)
+            self.close_connection = True
+        finally:
+            if length is None or not response.isclosed():
+                response.close()
+                self.backend_connection(fresh=True)
+
 def main():
-    # Change to frontend directory
-    os.chdir(FRONTEND_DIR)
-    
+    parser = argparse.ArgumentParser(description='Serve the dashboard')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--api', metavar='URL',
+                        help=f'proxy {API_PREFIX}/* to this backend (e.g. http://localhost:8000) '
+                             'and point the dashboard at it')
+    parser.add_argument('--no-browser', action='store_true', help='do not open a browser')
+    args = parser.parse_args()
+
+    DashboardHandler.assets = AssetCache(FRONTEND_DIR, API_PREFIX if args.api else None)
+    DashboardHandler.api_url = args.api
+
     try:
-        with socketserver.TCPServer(("", PORT), CORSHTTPRequestHandler) as httpd:
-            print(f"🚀 Frontend server starting on http://localhost:{PORT}")
-            print(f"📁 Serving files from: {FRONTEND_DIR}")
-            print(f"🔗 Opening dashboard in your default browser...")
-            print(f"\n💡 Make sure your backend is running on http://localhost:8000")
-            print(f"   You can start it with: python flask_backend.py")
+        with http.server.ThreadingHTTPServer(("", args.port), DashboardHandler) as httpd:
+            httpd.daemon_threads = True
+            print(f"🚀 Frontend server starting on http://localhost:{args.port}")
+            print(f"📁 Serving files from: {FRONTEND_DIR} (compression: {'br, ' if brotli else ''}gzip)")
+            if args.api:
+                print(f"🔀 Proxying {API_PREFIX}/* to {args.api}")
+            else:
+                print(f"\n💡 Make sure your backend is running on http://localhost:8000")
+                print(f"   You can start it with: python flask_backend_sqlite.py")
             print(f"\n⏹️  Press Ctrl+C to stop the server")
-            
-            # Open browser
-            webbrowser.open(f'http://localhost:{PORT}')
-            
+
+            if not args.no_browser:
+                print(f"🔗 Opening dashboard in your default browser...")
+                webbrowser.open(f'http://localhost:{args.port}')
+
             # Start server
             httpd.serve_forever()
-            
+
     except KeyboardInterrupt:
         print(f"\n🛑 Server stopped")
         sys.exit(0)
     except OSError as e:
-        if e.errno == 48:  # Address already in use
-            print(f"❌ Port {PORT} is already in use. Try a different port or stop the existing server.")
+        if e.errno in (48, 98):  # Address already in use (macOS, Linux)
+            print(f"❌ Port {args.port} is already in use. Try a different port or stop the existing server.")
         else:
             print(f"❌ Error starting server: {e}")
         sys.exit(1)
@@ -0,0 +1,356 @@
+"""
+Native Linux probes for the system utility checks.
+
+Each probe reads the facts a check needs straight from the filesystem
+instead of forking a helper (lsblk, apt, systemctl, gsettings) and returns
+a result shaped like the matching check in main.py. A probe raises
+ProbeUnavailable when the data it relies on is not present, and the caller
+falls back to the subprocess implementation.
+
+All paths are resolved under ROOT (or the `root` argument), so tests can
+point the probes at a fake root filesystem.
+"""
+
+import bz2
+import glob
+import gzip
+import lzma
+import os
+import re
+import struct
+import xml.etree.ElementTree as ET
+
+try:
+    import lz4.frame
+except ImportError:  # Optional: pip install lz4 (apt's default list compression)
+    lz4 = None
+
+# Filesystem root the probes read from
+ROOT = '/'
+
+DPKG_STATUS = 'var/lib/dpkg/status'
+APT_LISTS_DIR = 'var/lib/apt/lists'
+# Process name and unit of the ClamAV daemon
+CLAMAV_PROCESS = 'clamd'
+CLAMAV_UNIT = 'clamav-daemon.service'
+SYSTEMD_UNITS_DIR = 'run/systemd/units'
+SCHEMAS_DIR = 'usr/share/glib-2.0/schemas'
+POWER_SCHEMA = 'org.gnome.settings-daemon.plugins.power'
+SLEEP_KEY = 'sleep-inactive-ac-timeout'
+
+class ProbeUnavailable(Exception):
+    """The facts a probe needs cannot be read on this machine."""
+
+def _path(root, *parts):
+    return os.path.join(root if root is not None else ROOT, *[p.lstrip('/') for p in parts])
+
+def _read_text(path):
+    with open(path, encoding='utf-8', errors='replace') as f:
+        return f.read().strip()
+
+# --- Disk encryption -------------------------------------------------------
+
+def disk_encryption(root=None):
+    """LUKS/dm-crypt detection from device-mapper uuids in /sys/block."""
+    block_dir = _path(root, 'sys/block')
+    if not os.path.isdir(block_dir):
+        raise ProbeUnavailable(f'{block_dir} not found')
+    lines = []
+    encrypted = False
+    for uuid_path in sorted(glob.glob(os.path.join(block_dir, 'dm-*', 'dm', 'uuid'))):
+        device = uuid_path.split(os.sep)[-3]
+        uuid = _read_text(uuid_path)
+        try:
+            name = _read_text(os.path.join(os.path.dirname(uuid_path), 'name'))
+        except OSError:
+            name = device
+        # dm-crypt targets are created with a CRYPT-<type>-... uuid (cryptsetup)
+        is_crypt = uuid.startswith('CRYPT-')
+        encrypted = encrypted or is_crypt
+        lines.append(f"{name} ({device}) {'crypt' if is_crypt else 'dm'} {uuid}")
+    return {'encrypted': encrypted, 'details': '\n'.join(lines) or 'No device-mapper devices'}
+
+# --- OS updates ------------------------------------------------------------
+
+def _stanzas(lines, fields):
+    """Yield {field: value} per deb822 stanza, keeping only `fields`."""
+    stanza = {}
+    for line in lines:
+        if not line.strip():
+            if stanza:
+                yield stanza
+                stanza = {}
+            continue
+        if line[0] in ' \t':
+            continue
+        key, sep, value = line.partition(':')
+        if sep and key in fields:
+            stanza[key] = value.strip()
+    if stanza:
+        yield stanza
+
+# Package list file suffixes apt may use -> opener taking (path, mode, encoding=, errors=);
+# None for compressions we cannot read here
+LIST_OPENERS = {
+    '': open,
+    '.gz': gzip.open,
+    '.xz': lzma.open,
+    '.bz2': bz2.open,
+    '.lz4': lz4.frame.open if lz4 is not None else None,
+    '.zst': None,
+}
+
+def _list_suffix(path):
+    return path[path.rindex('_Packages') + len('_Packages'):]
+
+def _read_list(path):
+    """Yield the stanzas of one apt Packages list; ProbeUnavailable if it cannot be read."""
+    opener = LIST_OPENERS[_list_suffix(path)]
+    if opener is None:
+        raise ProbeUnavailable(f'Cannot read {os.path.basename(path)}')
+    try:
+        with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+            yield from _stanzas(f, ('Package', 'Version', 'Architecture'))
+    except (OSError, EOFError, ValueError, RuntimeError, lzma.LZMAError) as e:
+        raise ProbeUnavailable(f'Cannot read {os.path.basename(path)}: {e}')
+
+def _char_order(c):
+    if c == '~':
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+def _compare_fragment(a, b):
+    """dpkg's verrevcmp for an upstream version or revision."""
+    while a or b:
+        a_text = re.match(r'[^0-9]*', a).group()
+        b_text = re.match(r'[^0-9]*', b).group()
+        for i in range(max(len(a_text), len(b_text))):
+            ac = _char_order(a_text[i]) if i < len(a_text) else 0
+            bc = _char_order(b_text[i]) if i < len(b_text) else 0
+            if ac != bc:
+                return -1 if ac < bc else 1
+        a, b = a[len(a_text):], b[len(b_text):]
+        a_num = re.match(r'[0-9]*', a).group()
+        b_num = re.match(r'[0-9]*', b).group()
+        if int(a_num or 0) != int(b_num or 0):
+            return -1 if int(a_num or 0) < int(b_num or 0) else 1
+        a, b = a[len(a_num):], b[len(b_num):]
+    return 0
+
+def _split_version(version):
+    epoch, sep, rest = version.partition(':')
+    if not sep:
+        epoch, rest = '0', version
+    upstream, sep, revision = rest.rpartition('-')
+    if not sep:
+        upstream, revision = rest, ''
+    return int(epoch or 0), upstream, revision
+
+def compare_versions(a, b):
+    """Compare two Debian package versions; returns -1, 0 or 1."""
+    a_epoch, a_upstream, a_revision = _split_version(a)
+    b_epoch, b_upstream, b_revision = _split_version(b)
+    if a_epoch != b_epoch:
+        return -1 if a_epoch < b_epoch else 1
+    return _compare_fragment(a_upstream, b_upstream) or _compare_fragment(a_revision, b_revision)
+
+def _not_automatic(list_path):
+    """True when the list belongs to a NotAutomatic suite (e.g. backports)."""
+    name = os.path.basename(list_path)
+    if '_dists_' not in name:
+        return False
+    prefix, _, rest = name.partition('_dists_')
+    suite = rest.split('_', 1)[0]
+    for release in ('InRelease', 'Release'):
+        path = os.path.join(os.path.dirname(list_path), f'{prefix}_dists_{suite}_{release}')
+        try:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    if not line.strip():
+                        break
+                    if line.lower().startswith('notautomatic:'):
+                        return line.split(':', 1)[1].strip().lower() == 'yes'
+            return False
+        except OSError:
+            continue
+    return False
+
+def installed_packages(root=None):
+    """{(name, arch): version} of installed packages from the dpkg database."""
+    path = _path(root, DPKG_STATUS)
+    try:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            return {
+                (s['Package'], s.get('Architecture', 'all')): s['Version']
+                for s in _stanzas(f, ('Package', 'Version', 'Architecture', 'Status'))
+                if 'Version' in s and s.get('Status', '').split()[-1:] == ['installed']
+            }
+    except OSError as e:
+        raise ProbeUnavailable(f'dpkg status not readable: {e}')
+
+def os_updates(root=None):
+    """Pending upgrades: installed dpkg versions vs. the newest in the apt lists.
+
+    apt pin priorities are not evaluated; lists of NotAutomatic suites are
+    skipped, which covers the usual backports case.
+    """
+    installed = installed_packages(root)
+    lists_dir = _path(root, APT_LISTS_DIR)
+    # Skip pdiff indexes and the like; every real list must be read, or an
+    # unreadable one (e.g. lz4 without the module) could hide upgrades
+    lists = sorted(path for path in glob.glob(os.path.join(lists_dir, '*_Packages*'))
+                   if _list_suffix(path) in LIST_OPENERS)
+    if not lists:
+        raise ProbeUnavailable(f'No package lists in {lists_dir}')
+    candidates = {}
+    for list_path in lists:
+        if _not_automatic(list_path):
+            continue
+        for s in _read_list(list_path):
+            key = (s.get('Package'), s.get('Architecture', 'all'))
+            version = s.get('Version')
+            if key not in installed or version is None:
+                continue
+            if key not in candidates or compare_versions(version, candidates[key]) > 0:
+                candidates[key] = version
+    upgradable = sorted(
+        f'{name}/{arch} {installed[(name, arch)]} -> {version}'
+        for (name, arch), version in candidates.items()
+        if compare_versions(version, installed[(name, arch)]) > 0
+    )
+    details = '\n'.join(upgradable) if upgradable else 'All packages are up to date.'
+    return {'up_to_date': not upgradable, 'details': details}
+
+# --- Antivirus -------------------------------------------------------------
+
+def running_processes(name, root=None):
+    """PIDs whose /proc/<pid>/comm equals `name`."""
+    proc_dir = _path(root, 'proc')
+    if not os.path.isdir(proc_dir):
+        raise ProbeUnavailable(f'{proc_dir} not found')
+    pids = []
+    for entry in os.listdir(proc_dir):
+        if not entry.isdigit():
+            continue
+        try:
+            comm = _read_text(os.path.join(proc_dir, entry, 'comm'))
+        except OSError:
+            continue  # Process exited while scanning
+        if comm == name:
+            pids.append(int(entry))
+    return sorted(pids)
+
+def antivirus(root=None):
+    """ClamAV daemon state from systemd's runtime unit files and /proc."""
+    pids = running_processes(CLAMAV_PROCESS, root)
+    # systemd keeps an invocation id link for every unit it has started
+    unit_started = os.path.lexists(_path(root, SYSTEMD_UNITS_DIR, f'invocation:{CLAMAV_UNIT}'))
+    if pids:
+        status = f"active ({CLAMAV_PROCESS} pid {', '.join(map(str, pids))})"
+    else:
+        status = 'inactive' + (f' ({CLAMAV_UNIT} started but not running)' if unit_started else '')
+    return {'antivirus_present': bool(pids), 'status': status}
+
+# --- Sleep settings --------------------------------------------------------
+
+def _gvdb_items(data):
+    """{full key: (type, value bytes)} of a GVDB file's root hash table."""
+    if len(data) < 24 or data[:8] != b'GVariant':
+        raise ValueError('Not a GVDB file')
+    start, end = struct.unpack_from('<II', data, 16)
+    n_bloom_words, n_buckets = struct.unpack_from('<II', data, start)
+    n_bloom_words &= (1 << 27) - 1
+    items_start = start + 8 + 4 * (n_bloom_words + n_buckets)
+    count = (end - items_start) // 24
+    raw = []
+    for i in range(count):
+        _, parent, key_start, key_size, kind, _, value_start, value_end = struct.unpack_from(
+            '<IIIHccII', data, items_start + 24 * i)
+        raw.append((parent, data[key_start:key_start + key_size].decode('utf-8'),
+                    kind.decode('ascii'), data[value_start:value_end]))
+
+    names = {}
+
+    def full_name(index):
+        if index not in names:
+            parent, key = raw[index][0], raw[index][1]
+            names[index] = (full_name(parent) if parent != 0xFFFFFFFF else '') + key
+        return names[index]
+
+    return {full_name(i): (kind, value) for i, (_, _, kind, value) in enumerate(raw)}
+
+def _gvariant_int(value):
+    """Integer held by a serialized 'v' (variant) GVariant of type i or u."""
+    data, _, type_string = value.rpartition(b'\0')
+    if type_string == b'i':
+        return struct.unpack('<i', data[:4])[0]
+    if type_string == b'u':
+        return struct.unpack('<I', data[:4])[0]
+    raise ValueError(f'Unexpected GVariant type {type_string!r}')
+
+def dconf_value(key, root=None, config_home=None):
+    """Integer stored for `key` in the user's dconf database, or None if unset."""
+    if config_home is None:
+        config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+    try:
+        with open(_path(root, config_home, 'dconf', 'user'), 'rb') as f:
+            items = _gvdb_items(f.read())
+    except FileNotFoundError:
+        return None  # Nothing changed from the defaults yet
+    entry = items.get(key)
+    if entry is None or entry[0] != 'v':
+        return None
+    return _gvariant_int(entry[1])
+
+def schema_default(schema, key, root=None):
+    """Default of a GSettings key from its schema XML and vendor override files."""
+    schemas_dir = _path(root, SCHEMAS_DIR)
+    try:
+        tree = ET.parse(os.path.join(schemas_dir, f'{schema}.gschema.xml'))
+    except (OSError, ET.ParseError) as e:
+        raise ProbeUnavailable(f'Schema {schema} not available: {e}')
+    default = None
+    for element in tree.iter('schema'):
+        if element.get('id') != schema:
+            continue
+        for key_element in element.iter('key'):
+            if key_element.get('name') == key:
+                default = key_element.findtext('default')
+    # Overrides are applied in file name order, later files winning
+    for path in sorted(glob.glob(os.path.join(schemas_dir, '*.gschema.override'))):
+        section = None
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('['):
+                    section = line.strip('[]')
+                elif section == schema and line.partition('=')[0].strip() == key:
+                    default = line.partition('=')[2].strip()
+    if default is None:
+        raise ProbeUnavailable(f'{schema} has no key {key}')
+    return int(default.split()[-1])  # GVariant text, e.g. "1200" or "int32 1200"
+
+def sleep_settings(root=None, config_home=None):
+    """GNOME AC sleep timeout from the dconf database, else the schema default."""
+    dconf_key = f"/{POWER_SCHEMA.replace('.', '/')}/{SLEEP_KEY}"
+    seconds = dconf_value(dconf_key, root, config_home)
+    source = 'dconf'
+    if seconds is None:
+        seconds = schema_default(POWER_SCHEMA, SLEEP_KEY, root)
+        source = 'schema default'
+    minutes = seconds // 60
+    return {
+        'sleep_timeout_minutes': minutes,
+        'compliant': minutes <= 10,
+        'details': f'{seconds} ({source})',
+    }
+
+# Check name (as in main.CHECKS) -> native probe
+PROBES = {
+    'disk_encryption': disk_encryption,
+    'os_update': os_updates,
+    'antivirus': antivirus,
+    'sleep_settings': sleep_settings,
+}
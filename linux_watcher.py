@@ -0,0 +1,130 @@
+"""
+inotify watcher for the system utility's watch mode (Linux only).
+
+Watches the directories holding the files each check reads (see
+linux_probes.py) and reports which checks are affected by a change, so the
+daemon can re-run just those checks instead of polling all of them.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+import linux_probes
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# Files are usually replaced by rename (dpkg, apt, dconf), so directories are
+# watched for entries being written, moved in/out, created or removed
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE | IN_ATTRIB
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+def watch_spec(root=None, config_home=None):
+    """Check name -> [(directory, file name filter)] of the files behind it.
+
+    A filter of None matches every entry in the directory; otherwise it is a
+    substring the entry name must contain.
+    """
+    root = root if root is not None else linux_probes.ROOT
+    if config_home is None:
+        config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+
+    def path(*parts):
+        return os.path.join(root, *[p.lstrip('/') for p in parts])
+
+    return {
+        'disk_encryption': [(path('dev/mapper'), None)],
+        'os_update': [
+            (os.path.dirname(path(linux_probes.DPKG_STATUS)), os.path.basename(linux_probes.DPKG_STATUS)),
+            (path(linux_probes.APT_LISTS_DIR), '_Packages'),
+        ],
+        'antivirus': [(path(linux_probes.SYSTEMD_UNITS_DIR), linux_probes.CLAMAV_UNIT)],
+        'sleep_settings': [(path(config_home, 'dconf'), 'user')],
+    }
+
+class InotifyWatcher:
+    """Blocks until files behind some checks change and names those checks.
+
+    Events are debounced: after the first one the watcher keeps collecting
+    until `debounce` seconds pass without events (at most `max_delay`), so a
+    package upgrade rewriting many files triggers a single re-check.
+    """
+
+    def __init__(self, spec, debounce=2, max_delay=30):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        # wd -> [(check name, file name filter)]
+        self._watches = {}
+        self.watched = set()
+        for name, paths in spec.items():
+            for directory, name_filter in paths:
+                wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+                if wd < 0:
+                    err = ctypes.get_errno()
+                    if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                        continue  # Nothing to watch here; the safety-net poll covers it
+                    raise OSError(err, f'{os.strerror(err)}: {directory}')
+                self._watches.setdefault(wd, []).append((name, name_filter))
+                self.watched.add(name)
+
+    def close(self):
+        os.close(self.fd)
+
+    def _read(self):
+        """Check names affected by the events currently queued."""
+        affected = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return affected
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            filename = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: assume everything changed
+                affected.update(self.watched)
+                continue
+            for name, name_filter in self._watches.get(wd, ()):
+                if name_filter is None or name_filter in filename:
+                    affected.add(name)
+        return affected
+
+    def wait(self, timeout):
+        """Affected check names, or an empty set if `timeout` seconds pass quietly."""
+        deadline = time.monotonic() + timeout
+        affected = set()
+        while not affected:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return affected
+            if not select.select([self.fd], [], [], remaining)[0]:
+                return affected
+            affected = self._read()
+        give_up = time.monotonic() + self.max_delay
+        while True:
+            quiet = min(self.debounce, give_up - time.monotonic())
+            if quiet <= 0 or not select.select([self.fd], [], [], quiet)[0]:
+                return affected
+            affected |= self._read()
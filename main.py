@@ -12,6 +12,117 @@ import threading
 import subprocess
 import re
 import sys
+import os
+import json
+import hashlib
+import locale
+import random
+import sqlite3
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import linux_probes
+
+# Backend base URL (Flask or FastAPI server)
+API_URL = 'http://localhost:8000'
+MACHINE_ID_FILE = 'machine_id.txt'
+# Seconds before an API request is abandoned
+HTTP_TIMEOUT = 10
+# Reports the server could not take are queued on disk in the agent's state
+# directory and sent to /report/batch, SPOOL_BATCH_SIZE at a time, once it is
+# reachable again. Beyond SPOOL_MAX_REPORTS the oldest are dropped.
+STATE_DIR = os.environ.get('SOLSPHERE_STATE_DIR') or os.path.join(os.path.expanduser('~'), '.solsphere')
+SPOOL_FILE = 'spool.db'
+SPOOL_BATCH_SIZE = 100
+SPOOL_MAX_REPORTS = 10000
+# Delay (seconds) before retrying after the server was unreachable: doubled
+# per consecutive failure up to RETRY_MAX_SECONDS, with random jitter
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 15 * 60
+# The server assigns each report's successor a time slot (next_report_in) and
+# answers 429/503 with Retry-After when overloaded. Both are honoured, shifted
+# by up to REPORT_JITTER_SECONDS so agents given the same time do not collide.
+REPORT_JITTER_SECONDS = 15
+# The first report waits a random 0..STARTUP_JITTER_SECONDS, so a fleet started
+# together (boot storm, mass deploy) reaches the server spread out before it
+# has handed out report slots
+STARTUP_JITTER_SECONDS = 120
+# Keys holding raw command output or run metadata; left out of content hashes
+# so that noise in the text does not trigger resends
+VOLATILE_KEYS = ('details', 'status', 'timed_out')
+# Command output in 'details'/'status' is sent with column padding and blank
+# lines squeezed out and cut at MAX_DETAILS_LENGTH characters
+MAX_DETAILS_LENGTH = 1000
+
+# Default deadline (seconds) for a single check when it does not declare its own
+DEFAULT_CHECK_TIMEOUT = 60
+# Extra time given to a check's worker thread to unwind after its deadline
+CHECK_GRACE_SECONDS = 2
+# On Linux, read check facts directly (see linux_probes.py) before falling
+# back to lsblk/apt/systemctl/gsettings
+NATIVE_LINUX_PROBES = True
+# Per-check timings (wall time, subprocess exit status and output size) are
+# sent with each report; set SOLSPHERE_TIMING_LOG to also append them to a
+# local file, one JSON line per collection cycle
+TIMING_LOG = os.environ.get('SOLSPHERE_TIMING_LOG')
+# Longest command line kept in a timing entry
+MAX_COMMAND_LENGTH = 200
+
+# Per-thread state of the check currently running in a worker (deadline, timeout
+# flag, subprocesses run so far)
+_check_state = threading.local()
+
+def output_bytes(output, kwargs):
+    """Size in bytes of check_output() output, re-encoded when it was decoded to text."""
+    if isinstance(output, str):
+        # Encoded the way subprocess decoded it (its text mode uses the locale encoding)
+        output = output.encode(kwargs.get('encoding') or locale.getpreferredencoding(False), 'replace')
+    return len(output or b'')
+
+def run_command(args, **kwargs):
+    """subprocess.check_output bounded by the deadline of the running check.
+
+    The child process is killed when the deadline passes, so a hung command
+    (e.g. `apt list --upgradable`) can never stall the collector. Wall time,
+    exit status and output size are recorded for the check's timings.
+    """
+    deadline = getattr(_check_state, 'deadline', None)
+    if deadline is not None:
+        kwargs.setdefault('timeout', max(deadline - time.monotonic(), 0.1))
+    entry = {'command': ' '.join(args)[:MAX_COMMAND_LENGTH], 'exit_status': None, 'output_bytes': 0}
+    start = time.monotonic()
+    try:
+        output = subprocess.check_output(args, **kwargs)
+        entry['exit_status'] = 0
+        entry['output_bytes'] = output_bytes(output, kwargs)
+        return output
+    except subprocess.CalledProcessError as e:
+        entry['exit_status'] = e.returncode
+        entry['output_bytes'] = output_bytes(e.output, kwargs)
+        raise
+    except subprocess.TimeoutExpired:
+        _check_state.timed_out = True
+        entry['timed_out'] = True
+        raise
+    finally:
+        entry['seconds'] = round(time.monotonic() - start, 4)
+        commands = getattr(_check_state, 'commands', None)
+        if commands is not None:
+            commands.append(entry)
+
+def native_probe(name):
+    """Result of the native Linux probe for a check, or None to use the subprocess version."""
+    if not NATIVE_LINUX_PROBES:
+        return None
+    try:
+        return linux_probes.PROBES[name]()
+    except linux_probes.ProbeUnavailable:
+        return None
+    except Exception as e:
+        print(f'Native {name} probe failed, falling back: {e}')
+        return None
 
 def is_admin():
     if platform.system() == 'Windows':
@@ -27,7 +138,7 @@ def check_disk_encryption():
         if not is_admin():
             return {'encrypted': None, 'details': 'Administrator privileges required to check BitLocker status.'}
         try:
-            output = subprocess.check_output(
+            output = run_command(
                 ['powershell', '-Command', 'Get-BitLockerVolume | Select-Object -Property VolumeStatus'],
                 stderr=subprocess.STDOUT, text=True)
             encrypted = 'FullyEncrypted' in output
@@ -35,10 +146,12 @@ def check_disk_encryption():
         except Exception as e:
             return {'encrypted': None, 'details': str(e)}
     elif system == 'Linux':
+        result = native_probe('disk_encryption')
+        if result is not None:
+            return result
         try:
             # Check for LUKS encrypted partitions
-            output = subprocess.check_output(['lsblk', '-o', 'NAME,TYPE,MOUNTPOINT'], text=True)
-            crypt_output = subprocess.check_output(['lsblk', '-o', 'NAME,TYPE'], text=True)
+            crypt_output = run_command(['lsblk', '-o', 'NAME,TYPE'], text=True)
             encrypted = 'crypt' in crypt_output
             return {'encrypted': encrypted, 'details': crypt_output.strip()}
         except Exception as e:
@@ -46,7 +159,7 @@ def check_disk_encryption():
     elif system == 'Darwin':
         try:
             # Check FileVault status
-            output = subprocess.check_output(['fdesetup', 'status'], text=True)
+            output = run_command(['fdesetup', 'status'], text=True)
             encrypted = 'On' in output
             return {'encrypted': encrypted, 'details': output.strip()}
         except Exception as e:
@@ -62,16 +175,19 @@ def check_os_update_status():
         except Exception as e:
             return {'up_to_date': None, 'details': str(e)}
     elif system == 'Linux':
+        result = native_probe('os_update')
+        if result is not None:
+            return result
         try:
             # Check for available updates (Debian/Ubuntu)
-            output = subprocess.check_output(['apt', 'list', '--upgradable'], text=True, stderr=subprocess.DEVNULL)
+            output = run_command(['apt', 'list', '--upgradable'], text=True, stderr=subprocess.DEVNULL)
             up_to_date = 'upgradable' not in output
             return {'up_to_date': up_to_date, 'details': output.strip()}
         except Exception as e:
             return {'up_to_date': None, 'details': str(e)}
     elif system == 'Darwin':
         try:
-            output = subprocess.check_output(['softwareupdate', '-l'], text=True)
+            output = run_command(['softwareupdate', '-l'], text=True)
             up_to_date = 'No new software available.' in output
             return {'up_to_date': up_to_date, 'details': output.strip()}
         except Exception as e:
@@ -82,17 +198,21 @@ def check_antivirus_status():
     system = platform.system()
     if system == 'Windows':
         try:
-            output = subprocess.check_output(
-                ['powershell', '-Command', 'Get-MpComputerStatus | Select-Object -Property AMServiceEnabled,AntivirusEnabled,RealTimeProtectionEnabled,AntivirusSignatureLastUpdated'],
+            # Format-List puts each value on its own line instead of a column-wrapped table
+            output = run_command(
+                ['powershell', '-Command', 'Get-MpComputerStatus | Select-Object -Property AMServiceEnabled,AntivirusEnabled,RealTimeProtectionEnabled,AntivirusSignatureLastUpdated | Format-List'],
                 stderr=subprocess.STDOUT, text=True)
             present = 'True' in output
             return {'antivirus_present': present, 'status': output.strip()}
         except Exception as e:
             return {'antivirus_present': None, 'status': str(e)}
     elif system == 'Linux':
+        result = native_probe('antivirus')
+        if result is not None:
+            return result
         try:
             # Check for ClamAV as a common open-source AV
-            output = subprocess.check_output(['systemctl', 'is-active', 'clamav-daemon'], text=True)
+            output = run_command(['systemctl', 'is-active', 'clamav-daemon'], text=True)
             present = 'active' in output
             return {'antivirus_present': present, 'status': output.strip()}
         except Exception as e:
@@ -100,7 +220,7 @@ def check_antivirus_status():
     elif system == 'Darwin':
         # No built-in AV, check for common AV process (e.g., ClamXAV)
         try:
-            output = subprocess.check_output(['pgrep', 'ClamXAV'], text=True)
+            output = run_command(['pgrep', 'ClamXAV'], text=True)
             present = bool(output.strip())
             return {'antivirus_present': present, 'status': 'ClamXAV running' if present else 'Not running'}
         except Exception as e:
@@ -111,7 +231,7 @@ def check_sleep_settings():
     system = platform.system()
     if system == 'Windows':
         try:
-            output = subprocess.check_output(
+            output = run_command(
                 ['powershell', '-Command', 'powercfg -query SCHEME_CURRENT SUB_SLEEP STANDBYIDLE'],
                 stderr=subprocess.STDOUT, text=True)
             match = re.search(r'Power Setting Index: (\d+)', output)
@@ -121,9 +241,12 @@ def check_sleep_settings():
         except Exception as e:
             return {'sleep_timeout_minutes': None, 'compliant': None, 'details': str(e)}
     elif system == 'Linux':
+        result = native_probe('sleep_settings')
+        if result is not None:
+            return result
         try:
             # Check sleep timeout (AC) using gsettings (GNOME)
-            output = subprocess.check_output(['gsettings', 'get', 'org.gnome.settings-daemon.plugins.power', 'sleep-inactive-ac-timeout'], text=True)
+            output = run_command(['gsettings', 'get', 'org.gnome.settings-daemon.plugins.power', 'sleep-inactive-ac-timeout'], text=True)
             seconds = int(output.strip())
             minutes = seconds // 60
             compliant = minutes <= 10
@@ -133,7 +256,7 @@ def check_sleep_settings():
     elif system == 'Darwin':
         try:
             # Get sleep settings using pmset
-            output = subprocess.check_output(['pmset', '-g', 'custom'], text=True)
+            output = run_command(['pmset', '-g', 'custom'], text=True)
             match = re.search(r'sleep\s+(\d+)', output)
             minutes = int(match.group(1)) if match else None
             compliant = minutes is not None and minutes <= 10
@@ -142,58 +265,646 @@ def check_sleep_settings():
             return {'sleep_timeout_minutes': None, 'compliant': None, 'details': str(e)}
     return {'sleep_timeout_minutes': None, 'compliant': None, 'details': 'Not implemented'}
 
-def collect_system_data():
-    return {
-        'os': platform.system(),
-        'disk_encryption': check_disk_encryption(),
-        'os_update': check_os_update_status(),
-        'antivirus': check_antivirus_status(),
-        'sleep_settings': check_sleep_settings(),
-    }
+# Registry of checks run by the collector: report key -> check function, its
+# deadline in seconds and the result reported when the check cannot finish.
+# 'refresh' is how often (seconds) the check is re-run; checks without one
+# follow the daemon interval. 'ttl' is how long a cached result may still be
+# reported when a refresh fails or times out.
+CHECKS = {
+    'disk_encryption': {
+        'func': check_disk_encryption,
+        'timeout': 60,
+        'refresh': 2 * 3600,
+        'ttl': 8 * 3600,
+        'empty': {'encrypted': None, 'details': None},
+    },
+    'os_update': {
+        'func': check_os_update_status,
+        'timeout': 120,
+        'refresh': 6 * 3600,
+        'ttl': 24 * 3600,
+        'empty': {'up_to_date': None, 'details': None},
+    },
+    'antivirus': {
+        'func': check_antivirus_status,
+        'timeout': 60,
+        'refresh': 3600,
+        'ttl': 4 * 3600,
+        'empty': {'antivirus_present': None, 'status': None},
+    },
+    'sleep_settings': {
+        'func': check_sleep_settings,
+        'timeout': 30,
+        'empty': {'sleep_timeout_minutes': None, 'compliant': None, 'details': None},
+    },
+}
+
+# Default refresh interval (seconds) for checks that do not declare one
+DEFAULT_REFRESH_SECONDS = 30 * 60
+# Watch mode (--watch, Linux): checks whose files are watched are re-run on
+# change, and otherwise only by this safety-net poll (seconds). Changes are
+# debounced for WATCH_DEBOUNCE_SECONDS of quiet, at most WATCH_MAX_DELAY_SECONDS.
+WATCH_SAFETY_NET_SECONDS = 6 * 3600
+WATCH_DEBOUNCE_SECONDS = 2
+WATCH_MAX_DELAY_SECONDS = 30
+
+# name -> {'result': dict, 'fetched_at': last run, 'produced_at': when result was produced}
+_check_cache = {}
+_check_cache_lock = threading.Lock()
+
+# Checks re-run on file changes by the watcher; their polling is stretched to the safety net
+_watched_checks = set()
+
+# What the server last acknowledged: overall content hash and per-section hashes
+_acked = {'content_hash': None, 'sections': {}}
+
+_check_executor = ThreadPoolExecutor(max_workers=2 * len(CHECKS), thread_name_prefix='check')
+# Futures of checks that missed their deadline and are still running. Python
+# threads cannot be killed, so such a check is not resubmitted until its
+# worker returns; at most one worker per check can be stuck this way.
+_stuck_checks = {}
+
+def _check_timeout(name):
+    return CHECKS[name].get('timeout', DEFAULT_CHECK_TIMEOUT)
+
+def failed_result(name, message, timed_out=False):
+    """Partial result for a check that raised or missed its deadline."""
+    result = dict(CHECKS[name]['empty'])
+    result['details' if 'details' in result else 'status'] = message
+    if timed_out:
+        result['timed_out'] = True
+    return result
+
+def compact_details(text):
+    """Command output without padding or blank lines, cut at MAX_DETAILS_LENGTH."""
+    lines = (re.sub(r'[ \t]+', ' ', line).strip() for line in text.splitlines())
+    text = '\n'.join(line for line in lines if line)
+    if len(text) > MAX_DETAILS_LENGTH:
+        text = f'{text[:MAX_DETAILS_LENGTH]}... [{len(text) - MAX_DETAILS_LENGTH} more characters]'
+    return text
+
+def _run_check(name, deadline):
+    """Run one check in a worker. Returns (result, timing)."""
+    _check_state.deadline = deadline
+    _check_state.timed_out = False
+    _check_state.commands = []
+    start = time.monotonic()
+    try:
+        try:
+            result = CHECKS[name]['func']()
+        except Exception as e:
+            result = failed_result(name, str(e))
+        if _check_state.timed_out:
+            result['timed_out'] = True
+        for key in ('details', 'status'):
+            if isinstance(result.get(key), str):
+                result[key] = compact_details(result[key])
+        timing = {
+            'seconds': round(time.monotonic() - start, 4),
+            'failed': bool(_is_failed(result)),
+            'output_bytes': len(json.dumps(result)),
+            'commands': _check_state.commands,
+        }
+        return result, timing
+    finally:
+        _check_state.deadline = None
+        _check_state.commands = None
+
+def run_checks(names, timings=None):
+    """Run the given checks concurrently, each bounded by its own deadline.
+
+    Returns {name: result}. A check that misses its deadline gets a partial
+    result marked 'timed_out', so a cycle takes as long as the slowest check
+    rather than the sum of all of them. Until the stuck worker of such a
+    check returns, the check is reported unavailable instead of being run
+    again. Each check's timing is stored in `timings` when given.
+    """
+    start = time.monotonic()
+    results = {}
+    futures = {}
+    for name in names:
+        stuck = _stuck_checks.get(name)
+        if stuck is not None and not stuck.done():
+            results[name] = failed_result(name, 'Unavailable: the previous run of this check is still hung',
+                                          timed_out=True)
+            if timings is not None:
+                timings[name] = {'seconds': 0, 'failed': True, 'timed_out': True, 'skipped': True}
+            continue
+        _stuck_checks.pop(name, None)
+        futures[name] = _check_executor.submit(_run_check, name, start + _check_timeout(name))
+    for name, future in futures.items():
+        remaining = start + _check_timeout(name) + CHECK_GRACE_SECONDS - time.monotonic()
+        try:
+            results[name], timing = future.result(timeout=max(remaining, 0))
+        except FutureTimeout:
+            # The worker is stuck outside run_command() and cannot be stopped; keep it
+            # from being joined by another copy of the same check next cycle
+            _stuck_checks[name] = future
+            results[name] = failed_result(name, f'Check timed out after {_check_timeout(name)}s', timed_out=True)
+            timing = {'seconds': round(time.monotonic() - start, 4), 'failed': True, 'timed_out': True}
+        if timings is not None:
+            timings[name] = timing
+    return results
+
+def log_timings(timings):
+    """Append one cycle's check timings to TIMING_LOG, if configured."""
+    if not TIMING_LOG or not timings:
+        return
+    entry = {'time': datetime.now(timezone.utc).isoformat(), 'checks': timings}
+    try:
+        with open(TIMING_LOG, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+    except OSError as e:
+        print(f'Could not write timing log: {e}')
+
+def _check_refresh(name, default_refresh):
+    refresh = CHECKS[name].get('refresh') or default_refresh
+    if name in _watched_checks:
+        return max(refresh, WATCH_SAFETY_NET_SECONDS)
+    return refresh
+
+def _check_ttl(name, default_refresh):
+    return CHECKS[name].get('ttl') or 2 * _check_refresh(name, default_refresh)
+
+def stale_checks(default_refresh=DEFAULT_REFRESH_SECONDS, now=None):
+    """Names of checks whose cached result is missing or due for a refresh."""
+    now = time.monotonic() if now is None else now
+    with _check_cache_lock:
+        return [
+            name for name in CHECKS
+            if name not in _check_cache
+            or now - _check_cache[name]['fetched_at'] >= _check_refresh(name, default_refresh)
+        ]
+
+def seconds_until_next_check(default_refresh=DEFAULT_REFRESH_SECONDS):
+    """Time until the earliest cached check becomes due again."""
+    now = time.monotonic()
+    with _check_cache_lock:
+        if len(_check_cache) < len(CHECKS):
+            return 0
+        return max(min(
+            entry['fetched_at'] + _check_refresh(name, default_refresh) - now
+            for name, entry in _check_cache.items()
+        ), 0)
+
+def collect_system_data(refresh=None, default_refresh=DEFAULT_REFRESH_SECONDS):
+    """Collect all check results, re-running only the checks that need it.
+
+    By default only stale checks are executed and the rest are served from
+    the cache. `refresh` forces the given check names to run (plus anything
+    never run or past its TTL). A refresh that fails or times out keeps the
+    previous result while it is within the check's TTL.
+    """
+    now = time.monotonic()
+    if refresh is None:
+        due = set(stale_checks(default_refresh, now))
+    else:
+        due = set(refresh)
+        with _check_cache_lock:
+            due.update(
+                name for name in CHECKS
+                if name not in _check_cache
+                or now - _check_cache[name]['produced_at'] >= _check_ttl(name, default_refresh)
+            )
+    timings = {}
+    fresh = run_checks([name for name in CHECKS if name in due], timings)
+    log_timings(timings)
+    data = {'os': platform.system()}
+    with _check_cache_lock:
+        for name, result in fresh.items():
+            cached = _check_cache.get(name)
+            if (_is_failed(result) and cached is not None and not _is_failed(cached['result'])
+                    and now - cached['produced_at'] < _check_ttl(name, default_refresh)):
+                # Keep serving the last good result, but respect the refresh schedule
+                cached['fetched_at'] = now
+            else:
+                _check_cache[name] = {'result': result, 'fetched_at': now, 'produced_at': now}
+        for name in CHECKS:
+            data[name] = _check_cache[name]['result']
+    # Only the checks run this cycle; neither is part of the content hash
+    data['timings'] = timings
+    data['collected_at'] = datetime.utcnow().isoformat()
+    return data
+
+def _is_failed(result):
+    """True when a check produced no verdict (error, timeout or unsupported)."""
+    return result.get('timed_out') or all(
+        value is None for key, value in result.items() if key not in ('details', 'status'))
+
+def normalize_section(result):
+    """Check result without volatile text, as compared between reports."""
+    return {key: value for key, value in result.items() if key not in VOLATILE_KEYS}
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+def content_hash(data):
+    """Hash of the normalized check results; equal hashes mean nothing to report."""
+    return _digest({
+        'os': data.get('os'),
+        'checks': {name: normalize_section(data[name]) for name in CHECKS},
+    })
+
+class ReportSpool:
+    """Append-only on-disk queue of full reports waiting for the server.
+
+    Backed by SQLite, so queued reports survive crashes and restarts. The
+    database is only created once something is queued.
+    """
+
+    def __init__(self, path, max_reports=SPOOL_MAX_REPORTS):
+        self.path = path
+        self.max_reports = max_reports
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self, create=True):
+        if self._conn is None:
+            if not create and not os.path.exists(self.path):
+                return None
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS spool (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    content_hash TEXT,
+                    payload TEXT NOT NULL,
+                    queued_at REAL NOT NULL
+                )
+            ''')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def append(self, payload):
+        with self._lock:
+            conn = self._db()
+            with conn:
+                conn.execute('INSERT INTO spool (content_hash, payload, queued_at) VALUES (?, ?, ?)',
+                             (payload.get('content_hash'), json.dumps(payload), time.time()))
+                conn.execute('DELETE FROM spool WHERE id <= (SELECT MAX(id) FROM spool) - ?', (self.max_reports,))
+
+    def peek(self, limit):
+        """Oldest queued reports as [(id, payload)]."""
+        with self._lock:
+            conn = self._db(create=False)
+            if conn is None:
+                return []
+            rows = conn.execute('SELECT id, payload FROM spool ORDER BY id LIMIT ?', (limit,)).fetchall()
+        return [(row_id, json.loads(payload)) for row_id, payload in rows]
+
+    def remove(self, ids):
+        with self._lock:
+            conn = self._db()
+            with conn:
+                conn.executemany('DELETE FROM spool WHERE id = ?', [(i,) for i in ids])
+
+    def last_hash(self):
+        with self._lock:
+            conn = self._db(create=False)
+            row = conn and conn.execute('SELECT content_hash FROM spool ORDER BY id DESC LIMIT 1').fetchone()
+        return row[0] if row else None
+
+    def __len__(self):
+        with self._lock:
+            conn = self._db(create=False)
+            return conn.execute('SELECT COUNT(*) FROM spool').fetchone()[0] if conn else 0
+
+spool = ReportSpool(os.path.join(STATE_DIR, SPOOL_FILE))
+
+# Consecutive delivery failures and when (monotonic) to try the spool again
+_retry = {'failures': 0, 'next_attempt': 0.0, 'retry_after': None}
+# Monotonic time the server asked for the next report, once it has said
+_schedule = {'next_report': None}
+_session = None
+_machine_id = None
+
+def load_machine_id():
+    # Persist machine_id in a file for consistent reporting; read it only once
+    global _machine_id
+    if _machine_id is None and os.path.exists(MACHINE_ID_FILE):
+        with open(MACHINE_ID_FILE, 'r') as f:
+            _machine_id = f.read().strip() or None
+    return _machine_id
+
+def save_machine_id(machine_id):
+    global _machine_id
+    with open(MACHINE_ID_FILE, 'w') as f:
+        f.write(machine_id)
+    _machine_id = machine_id
+
+def _acknowledge(data, digest):
+    _acked['content_hash'] = digest
+    _acked['sections'] = {name: _digest(normalize_section(data[name])) for name in CHECKS}
+
+def http_session():
+    """Shared requests.Session, so reports reuse one keep-alive connection."""
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+    return _session
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delay or HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def post_json(path, payload):
+    """POST to the API. Returns (status, body) and records the server's scheduling hints."""
+    resp = http_session().post(API_URL + path, json=payload, timeout=HTTP_TIMEOUT)
+    try:
+        body = resp.json()
+    except ValueError:
+        body = None
+    if resp.status_code in (429, 503):
+        _retry['retry_after'] = parse_retry_after(resp.headers.get('Retry-After'))
+    elif resp.status_code == 200 and isinstance(body, dict) and isinstance(body.get('next_report_in'), (int, float)):
+        jitter = random.uniform(-REPORT_JITTER_SECONDS, REPORT_JITTER_SECONDS)
+        _schedule['next_report'] = time.monotonic() + max(body['next_report_in'] + jitter, 0)
+    return resp.status_code, body
+
+def full_payload(data, digest):
+    payload = dict(data)
+    payload['content_hash'] = digest
+    machine_id = load_machine_id()
+    if machine_id:
+        payload['machine_id'] = machine_id
+    return payload
 
 def send_data_to_api(data):
-    import requests
-    import os
-    # Persist machine_id in a file for consistent reporting
-    machine_id_file = 'machine_id.txt'
-    if os.path.exists(machine_id_file):
-        with open(machine_id_file, 'r') as f:
-            machine_id = f.read().strip()
-        data['machine_id'] = machine_id
-    response = None
+    """Send a full report. Returns True once the server has stored it."""
+    digest = content_hash(data)
+    payload = full_payload(data, digest)
+    machine_id = payload.get('machine_id')
     try:
-        # Change the URL below to your backend server (Flask or FastAPI)
-        url = 'http://localhost:8000/report'
-        resp = requests.post(url, json=data, timeout=10)
-        if resp.status_code == 200:
-            result = resp.json()
+        status, result = post_json('/report', payload)
+        if status == 200:
             print('Data sent:', result)
             # Save machine_id if new
-            if 'machine_id' in result:
-                with open(machine_id_file, 'w') as f:
-                    f.write(result['machine_id'])
-        else:
-            print('Failed to send data:', resp.status_code, resp.text)
+            if 'machine_id' in result and result['machine_id'] != machine_id:
+                save_machine_id(result['machine_id'])
+            _acknowledge(data, digest)
+            return True
+        print('Failed to send data:', status, result)
     except Exception as e:
         print('Error sending data:', e)
+    return False
+
+def send_heartbeat(machine_id, digest, timings=None):
+    """Returns 'unchanged', 'resync' or None when the server was unreachable."""
+    payload = {'machine_id': machine_id, 'content_hash': digest}
+    if timings:
+        payload['timings'] = timings
+    try:
+        status, result = post_json('/report/heartbeat', payload)
+    except Exception as e:
+        print('Error sending heartbeat:', e)
+        return None
+    if status == 200:
+        return 'unchanged'
+    return 'resync' if status == 409 else None
+
+def send_delta(machine_id, data, digest):
+    """Send only the check sections that changed since the last acknowledged report.
+
+    Returns 'ok', 'resync' or None when the server was unreachable.
+    """
+    sections = {
+        name: data[name] for name in CHECKS
+        if _digest(normalize_section(data[name])) != _acked['sections'].get(name)
+    }
+    payload = {
+        'machine_id': machine_id,
+        'os': data.get('os'),
+        'base_hash': _acked['content_hash'],
+        'content_hash': digest,
+        'sections': sections,
+    }
+    if data.get('timings'):
+        payload['timings'] = data['timings']
+    try:
+        status, result = post_json('/report/delta', payload)
+    except Exception as e:
+        print('Error sending delta:', e)
+        return None
+    if status == 200:
+        print('Delta sent:', sorted(sections), result)
+        return 'ok'
+    return 'resync' if status == 409 else None
+
+def _schedule_retry():
+    _retry['failures'] += 1
+    delay = min(RETRY_BASE_SECONDS * 2 ** (_retry['failures'] - 1), RETRY_MAX_SECONDS)
+    retry_after, _retry['retry_after'] = _retry['retry_after'], None
+    if retry_after is not None:
+        # The server said when to come back; spread the retries just after that
+        _retry['next_attempt'] = time.monotonic() + retry_after + random.uniform(0, REPORT_JITTER_SECONDS)
+        return
+    # Jitter keeps a fleet that lost the server at once from reconnecting in lockstep
+    _retry['next_attempt'] = time.monotonic() + random.uniform(delay / 2, delay)
+
+def seconds_until_report():
+    """Time until the report slot the server assigned, or None if it has not assigned one."""
+    if _schedule['next_report'] is None:
+        return None
+    return max(_schedule['next_report'] - time.monotonic(), 0)
+
+def seconds_until_retry():
+    """Time until queued reports are due to be retried, or None if nothing is queued."""
+    if not len(spool):
+        return None
+    return max(_retry['next_attempt'] - time.monotonic(), 0)
+
+def spool_report(data, digest):
+    """Queue a full report on disk until the server is reachable again."""
+    if spool.last_hash() == digest:
+        return
+    if not load_machine_id():
+        # Queued reports must all carry the same id, before the server assigned one
+        save_machine_id(str(uuid.uuid4()))
+    spool.append(full_payload(data, digest))
+    print(f'Server unreachable; report queued ({len(spool)} waiting)')
+
+def _post_queued(entries):
+    """POST spooled (row_id, payload) entries as one batch.
+
+    Returns 'sent', 'rejected' (a 4xx retrying cannot fix) or None when
+    the server was unreachable or asked to be retried later.
+    """
+    try:
+        status, result = post_json('/report/batch', {'reports': [payload for _, payload in entries]})
+    except Exception as e:
+        print('Error sending queued reports:', e)
+        return None
+    if status == 200:
+        spool.remove([row_id for row_id, _ in entries])
+        last = entries[-1][1]
+        _acknowledge(last, last['content_hash'])
+        print(f'Sent {len(entries)} queued reports')
+        return 'sent'
+    if 400 <= status < 500 and status not in (408, 429):
+        print('Queued reports rejected by the server:', status, result)
+        return 'rejected'
+    print('Failed to send queued reports:', status, result)
+    return None
+
+def _resend_singly(entries):
+    """Resend a rejected batch one report at a time, dropping only the reports the server rejects.
+
+    Returns None if the server became unreachable part way through.
+    """
+    for row_id, payload in entries:
+        outcome = _post_queued([(row_id, payload)])
+        if outcome is None:
+            return None
+        if outcome == 'rejected':
+            print('Dropping a queued report rejected by the server')
+            spool.remove([row_id])
+    return 'sent'
+
+def drain_spool():
+    """Send queued reports to /report/batch, oldest first.
+
+    Returns True once the spool is empty; on failure the next attempt is
+    pushed back with exponential backoff.
+    """
+    while True:
+        entries = spool.peek(SPOOL_BATCH_SIZE)
+        if not entries:
+            _retry['failures'] = 0
+            return True
+        outcome = _post_queued(entries)
+        if outcome == 'rejected' and len(entries) == 1:
+            print('Dropping a queued report rejected by the server')
+            spool.remove([entries[0][0]])
+        elif outcome == 'rejected':
+            # Retrying cannot fix it, but one bad report must not take the others with it
+            outcome = _resend_singly(entries)
+        if outcome is None:
+            _schedule_retry()
+            return False
+
+def report_data(data):
+    """Report collected data using the smallest message the server accepts.
+
+    Unchanged results (including the first cycle after a restart) are sent as
+    a heartbeat, changed ones as a delta of the changed sections. When the
+    server asks for a resync, a full report is sent instead. Reports that
+    cannot be delivered are spooled to disk and drained in order, as a
+    batch, once the retry backoff allows.
+    """
+    digest = content_hash(data)
+    # This report uses up the assigned slot; a successful answer assigns the next
+    _schedule['next_report'] = None
+    if len(spool):
+        # Keep reports in order behind the ones already waiting
+        spool_report(data, digest)
+        if seconds_until_retry() > 0:
+            return False
+        return drain_spool()
+    machine_id = load_machine_id()
+    if machine_id:
+        if _acked['content_hash'] in (None, digest):
+            outcome = send_heartbeat(machine_id, digest, data.get('timings'))
+            if outcome == 'unchanged':
+                _acknowledge(data, digest)
+                return True
+        else:
+            outcome = send_delta(machine_id, data, digest)
+            if outcome == 'ok':
+                _acknowledge(data, digest)
+                return True
+        if outcome is None:
+            if digest != _acked['content_hash']:
+                spool_report(data, digest)
+                _schedule_retry()
+            elif _retry['retry_after'] is not None:
+                # Nothing to queue; check in again once the server has capacity
+                _schedule['next_report'] = (time.monotonic() + _retry['retry_after']
+                                            + random.uniform(0, REPORT_JITTER_SECONDS))
+                _retry['retry_after'] = None
+            return False
+    if send_data_to_api(data):
+        return True
+    spool_report(data, digest)
+    _schedule_retry()
+    return False
 
 def daemon_loop(interval_minutes=30):
-    last_data = None
+    # Wake up at the report slot the server assigned, or whenever the next
+    # check is due until it has; only stale checks are re-run
+    default_refresh = interval_minutes * 60
+    time.sleep(random.uniform(0, STARTUP_JITTER_SECONDS))
+    while True:
+        data = collect_system_data(default_refresh=default_refresh)
+        report_data(data)
+        wait = seconds_until_report()
+        if wait is None:
+            wait = seconds_until_next_check(default_refresh)
+        retry = seconds_until_retry()
+        if retry is not None:
+            wait = min(wait, retry)
+        time.sleep(max(wait, 1))
+
+def watch_loop(interval_minutes=30):
+    """Re-run checks when the files behind them change (inotify, Linux only).
+
+    Unchanged data is still reported (as a heartbeat) every interval, or at
+    the slot the server assigned, so the machine stays visible; checks
+    without watchable files keep polling.
+    Falls back to daemon_loop when inotify is unavailable.
+    """
+    try:
+        import linux_watcher
+        watcher = linux_watcher.InotifyWatcher(
+            linux_watcher.watch_spec(), WATCH_DEBOUNCE_SECONDS, WATCH_MAX_DELAY_SECONDS)
+    except (ImportError, OSError, AttributeError) as e:
+        print(f"Watch mode unavailable ({e}); polling instead.")
+        return daemon_loop(interval_minutes)
+    _watched_checks.update(watcher.watched)
+    print(f"Watching files for: {', '.join(sorted(watcher.watched)) or 'nothing'}")
+    default_refresh = interval_minutes * 60
+    time.sleep(random.uniform(0, STARTUP_JITTER_SECONDS))
+    affected = None
     while True:
-        data = collect_system_data()
-        if data != last_data:
-            send_data_to_api(data)
-            last_data = data
-        time.sleep(interval_minutes * 60)
-
-def start_daemon():
-    t = threading.Thread(target=daemon_loop, daemon=True)
+        data = collect_system_data(refresh=affected, default_refresh=default_refresh)
+        report_data(data)
+        delay = seconds_until_report()
+        # Once the server assigns report slots, polled checks wait for the slot too
+        scheduled = delay is not None
+        next_report = time.monotonic() + (delay if scheduled else default_refresh)
+        affected = None
+        while affected is None:
+            timeout = next_report - time.monotonic()
+            if not scheduled:
+                timeout = min(timeout, seconds_until_next_check(default_refresh))
+            retry = seconds_until_retry()
+            if retry is not None:
+                timeout = min(timeout, retry)
+            changed = watcher.wait(max(timeout, 1))
+            if changed:
+                affected = changed
+            elif (time.monotonic() >= next_report or seconds_until_retry() == 0
+                  or (not scheduled and seconds_until_next_check(default_refresh) <= 0)):
+                affected = stale_checks(default_refresh)
+
+def start_daemon(watch=False):
+    t = threading.Thread(target=watch_loop if watch else daemon_loop, daemon=True)
     t.start()
 
 if __name__ == "__main__":
     print("System Utility Daemon starting...")
     if platform.system() == 'Windows' and not is_admin():
         print("WARNING: For full functionality (e.g., BitLocker check), run this script as Administrator.")
-    start_daemon()
+    start_daemon(watch='--watch' in sys.argv[1:])
     while True:
         time.sleep(3600)  # Keep main thread alive
@@ -0,0 +1,250 @@
+"""
+In-process metrics for the backends, rendered in the Prometheus text format.
+
+Both servers register their request timings here and expose render() at
+/metrics; storage.py records SQLite query/commit timings, ingest queue depth
+and export durations. No client library is needed.
+
+Opt-in sampling profiler for hot paths (see profiled()):
+    SOLSPHERE_PROFILE=cprofile    cumulative cProfile stats per function,
+                                  written to SOLSPHERE_PROFILE_DIR as .pstats
+    SOLSPHERE_PROFILE=tracemalloc peak memory allocated per sampled call,
+                                  exported as profile_peak_memory_bytes
+    SOLSPHERE_PROFILE_RATE        fraction of calls sampled (default 0.01)
+"""
+import functools
+import os
+import random
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+BYTE_BUCKETS = (1024, 16 * 1024, 256 * 1024, 1024 ** 2, 16 * 1024 ** 2, 256 * 1024 ** 2)
+
+PROFILE_MODE = os.environ.get('SOLSPHERE_PROFILE', '').lower()
+PROFILE_RATE = float(os.environ.get('SOLSPHERE_PROFILE_RATE', '0.01'))
+PROFILE_DIR = os.environ.get('SOLSPHERE_PROFILE_DIR', '.')
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+        register(self)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, *label_values):
+        """Context manager observing the duration of its block."""
+        return _Timer(self, label_values)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        for label_values, values in sorted(series.items()):
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{self.name}_bucket{_labels_text(self.labels, label_values, [("le", _number(bound))])} {count}')
+            lines.append(f'{self.name}_bucket{_labels_text(self.labels, label_values, [("le", "+Inf")])} {values[-1]}')
+            lines.append(f'{self.name}_sum{_labels_text(self.labels, label_values)} {_number(values[-2])}')
+            lines.append(f'{self.name}_count{_labels_text(self.labels, label_values)} {values[-1]}')
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        register(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            lines.append(f'{self.name}{_labels_text(self.labels, label_values)} {_number(value)}')
+        return lines
+
+class Gauge:
+    """Gauge read from callbacks at render time, e.g. a queue's depth."""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._callbacks = []
+        register(self)
+
+    def set_function(self, func):
+        self._callbacks.append(func)
+
+    def render(self):
+        value = sum(func() for func in self._callbacks)
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {_number(value)}']
+
+def register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+
+def render():
+    """All registered metrics in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Time to produce a response, per route.', ('method', 'route', 'status'))
+SQLITE_QUERY_SECONDS = Histogram(
+    'sqlite_query_duration_seconds', 'Duration of SQLite read operations.', ('operation',))
+SQLITE_COMMIT_SECONDS = Histogram(
+    'sqlite_commit_duration_seconds', 'Duration of group-commit write transactions.')
+SQLITE_COMMIT_ROWS = Histogram(
+    'sqlite_commit_rows', 'Reports and heartbeats written per transaction.', buckets=SIZE_BUCKETS)
+INGEST_QUEUE_DEPTH = Gauge('ingest_queue_depth', 'Reports and heartbeats waiting for the group-commit writer.')
+EXPORT_SECONDS = Histogram(
+    'export_duration_seconds', 'Time to stream a complete export.', ('format',))
+EXPORT_BYTES = Histogram(
+    'export_size_bytes', 'Size of a complete export as sent.', ('format',), buckets=BYTE_BUCKETS)
+INGEST_REJECTED = Counter(
+    'ingest_rejected_total', 'Write requests refused with 503 by ingest backpressure.', ('reason',))
+COLLECTOR_CHECK_SECONDS = Histogram(
+    'collector_check_duration_seconds', 'Check durations reported by collectors.', ('check',))
+PROFILE_PEAK_MEMORY = Histogram(
+    'profile_peak_memory_bytes', 'Peak memory allocated by sampled calls (tracemalloc).', ('function',),
+    buckets=BYTE_BUCKETS)
+
+def timed(histogram, *label_values):
+    """Decorator observing the duration of each call in `histogram`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(*label_values):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timed_stream(chunks, fmt):
+    """Pass an export's chunks through, recording its total duration and size."""
+    start = time.perf_counter()
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        EXPORT_SECONDS.observe(time.perf_counter() - start, fmt)
+        EXPORT_BYTES.observe(size, fmt)
+
+# --- Sampling profiler -----------------------------------------------------
+
+_profile_lock = threading.Lock()
+_profile_stats = {}
+
+def _sample_cprofile(name, func, args, kwargs):
+    import cProfile
+    import pstats
+    # Only one profiler can be active at a time
+    if not _profile_lock.acquire(blocking=False):
+        return func(*args, **kwargs)
+    try:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            stats = _profile_stats.get(name)
+            if stats is None:
+                stats = _profile_stats[name] = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+            stats.dump_stats(os.path.join(PROFILE_DIR, f'profile-{name}.pstats'))
+    finally:
+        _profile_lock.release()
+
+def _sample_tracemalloc(name, func, args, kwargs):
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if not _profile_lock.acquire(blocking=False):
+        return func(*args, **kwargs)
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # Includes allocations by other threads during the call
+            PROFILE_PEAK_MEMORY.observe(max(tracemalloc.get_traced_memory()[1] - before, 0), name)
+    finally:
+        _profile_lock.release()
+
+def profiled(name):
+    """Sample a fraction of calls under the profiler chosen by SOLSPHERE_PROFILE.
+
+    A no-op wrapper unless profiling is enabled.
+    """
+    sampler = {'cprofile': _sample_cprofile, 'tracemalloc': _sample_tracemalloc}.get(PROFILE_MODE)
+
+    def decorator(func):
+        if sampler is None:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if random.random() >= PROFILE_RATE:
+                return func(*args, **kwargs)
+            return sampler(name, func, args, kwargs)
+        return wrapper
+    return decorator
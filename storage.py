@@ -0,0 +1,1591 @@
+"""
+Shared SQLite storage for the backend servers.
+
+Schema and migrations, the group-commit writer, filters and keyset
+pagination, the change feed, history and counters, exports and the response
+cache live here, so flask_backend_sqlite.py and backend.py (FastAPI) serve
+the same data the same way. The Flask app uses the thread-based API
+directly; AsyncStorage wraps it for asyncio servers.
+"""
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import asyncio
+import base64
+import csv
+import functools
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+DB_PATH = 'machines.db'
+# JSON snapshot of the fleet kept for file-based consumers (set
+# SOLSPHERE_SNAPSHOT_PATH to move it, or to an empty value to turn it off)
+# and the minimum seconds between two background rewrites of it
+SNAPSHOT_PATH = os.environ.get('SOLSPHERE_SNAPSHOT_PATH', 'machines_data.json')
+SNAPSHOT_MIN_INTERVAL = 10
+# Write-behind queue: max reports per transaction and how long (seconds) a
+# report may wait for others to share its commit
+WRITE_FLUSH_SIZE = 500
+WRITE_FLUSH_LATENCY = 0.02
+# Seconds a request waits for its reports to be committed, and seconds the
+# writer thread pauses before reopening the database after a failure
+WRITE_WAIT_TIMEOUT = 30
+WRITER_RESTART_DELAY = 1
+# Max reports accepted by one /report/batch request
+MAX_BATCH_REPORTS = 5000
+# Ingest backpressure: write requests get 503 with Retry-After (seconds) while
+# INGEST_MAX_QUEUE_DEPTH reports and heartbeats are queued or they took INGEST_MAX_LATENCY
+# seconds on average over the last INGEST_LATENCY_WINDOW seconds
+INGEST_MAX_QUEUE_DEPTH = 2000
+INGEST_MAX_LATENCY = 2.0
+INGEST_LATENCY_WINDOW = 10
+INGEST_RETRY_AFTER = 30
+# Agents are told to report once per REPORT_INTERVAL seconds, each machine at
+# its own offset within the interval
+REPORT_INTERVAL = 30 * 60
+# Number of pooled read connections
+READ_POOL_SIZE = 8
+# Serialized /machines and /machine/<id> responses kept in memory; entries are
+# reused until the next ingest changes the data version
+RESPONSE_CACHE_SIZE = 256
+
+# Check output texts ('details'/'status') at least BLOB_MIN_LENGTH characters
+# long are moved out of the machine rows into the blobs table, stored once per
+# distinct text and zlib-compressed; rows keep only the text's digest. Most
+# of them are the same command output on thousands of machines.
+BLOB_KEYS = ('details', 'status')
+BLOB_MIN_LENGTH = 64
+# Decompressed blob texts kept in memory for reads
+BLOB_CACHE_SIZE = 4096
+
+# Rows fetched per round trip while streaming exports, and bytes per sent block
+EXPORT_FETCH_SIZE = 500
+EXPORT_BUFFER_SIZE = 64 * 1024
+# Server-Sent Events: seconds between keep-alive comments (each also catches up
+# on changes committed by other worker processes)
+EVENTS_KEEPALIVE_INTERVAL = 15
+# History of state transitions: how long rows are kept, after how many days
+# they are downsampled to the last transition per machine per day, and how
+# often (seconds) the writer runs maintenance (history pruning, blob cleanup)
+HISTORY_RETENTION_DAYS = 365
+HISTORY_DOWNSAMPLE_AFTER_DAYS = 30
+HISTORY_MAINTENANCE_INTERVAL = 3600
+# Longest window and most buckets /history/compliance will compute
+MAX_HISTORY_DAYS = 366
+MAX_HISTORY_BUCKETS = 1000
+# Page size limits for paginated /machines queries
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+REQUIRED_FIELDS = ('os', 'disk_encryption', 'os_update', 'antivirus', 'sleep_settings')
+
+def connect():
+    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+    # WAL lets readers run alongside the writer; NORMAL sync is durable in WAL
+    # mode except for the last commits on power loss
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+# Typed columns derived from the check sections at ingest time, so filters run
+# as indexed WHERE clauses: column -> (section, key in that section)
+FLAG_COLUMNS = {
+    'encrypted': ('disk_encryption', 'encrypted'),
+    'up_to_date': ('os_update', 'up_to_date'),
+    'antivirus_present': ('antivirus', 'antivirus_present'),
+    'sleep_compliant': ('sleep_settings', 'compliant'),
+}
+# issue query parameter -> flag column that fails it (False or unknown)
+ISSUE_COLUMNS = {
+    'unencrypted_disk': 'encrypted',
+    'outdated_os': 'up_to_date',
+    'no_antivirus': 'antivirus_present',
+    'sleep_noncompliant': 'sleep_compliant',
+}
+SECTION_FIELDS = ('disk_encryption', 'os_update', 'antivirus', 'sleep_settings')
+MACHINE_COLUMNS = 'machine_id, timestamp, os, disk_encryption, os_update, antivirus, sleep_settings'
+# Columns computed from a record at ingest, in the order machine_row() emits them
+DERIVED_COLUMNS = ('os_lower',) + tuple(FLAG_COLUMNS) + ('status',)
+# Everything machine_row() writes besides MACHINE_COLUMNS; content_hash is the
+# client's hash of its normalized check results (see main.content_hash)
+STORED_COLUMNS = DERIVED_COLUMNS + ('content_hash',)
+# sort query parameter -> column; every one is indexed together with machine_id
+SORT_COLUMNS = {
+    'timestamp': 'timestamp',
+    'os': 'os_lower',
+    'status': 'status',
+    'machine_id': 'machine_id',
+}
+# Fields that can be returned without decoding any JSON section
+SUMMARY_FIELDS = ('machine_id', 'timestamp', 'os', 'status') + tuple(FLAG_COLUMNS) + ('change_seq',)
+
+def migrate_db(conn):
+    """Add derived columns missing from older databases and backfill them."""
+    c = conn.cursor()
+    existing = {row[1] for row in c.execute('PRAGMA table_info(machines)')}
+    added = []
+    if 'os_lower' not in existing:
+        c.execute('ALTER TABLE machines ADD COLUMN os_lower TEXT')
+        c.execute("UPDATE machines SET os_lower = lower(coalesce(os, ''))")
+    for column, (section, key) in FLAG_COLUMNS.items():
+        if column not in existing:
+            c.execute(f'ALTER TABLE machines ADD COLUMN {column} INTEGER')
+            added.append((column, section, key))
+    for column, section, key in added:
+        c.execute(f"""
+            UPDATE machines SET {column} = CASE json_type({section}, '$.{key}')
+                WHEN 'true' THEN 1 WHEN 'false' THEN 0 END
+        """)
+    if 'status' not in existing:
+        c.execute('ALTER TABLE machines ADD COLUMN status TEXT')
+        flags = list(FLAG_COLUMNS)
+        c.execute(f"""
+            UPDATE machines SET status = CASE
+                WHEN {' OR '.join(f'{f} = 0' for f in flags)} THEN 'critical'
+                WHEN {' OR '.join(f'{f} IS NULL' for f in flags)} THEN 'warning'
+                ELSE 'healthy' END
+        """)
+    if 'content_hash' not in existing:
+        # Left NULL for old rows: their clients' first heartbeat triggers a full resync
+        c.execute('ALTER TABLE machines ADD COLUMN content_hash TEXT')
+    if 'change_seq' not in existing:
+        # Monotonic position in the change feed, bumped on every write
+        c.execute('ALTER TABLE machines ADD COLUMN change_seq INTEGER')
+        c.execute('UPDATE machines SET change_seq = rowid')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_machines_change_seq ON machines(change_seq)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_machines_os_lower ON machines(os_lower, machine_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_machines_status ON machines(status, machine_id)')
+    for column in FLAG_COLUMNS:
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_machines_{column} ON machines({column})')
+
+def init_db():
+    with connect() as conn:
+        c = conn.cursor()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS machines (
+                machine_id TEXT PRIMARY KEY,
+                timestamp TEXT,
+                os TEXT,
+                disk_encryption TEXT,
+                os_update TEXT,
+                antivirus TEXT,
+                sleep_settings TEXT
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_machines_timestamp ON machines(timestamp, machine_id)')
+        migrate_db(conn)
+        history_exists = c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'machine_history'").fetchone()
+        # Append-only log of state transitions: a row is written only when a
+        # machine's derived columns change
+        c.execute(f'''
+            CREATE TABLE IF NOT EXISTS machine_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                machine_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                os_lower TEXT,
+                {' INTEGER, '.join(FLAG_COLUMNS)} INTEGER,
+                status TEXT
+            )
+        ''')
+        if not history_exists:
+            # Seed each known machine's current state as its first transition
+            c.execute(f'''
+                INSERT INTO machine_history (machine_id, timestamp, {', '.join(DERIVED_COLUMNS)})
+                SELECT machine_id, timestamp, {', '.join(DERIVED_COLUMNS)} FROM machines
+            ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_history_machine ON machine_history(machine_id, timestamp)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_history_timestamp ON machine_history(timestamp)')
+        # Fleet summary counters kept current at ingest (see update_counters)
+        stats_exist = c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fleet_stats'").fetchone()
+        c.execute('CREATE TABLE IF NOT EXISTS fleet_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        if not stats_exist:
+            rebuild_counters(conn)
+        blobs_exist = c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'blobs'").fetchone()
+        # Compressed check output shared by machine rows (see extract_blobs)
+        c.execute('CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID')
+        if not blobs_exist:
+            move_blobs(conn)
+        conn.commit()
+
+class ConnectionPool:
+    """Small pool of reusable read connections shared by request threads."""
+
+    def __init__(self, size):
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = connect()
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+read_pool = ConnectionPool(READ_POOL_SIZE)
+
+def flag_value(section, key):
+    """Tri-state check verdict stored as 1/0/NULL."""
+    value = section.get(key) if isinstance(section, dict) else None
+    if value is True:
+        return 1
+    if value is False:
+        return 0
+    return None
+
+def machine_status(flags):
+    """Overall status, matching the dashboard: any failed check is critical,
+    any unknown check is a warning."""
+    if any(flag == 0 for flag in flags):
+        return 'critical'
+    if any(flag is None for flag in flags):
+        return 'warning'
+    return 'healthy'
+
+def blob_digest(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+def extract_blobs(section, blobs):
+    """Section as stored: long BLOB_KEYS texts become digests under '_blobs'.
+
+    The texts are added to `blobs` ({digest: text}).
+    """
+    if not isinstance(section, dict):
+        return section
+    refs = {}
+    for key in BLOB_KEYS:
+        text = section.get(key)
+        if isinstance(text, str) and len(text) >= BLOB_MIN_LENGTH:
+            refs[key] = digest = blob_digest(text)
+            blobs[digest] = text
+    if not refs:
+        return section
+    stored = {key: value for key, value in section.items() if key not in refs}
+    stored['_blobs'] = refs
+    return stored
+
+def store_blobs(conn, blobs):
+    """Insert the {digest: text} blobs not stored yet; only those are compressed."""
+    digests = list(blobs)
+    existing = set()
+    for i in range(0, len(digests), 500):
+        chunk = digests[i:i + 500]
+        existing.update(row[0] for row in conn.execute(
+            f'SELECT digest FROM blobs WHERE digest IN ({",".join("?" * len(chunk))})', chunk))
+    conn.executemany('INSERT OR IGNORE INTO blobs (digest, data) VALUES (?, ?)', [
+        (digest, zlib.compress(text.encode('utf-8')))
+        for digest, text in blobs.items() if digest not in existing
+    ])
+
+def move_blobs(conn):
+    """Move the long texts of rows stored before the blobs table existed into it."""
+    blobs, updates = {}, []
+    for row in conn.execute(f'SELECT machine_id, {", ".join(SECTION_FIELDS)} FROM machines').fetchall():
+        sections = [json.dumps(extract_blobs(json.loads(value), blobs)) if value else value for value in row[1:]]
+        updates.append(sections + [row[0]])
+    store_blobs(conn, blobs)
+    conn.executemany(
+        f'UPDATE machines SET {", ".join(f"{field} = ?" for field in SECTION_FIELDS)} WHERE machine_id = ?',
+        updates)
+
+def prune_blobs(conn):
+    """Delete blobs no machine row refers to any more."""
+    referenced = ' UNION '.join(
+        f"SELECT value FROM machines, json_each(machines.{field}, '$._blobs')" for field in SECTION_FIELDS)
+    conn.execute(f'DELETE FROM blobs WHERE digest NOT IN ({referenced})')
+
+def machine_row(record):
+    """Row tuple written by commit_batch.
+
+    The last element is not a column: it holds the {digest: text} blobs the
+    sections refer to.
+    """
+    flags = tuple(flag_value(record[section], key) for section, key in FLAG_COLUMNS.values())
+    blobs = {}
+    sections = tuple(json.dumps(extract_blobs(record[field], blobs)) for field in SECTION_FIELDS)
+    return (
+        record['machine_id'],
+        record['timestamp'],
+        record['os'],
+    ) + sections + ((record['os'] or '').lower(),) + flags + (
+        machine_status(flags), record.get('content_hash'), blobs)
+
+class StaleReport(Exception):
+    """A heartbeat or delta was based on a report that has since been replaced; servers answer 409 resync."""
+
+class WriteTicket:
+    def __init__(self, rows, touches=(), bases=None):
+        self.rows = rows
+        # content_hash each row requires the stored row to still have (None: unconditional)
+        self.bases = list(bases) if bases is not None else [None] * len(rows)
+        # (timestamp, machine_id, content_hash) heartbeats that only bump timestamp
+        self.touches = list(touches)
+        self.size = len(self.rows) + len(self.touches)
+        self.error = None
+        self.submitted = time.monotonic()
+        self._done = threading.Event()
+
+    def resolve(self, error=None):
+        self.error = error
+        write_latency.observe(time.monotonic() - self.submitted)
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout):
+        if not self._done.wait(timeout):
+            raise TimeoutError('Timed out waiting for the report to be stored')
+        if self.error is not None:
+            raise self.error
+
+@metrics.profiled('commit_batch')
+def commit_batch(conn, rows, touches, bases=None):
+    """Write machine_row() tuples and heartbeat touches in one transaction.
+
+    Touches are (timestamp, machine_id, content_hash) heartbeats that only
+    bump the timestamp, and only while the stored content_hash still matches.
+    `bases` (aligned with rows) makes a row conditional the same way: it is
+    written only if the machine's stored content_hash, as left by the rows
+    before it, equals its base. Both checks run under the write lock.
+    Returns (first_seq, last_seq, stale), where stale holds the positions in
+    rows + touches that were skipped.
+    """
+    metrics.SQLITE_COMMIT_ROWS.observe(len(rows) + len(touches))
+    stale = set()
+    touch_offset = len(rows)
+    with metrics.SQLITE_COMMIT_SECONDS.time(), conn:
+        # Take the write lock first so the states read below cannot go
+        # stale before the counters and history are derived from them
+        conn.execute('BEGIN IMMEDIATE')
+        if bases is not None and any(base is not None for base in bases):
+            hashes = stored_hashes(conn, [row[0] for row in rows])
+            applied = []
+            for i, (row, base) in enumerate(zip(rows, bases)):
+                if base is not None and hashes.get(row[0]) != base:
+                    stale.add(i)
+                    continue
+                hashes[row[0]] = row[-2]
+                applied.append(row)
+            rows = applied
+        states = previous_states(conn, [row[0] for row in rows])
+        # Sequence numbers are allocated under the write lock, so they
+        # stay monotonic even with several worker processes
+        first_seq = seq = conn.execute('SELECT COALESCE(MAX(change_seq), 0) FROM machines').fetchone()[0] + 1
+        store_blobs(conn, {digest: text for row in rows for digest, text in row[-1].items()})
+        conn.executemany(f'''
+            INSERT OR REPLACE INTO machines ({MACHINE_COLUMNS}, {', '.join(STORED_COLUMNS)}, change_seq)
+            VALUES ({', '.join('?' * (8 + len(STORED_COLUMNS)))})
+        ''', [row[:-1] + (seq + i,) for i, row in enumerate(rows)])
+        seq += len(rows)
+        record_transitions(conn, rows, states)
+        update_counters(conn, rows, states)
+        for i, (ts, machine_id, digest) in enumerate(touches):
+            c = conn.execute('UPDATE machines SET timestamp = ?, change_seq = ? WHERE machine_id = ? AND content_hash = ?',
+                             (ts, seq, machine_id, digest))
+            if c.rowcount:
+                seq += 1
+            else:
+                stale.add(touch_offset + i)
+    return first_seq, seq - 1, stale
+
+def stored_hashes(conn, machine_ids):
+    """{machine_id: content_hash} currently stored for the given machines."""
+    hashes = {}
+    ids = list(set(machine_ids))
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        hashes.update(conn.execute(
+            f'SELECT machine_id, content_hash FROM machines WHERE machine_id IN ({",".join("?" * len(chunk))})', chunk))
+    return hashes
+
+def after_commit(conn, rows, touches, first_seq, last_seq):
+    """Let the snapshot writer and /events subscribers know about a committed batch."""
+    if snapshot_writer and (rows or touches):
+        snapshot_writer.mark_stale()
+    if last_seq >= first_seq:
+        change_broker.publish()
+
+_last_maintenance = time.monotonic()
+
+def run_maintenance(conn):
+    """Prune history and unreferenced blobs once every HISTORY_MAINTENANCE_INTERVAL; called by the writer."""
+    global _last_maintenance
+    if time.monotonic() - _last_maintenance < HISTORY_MAINTENANCE_INTERVAL:
+        return
+    _last_maintenance = time.monotonic()
+    try:
+        with conn:
+            prune_history(conn, datetime.utcnow())
+            prune_blobs(conn)
+    except Exception as e:
+        logger.error('Storage maintenance failed: %s', e)
+
+class WriteBehindQueue:
+    """Group-commit writer: one thread drains queued reports into SQLite.
+
+    Reports submitted by concurrent requests are written with executemany in
+    a single transaction of up to `flush_size` rows, waiting at most
+    `flush_latency` seconds for a batch to fill. That turns one fsync per
+    report into one fsync per batch.
+    """
+
+    def __init__(self, flush_size, flush_latency):
+        self.flush_size = flush_size
+        self.flush_latency = flush_latency
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        # Rows and touches submitted but not yet committed or failed; a
+        # /report/batch ticket can carry thousands of them
+        self._pending = 0
+
+    def submit(self, records, touches=(), bases=None):
+        ticket = WriteTicket([machine_row(r) for r in records], touches, bases)
+        with self._lock:
+            self._pending += ticket.size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+        self._queue.put(ticket)
+        return ticket
+
+    def depth(self):
+        return self._pending
+
+    def _release(self, tickets):
+        with self._lock:
+            self._pending -= sum(ticket.size for ticket in tickets)
+
+    def _run(self):
+        while True:
+            try:
+                conn = connect()
+            except Exception as e:
+                # Do not leave requests waiting out WRITE_WAIT_TIMEOUT on a writer that cannot write
+                logger.error('Write-behind writer cannot open the database: %s', e)
+                self._fail_pending(e)
+                time.sleep(WRITER_RESTART_DELAY)
+                continue
+            try:
+                self._serve(conn)
+            except Exception as e:
+                logger.exception('Write-behind writer failed, restarting: %s', e)
+                self._fail_pending(e)
+                time.sleep(WRITER_RESTART_DELAY)
+            finally:
+                conn.close()
+
+    def _fail_pending(self, error):
+        while True:
+            try:
+                ticket = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            ticket.resolve(error)
+            self._release([ticket])
+
+    def _serve(self, conn):
+        while True:
+            batch = [self._queue.get()]
+            size = batch[0].size
+            deadline = time.monotonic() + self.flush_latency
+            while size < self.flush_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    ticket = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(ticket)
+                size += ticket.size
+            try:
+                self._flush(conn, batch)
+            except Exception as e:
+                for ticket in batch:
+                    if not ticket.done():
+                        ticket.resolve(e)
+                raise
+            finally:
+                self._release(batch)
+            run_maintenance(conn)
+
+    def _flush(self, conn, batch):
+        rows = [row for ticket in batch for row in ticket.rows]
+        bases = [base for ticket in batch for base in ticket.bases]
+        touches = [touch for ticket in batch for touch in ticket.touches]
+        try:
+            first_seq, last_seq, stale = commit_batch(conn, rows, touches, bases)
+        except Exception as e:
+            if len(batch) > 1:
+                # Commit each request on its own so a bad one only fails itself
+                for ticket in batch:
+                    self._flush(conn, [ticket])
+                return
+            logger.error('Write-behind flush of %d reports failed: %s', len(batch), e)
+            for ticket in batch:
+                ticket.resolve(e)
+            return
+        for ticket, positions in zip(batch, batch_positions(batch, len(rows))):
+            ticket.resolve(StaleReport() if stale & positions else None)
+        after_commit(conn, rows, touches, first_seq, last_seq)
+
+def batch_positions(batch, row_count):
+    """For each queued write, its positions in the rows + touches passed to commit_batch."""
+    positions = []
+    row, touch = 0, row_count
+    for item in batch:
+        rows, touches = (item.rows, item.touches) if isinstance(item, WriteTicket) else item[:2]
+        positions.append(set(range(row, row + len(rows))) | set(range(touch, touch + len(touches))))
+        row += len(rows)
+        touch += len(touches)
+    return positions
+
+write_queue = WriteBehindQueue(WRITE_FLUSH_SIZE, WRITE_FLUSH_LATENCY)
+metrics.INGEST_QUEUE_DEPTH.set_function(write_queue.depth)
+
+class RecentLatency:
+    """Mean of the latencies observed over the last `window` seconds.
+
+    Old samples age out, so after a spike (when writes are refused and none
+    are observed) the mean falls back to zero.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._samples = deque()
+        self._total = 0.0
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._samples and self._samples[0][0] < now - self.window:
+            self._total -= self._samples.popleft()[1]
+
+    def observe(self, seconds):
+        now = time.monotonic()
+        with self._lock:
+            self._samples.append((now, seconds))
+            self._total += seconds
+            self._expire(now)
+
+    def mean(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return self._total / len(self._samples) if self._samples else 0.0
+
+# Time from queueing a write to its commit
+write_latency = RecentLatency(INGEST_LATENCY_WINDOW)
+
+def ingest_retry_after(depth):
+    """Retry-After seconds for a write request, or None while ingest keeps up.
+
+    `depth` is the number of rows and heartbeats queued by the server's writer.
+    """
+    if depth >= INGEST_MAX_QUEUE_DEPTH:
+        reason = 'queue_depth'
+    elif write_latency.mean() >= INGEST_MAX_LATENCY:
+        reason = 'latency'
+    else:
+        return None
+    metrics.INGEST_REJECTED.inc(reason)
+    return INGEST_RETRY_AFTER
+
+def report_schedule(machine_id, now=None):
+    """Server-assigned time of a machine's next report, for report responses.
+
+    Each machine keeps a fixed offset within REPORT_INTERVAL, derived from a
+    hash of its id, so a fleet that booted together still reports evenly
+    spread over the interval. The next slot is at least half an interval away.
+    """
+    now = time.time() if now is None else now
+    offset = int.from_bytes(hashlib.blake2b(machine_id.encode(), digest_size=8).digest(), 'big') % REPORT_INTERVAL
+    slot = offset + math.ceil((now + REPORT_INTERVAL / 2 - offset) / REPORT_INTERVAL) * REPORT_INTERVAL
+    return {
+        'next_report_in': round(slot - now),
+        'next_report_at': datetime.utcfromtimestamp(slot).isoformat(),
+    }
+
+class Subscription:
+    """Wake-up signal for one /events stream; wake-ups coalesce, so a slow client never falls behind."""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def notify(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        """True if changes were committed since the last wait, False on timeout."""
+        woken = self._event.wait(timeout)
+        self._event.clear()
+        return woken
+
+class AsyncSubscription:
+    """Subscription awaited on an asyncio event loop; notify() runs on the writer thread."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._event = asyncio.Event()
+
+    def notify(self):
+        self.loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._event.clear()
+
+class ChangeBroker:
+    """Wakes /events subscribers when ingest commits machine upserts.
+
+    Subscribers only learn that something changed; each re-reads the change
+    feed from its own position, so nothing is lost between wake-ups.
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, subscription=None):
+        subscription = subscription or Subscription()
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.notify()
+
+change_broker = ChangeBroker()
+
+def previous_states(conn, machine_ids):
+    """{machine_id: DERIVED_COLUMNS values} currently stored for the given machines."""
+    states = {}
+    ids = list(set(machine_ids))
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        c = conn.execute(
+            f'SELECT machine_id, {", ".join(DERIVED_COLUMNS)} FROM machines'
+            f' WHERE machine_id IN ({",".join("?" * len(chunk))})', chunk)
+        for row in c:
+            states[row[0]] = tuple(row[1:])
+    return states
+
+def row_state(row):
+    """DERIVED_COLUMNS values of a machine_row() tuple."""
+    return row[7:7 + len(DERIVED_COLUMNS)]
+
+def record_transitions(conn, rows, states):
+    """Append a history row for each machine_row() whose state differs from `states`."""
+    states = dict(states)
+    transitions = []
+    for row in rows:
+        state = row_state(row)
+        if states.get(row[0]) != state:
+            transitions.append((row[0], row[1]) + state)
+            states[row[0]] = state
+    conn.executemany(f'''
+        INSERT INTO machine_history (machine_id, timestamp, {', '.join(DERIVED_COLUMNS)})
+        VALUES ({', '.join('?' * (2 + len(DERIVED_COLUMNS)))})
+    ''', transitions)
+
+def state_counters(state):
+    """fleet_stats names a machine in the given DERIVED_COLUMNS state counts towards."""
+    os_lower, flags, status = state[0], state[1:-1], state[-1]
+    names = ['total', f'os:{os_lower}', f'status:{status}']
+    for issue, column in ISSUE_COLUMNS.items():
+        if flags[list(FLAG_COLUMNS).index(column)] != 1:
+            names.append(f'issue:{issue}')
+    return names
+
+def update_counters(conn, rows, states):
+    """Adjust fleet_stats by diffing each machine's previous and new state."""
+    states = dict(states)
+    deltas = {}
+    for row in rows:
+        old, new = states.get(row[0]), row_state(row)
+        if old == new:
+            continue
+        for name in state_counters(old) if old else ():
+            deltas[name] = deltas.get(name, 0) - 1
+        for name in state_counters(new):
+            deltas[name] = deltas.get(name, 0) + 1
+        states[row[0]] = new
+    conn.executemany('''
+        INSERT INTO fleet_stats (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+    ''', [(name, delta) for name, delta in deltas.items() if delta])
+
+def rebuild_counters(conn):
+    """Recompute fleet_stats from scratch with one pass over the machines table."""
+    counts = {}
+    for row in conn.execute(f'SELECT {", ".join(DERIVED_COLUMNS)} FROM machines'):
+        for name in state_counters(tuple(row)):
+            counts[name] = counts.get(name, 0) + 1
+    conn.execute('DELETE FROM fleet_stats')
+    conn.executemany('INSERT INTO fleet_stats (name, value) VALUES (?, ?)', counts.items())
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS, 'get_fleet_stats')
+def get_fleet_stats():
+    """Fleet summary read from the fleet_stats counters; cost does not grow with the fleet."""
+    with read_pool.connection() as conn:
+        counters = dict(conn.execute('SELECT name, value FROM fleet_stats WHERE value != 0'))
+        last_report = conn.execute('SELECT MAX(timestamp) FROM machines').fetchone()[0]
+    stats = {
+        'total': counters.pop('total', 0),
+        'by_os': {},
+        'issues': {issue: 0 for issue in ISSUE_COLUMNS},
+        'status': {'healthy': 0, 'warning': 0, 'critical': 0},
+        'last_report': last_report,
+    }
+    for name, value in counters.items():
+        kind, _, key = name.partition(':')
+        stats['by_os' if kind == 'os' else 'issues' if kind == 'issue' else 'status'][key] = value
+    return stats
+
+def prune_history(conn, now):
+    """Apply history retention and downsampling.
+
+    Rows past HISTORY_RETENTION_DAYS are dropped, except each machine's last
+    one, which still describes its state at the cutoff. Rows past
+    HISTORY_DOWNSAMPLE_AFTER_DAYS are reduced to the last transition per
+    machine per day.
+    """
+    cutoff = (now - timedelta(days=HISTORY_RETENTION_DAYS)).isoformat()
+    conn.execute('''
+        DELETE FROM machine_history WHERE timestamp < ? AND id NOT IN (
+            SELECT MAX(id) FROM machine_history WHERE timestamp < ? GROUP BY machine_id)
+    ''', (cutoff, cutoff))
+    cutoff = (now - timedelta(days=HISTORY_DOWNSAMPLE_AFTER_DAYS)).isoformat()
+    conn.execute('''
+        DELETE FROM machine_history WHERE timestamp < ? AND id NOT IN (
+            SELECT MAX(id) FROM machine_history WHERE timestamp < ?
+            GROUP BY machine_id, substr(timestamp, 1, 10))
+    ''', (cutoff, cutoff))
+
+def save_machines(records, base_hashes=None):
+    """Queue records for the next group commit and wait until it is durable.
+
+    With base_hashes, each record is written only if the stored content_hash
+    still equals its base; otherwise StaleReport is raised.
+    """
+    write_queue.submit(records, bases=base_hashes).wait(WRITE_WAIT_TIMEOUT)
+
+def save_machine(record, base_hash=None):
+    save_machines([record], None if base_hash is None else [base_hash])
+
+def touch_machine(machine_id, content_hash, timestamp):
+    """Record a heartbeat: bump last-seen without rewriting the row.
+
+    Raises StaleReport if the stored report no longer has content_hash.
+    """
+    write_queue.submit([], [(timestamp, machine_id, content_hash)]).wait(WRITE_WAIT_TIMEOUT)
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS, 'get_content_hash')
+def get_content_hash(machine_id):
+    """(exists, content_hash) for a machine, without decoding its sections."""
+    with read_pool.connection() as conn:
+        row = conn.execute('SELECT content_hash FROM machines WHERE machine_id = ?', (machine_id,)).fetchone()
+    return (row is not None), (row[0] if row else None)
+
+class BlobCache:
+    """LRU of decompressed blob texts, loaded from the blobs table on a miss.
+
+    Blobs are immutable (keyed by their content), so entries never go stale.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, conn, digest):
+        with self._lock:
+            if digest in self._entries:
+                self._entries.move_to_end(digest)
+                return self._entries[digest]
+        row = conn.execute('SELECT data FROM blobs WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            return None
+        text = zlib.decompress(row[0]).decode('utf-8')
+        with self._lock:
+            self._entries[digest] = text
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return text
+
+blob_cache = BlobCache(BLOB_CACHE_SIZE)
+
+def load_section(conn, value):
+    """Decode a stored section, restoring the texts moved to the blobs table."""
+    section = json.loads(value)
+    refs = section.pop('_blobs', None) if isinstance(section, dict) else None
+    for key, digest in (refs or {}).items():
+        section[key] = blob_cache.get(conn, digest)
+    return section
+
+def row_to_machine(row, conn):
+    machine = {'machine_id': row[0], 'timestamp': row[1], 'os': row[2]}
+    for field, value in zip(SECTION_FIELDS, row[3:7]):
+        machine[field] = load_section(conn, value)
+    return machine
+
+def filter_clauses(os_filter=None, issue=None, status=None, search=None):
+    """WHERE clauses and params for the /machines filters, using indexed columns."""
+    clauses, params = [], []
+    if os_filter:
+        clauses.append('os_lower = ?')
+        params.append(os_filter.lower())
+    column = ISSUE_COLUMNS.get(issue)
+    if column:
+        # A check counts as an issue when it failed or its result is unknown
+        clauses.append(f'({column} = 0 OR {column} IS NULL)')
+    if status:
+        clauses.append('status = ?')
+        params.append(status)
+    if search:
+        escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        clauses.append("machine_id LIKE ? ESCAPE '\\'")
+        params.append(f'%{escaped}%')
+    return clauses, params
+
+def where_sql(clauses):
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS, 'get_all_machines')
+def get_all_machines(os_filter=None, issue=None):
+    clauses, params = filter_clauses(os_filter, issue)
+    with read_pool.connection() as conn:
+        c = conn.cursor()
+        c.execute(f'SELECT {MACHINE_COLUMNS} FROM machines{where_sql(clauses)}', params)
+        return [row_to_machine(row, conn) for row in c.fetchall()]
+
+def encode_cursor(sort_value, machine_id):
+    raw = json.dumps([sort_value, machine_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort_value, machine_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    return sort_value, machine_id
+
+def project_row(fields, row, conn):
+    """Build a response dict from selected columns, decoding only JSON sections."""
+    machine = {}
+    for field, value in zip(fields, row):
+        if field in SECTION_FIELDS:
+            machine[field] = load_section(conn, value)
+        elif field in FLAG_COLUMNS:
+            machine[field] = None if value is None else bool(value)
+        else:
+            machine[field] = value
+    return machine
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS, 'changed_machines')
+def changed_machines(conn, since, until=None, limit=None):
+    """Summary rows whose change_seq is in (since, until], in feed order."""
+    clauses, params = ['change_seq > ?'], [since]
+    if until is not None:
+        clauses.append('change_seq <= ?')
+        params.append(until)
+    sql = f'SELECT {", ".join(SUMMARY_FIELDS)} FROM machines{where_sql(clauses)} ORDER BY change_seq'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return [project_row(SUMMARY_FIELDS, row, conn) for row in conn.execute(sql, params)]
+
+def current_change_seq(conn):
+    return conn.execute('SELECT COALESCE(MAX(change_seq), 0) FROM machines').fetchone()[0]
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS, 'query_machines')
+def query_machines(os_filter=None, issue=None, status=None, search=None, sort='timestamp',
+                   order='desc', cursor=None, limit=DEFAULT_PAGE_SIZE, fields=None):
+    """One keyset-paginated page of machines.
+
+    Rows are ordered by (sort column, machine_id) so the cursor of the last
+    row is a stable position. Returns (machines, next_cursor, total,
+    change_cursor), where next_cursor is None on the last page, total counts
+    all matches and change_cursor is the change feed position the page
+    reflects (pass it as `since` to follow updates).
+    limit=None returns every match.
+    """
+    sort_column = SORT_COLUMNS[sort]
+    fields = list(fields or MACHINE_COLUMNS.split(', '))
+    if 'machine_id' not in fields:
+        fields.insert(0, 'machine_id')
+    select = list(fields)
+    if sort_column not in select:
+        select.append(sort_column)
+    clauses, params = filter_clauses(os_filter, issue, status, search)
+    with read_pool.connection() as conn:
+        c = conn.cursor()
+        change_cursor = current_change_seq(conn)
+        total = c.execute(f'SELECT COUNT(*) FROM machines{where_sql(clauses)}', params).fetchone()[0]
+        if cursor:
+            sort_value, machine_id = decode_cursor(cursor)
+            op = '<' if order == 'desc' else '>'
+            clauses.append(f'({sort_column}, machine_id) {op} (?, ?)')
+            params += [sort_value, machine_id]
+        direction = 'DESC' if order == 'desc' else 'ASC'
+        sql = (f'SELECT {", ".join(select)} FROM machines{where_sql(clauses)}'
+               f' ORDER BY {sort_column} {direction}, machine_id {direction}')
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit + 1)
+        rows = c.execute(sql, params).fetchall()
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = encode_cursor(last[select.index(sort_column)], last[select.index('machine_id')])
+        machines = [project_row(fields, row, conn) for row in rows]
+    return machines, next_cursor, total, change_cursor
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS, 'get_machine_by_id')
+def get_machine_by_id(machine_id):
+    with read_pool.connection() as conn:
+        c = conn.cursor()
+        c.execute(f'SELECT {MACHINE_COLUMNS} FROM machines WHERE machine_id = ?', (machine_id,))
+        row = c.fetchone()
+        if not row:
+            return None
+        return row_to_machine(row, conn)
+
+def history_row(row):
+    entry = {'timestamp': row[0], 'os': row[1]}
+    for column, value in zip(FLAG_COLUMNS, row[2:2 + len(FLAG_COLUMNS)]):
+        entry[column] = None if value is None else bool(value)
+    entry['status'] = row[-1]
+    return entry
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS, 'get_machine_history')
+def get_machine_history(machine_id, since=None, until=None, limit=None):
+    """State transitions of one machine, oldest first."""
+    clauses, params = ['machine_id = ?'], [machine_id]
+    if since:
+        clauses.append('timestamp >= ?')
+        params.append(since)
+    if until:
+        clauses.append('timestamp < ?')
+        params.append(until)
+    sql = f'SELECT timestamp, {", ".join(DERIVED_COLUMNS)} FROM machine_history{where_sql(clauses)} ORDER BY timestamp'
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    with read_pool.connection() as conn:
+        return [history_row(row) for row in conn.execute(sql, params)]
+
+HISTORY_BUCKETS = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+    'week': timedelta(weeks=1),
+}
+
+def bucket_bounds(now, days, bucket):
+    """(start, end) pairs covering the last `days` days, aligned to the bucket size.
+
+    Raises ValueError when that takes more than MAX_HISTORY_BUCKETS buckets.
+    """
+    step = HISTORY_BUCKETS[bucket]
+    aligned = datetime(now.year, now.month, now.day) if bucket != 'hour' else now.replace(minute=0, second=0, microsecond=0)
+    if bucket == 'week':
+        aligned -= timedelta(days=aligned.weekday())
+    window_start = now - timedelta(days=days)
+    bounds = []
+    start = aligned
+    while start + step > window_start:
+        if len(bounds) == MAX_HISTORY_BUCKETS:
+            raise ValueError(f'{days} days of {bucket} buckets exceeds {MAX_HISTORY_BUCKETS} buckets;'
+                             ' use fewer days or a coarser bucket')
+        bounds.append((start, min(start + step, now)))
+        start -= step
+    return list(reversed(bounds))
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS, 'fleet_compliance')
+def fleet_compliance(days=30, bucket='day', os_filter=None, now=None):
+    """Share of machines passing each check at the end of every time bucket.
+
+    Each machine's last transition before the first bucket end seeds the
+    counts. LAG() turns every later transition into +1 for the new state
+    and -1 for the one it replaces, and a running SUM() over those deltas,
+    interleaved with the bucket ends in time order, gives the counts at
+    each bucket end. The cost follows the transitions in the window rather
+    than machines x buckets.
+    """
+    now = now or datetime.utcnow()
+    bounds = bucket_bounds(now, days, bucket)
+    if not bounds:
+        return []
+    ends = [end.isoformat() for _, end in bounds]
+    clauses, params = [], list(ends)
+    if os_filter:
+        clauses.append('os_lower = ?')
+        params.append(os_filter.lower())
+    params += [ends[0], ends[0], ends[-1]]
+    passing = [f'{column} IS 1' for column in FLAG_COLUMNS] + ["status IS 'healthy'"]
+    deltas = [f'd{i}' for i in range(len(passing))]
+    sql = f'''
+        WITH bucket_ends(t) AS (VALUES {', '.join(['(?)'] * len(bounds))}),
+        tracked AS (SELECT machine_id FROM machines{where_sql(clauses)}),
+        relevant AS (
+            SELECT h.* FROM tracked m
+            JOIN machine_history h ON h.id = (
+                SELECT id FROM machine_history
+                WHERE machine_id = m.machine_id AND timestamp < ?
+                ORDER BY timestamp DESC, id DESC LIMIT 1)
+            UNION ALL
+            SELECT h.* FROM tracked m
+            JOIN machine_history h ON h.machine_id = m.machine_id AND h.timestamp >= ? AND h.timestamp < ?
+        ),
+        feed AS (
+            SELECT t AS timestamp, 0 AS is_change, 0 AS d_machines, {', '.join(f'0 AS {d}' for d in deltas)}
+            FROM bucket_ends
+            UNION ALL
+            SELECT timestamp, 1, LAG(id) OVER w IS NULL,
+                   {', '.join(f'({expr}) - COALESCE(LAG({expr}) OVER w, 0)' for expr in passing)}
+            FROM relevant
+            WINDOW w AS (PARTITION BY machine_id ORDER BY timestamp, id)
+        ),
+        totals AS (
+            SELECT timestamp, is_change, {', '.join(f'SUM({d}) OVER running' for d in ['d_machines'] + deltas)}
+            FROM feed
+            WINDOW running AS (ORDER BY timestamp, is_change ROWS UNBOUNDED PRECEDING)
+        )
+        SELECT * FROM totals WHERE NOT is_change
+    '''
+    with read_pool.connection() as conn:
+        totals = {row[0]: row[2:] for row in conn.execute(sql, params)}
+    series = []
+    for start, end in bounds:
+        counts = totals.get(end.isoformat(), (0,) + (0,) * (len(FLAG_COLUMNS) + 1))
+        machines = counts[0]
+        point = {'start': start.isoformat(), 'end': end.isoformat(), 'machines': machines}
+        for name, count in zip(tuple(FLAG_COLUMNS) + ('healthy',), counts[1:]):
+            point[name] = round(100.0 * (count or 0) / machines, 1) if machines else None
+        series.append(point)
+    return series
+
+class SnapshotWriter:
+    """Debounced background writer for the machines_data.json snapshot.
+
+    Ingest only marks the snapshot stale. A background thread rewrites it at
+    most once every `min_interval` seconds, or as soon as /export/json asks.
+    Changed machines are tracked by change_seq, which also covers other
+    worker processes: a rewrite reads just the rows changed since the last
+    one and merges them into the previous file line by line (both are
+    ordered by machine_id), so the fleet is never held in memory. The first
+    write, or one after another process replaced the file, streams the whole
+    table. The file is swapped in atomically via a temp file + rename.
+    """
+
+    def __init__(self, path, min_interval):
+        self.path = path
+        self.min_interval = min_interval
+        self._seq = None
+        self._written = None
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._urgent = threading.Event()
+        self._thread = None
+
+    def mark_stale(self, urgent=False):
+        """Schedule a rewrite; `urgent` skips the remaining debounce delay."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+                self._thread.start()
+        if urgent:
+            self._urgent.set()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            delay = self._last_write + self.min_interval - time.monotonic()
+            if delay > 0:
+                self._urgent.wait(delay)
+            self._wake.clear()
+            self._urgent.clear()
+            try:
+                self.write()
+            except Exception as e:
+                logger.error('Snapshot write failed: %s', e)
+            self._last_write = time.monotonic()
+
+    def write(self):
+        with self._write_lock:
+            with read_pool.connection() as conn:
+                seq = current_change_seq(conn)
+                changed = None
+                if self._seq is not None and self._written == self._file_id():
+                    c = conn.execute(f'SELECT {MACHINE_COLUMNS} FROM machines WHERE change_seq > ? ORDER BY machine_id',
+                                     (self._seq,))
+                    changed = [(m['machine_id'], json.dumps(m)) for m in (row_to_machine(row, conn) for row in c)]
+            if changed == []:
+                return
+            try:
+                self._replace(self._merged(changed) if changed else None)
+            except ValueError as e:
+                logger.warning('Rewriting the whole snapshot: %s', e)
+                self._replace(None)
+            self._seq = seq
+            self._written = self._file_id()
+
+    def _file_id(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _merged(self, changed):
+        """(machine_id, json) pairs of the previous file with `changed` rows merged in."""
+        decoder = json.JSONDecoder()
+        changed = iter(changed)
+        pending = next(changed, None)
+        previous_id = None
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip().rstrip(',')
+                if line in ('{', '}', '{}'):
+                    continue
+                machine_id, end = decoder.raw_decode(line)
+                value = line[line.index(':', end) + 1:].strip()
+                if not (isinstance(machine_id, str) and value.startswith('{') and value.endswith('}')):
+                    raise ValueError('snapshot is not one machine per line')
+                if previous_id is not None and machine_id <= previous_id:
+                    raise ValueError('snapshot is not ordered by machine_id')
+                previous_id = machine_id
+                while pending is not None and pending[0] < machine_id:
+                    yield pending
+                    pending = next(changed, None)
+                if pending is not None and pending[0] == machine_id:
+                    yield pending
+                    pending = next(changed, None)
+                else:
+                    yield machine_id, value
+        while pending is not None:
+            yield pending
+            pending = next(changed, None)
+
+    def _replace(self, machines):
+        """Write `machines` ((machine_id, json) pairs; None streams the table) to the snapshot."""
+        if machines is None:
+            machines = ((m['machine_id'], json.dumps(m)) for m in iter_machines())
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.machines_data.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in buffered(object_chunks(machines)):
+                    f.write(block)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+snapshot_writer = SnapshotWriter(SNAPSHOT_PATH, SNAPSHOT_MIN_INTERVAL) if SNAPSHOT_PATH else None
+
+class CachedResponse:
+    """A serialized JSON body, its gzipped form and their strong ETags."""
+
+    def __init__(self, version, body):
+        self.version = version
+        self.body = body
+        self.gzip_body = b''.join(gzipped([body]))
+        digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.etag = digest
+        # A different representation needs a different strong validator
+        self.gzip_etag = digest + '-gzip'
+
+class ResponseCache:
+    """LRU of serialized read responses keyed on route and query string.
+
+    Each entry records the data version (MAX(change_seq), bumped by every
+    ingest) it was built at and is only served while that is still current,
+    so a repeated poll costs one index seek instead of a query and a
+    re-serialization. The version comes from the database, so writes made
+    by other worker processes invalidate entries too.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.version != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, version, body):
+        entry = CachedResponse(version, body)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS, 'data_version')
+def data_version():
+    with read_pool.connection() as conn:
+        return current_change_seq(conn)
+
+def observe_timings(data):
+    """Feed the per-check durations a collector reported into the metrics."""
+    timings = data.get('timings')
+    if not isinstance(timings, dict):
+        return
+    for check, entry in timings.items():
+        seconds = entry.get('seconds') if isinstance(entry, dict) else None
+        if check in SECTION_FIELDS and isinstance(seconds, (int, float)):
+            metrics.COLLECTOR_CHECK_SECONDS.observe(seconds, check)
+
+class InvalidReport(ValueError):
+    """An incoming report is malformed; servers answer it with 400."""
+
+def prepare_record(data, now):
+    """Validate one incoming report and stamp it with machine_id/timestamp."""
+    if not isinstance(data, dict):
+        raise InvalidReport('Each report must be a JSON object')
+    missing = [f for f in REQUIRED_FIELDS if f not in data]
+    if missing:
+        raise InvalidReport(f"Missing fields: {', '.join(missing)}")
+    machine_id = data.get('machine_id')
+    if machine_id is not None and not isinstance(machine_id, str):
+        raise InvalidReport('machine_id must be a string')
+    if not isinstance(data['os'], str) or not data['os']:
+        raise InvalidReport('os must be a non-empty string')
+    observe_timings(data)
+    record = data.copy()
+    record['machine_id'] = data.get('machine_id') or str(uuid.uuid4())
+    record['timestamp'] = now
+    return record
+
+def collection_time(data, now):
+    """Timestamp for a queued report: its `collected_at`, clamped to `now` (ISO), else `now`."""
+    try:
+        collected = datetime.fromisoformat(data['collected_at'])
+    except (TypeError, KeyError, ValueError):
+        return now
+    if collected.tzinfo is not None:
+        collected = collected.astimezone(timezone.utc).replace(tzinfo=None)
+    return min(collected, datetime.fromisoformat(now)).isoformat()
+
+def iter_machines(os_filter=None, issue=None):
+    """Yield matching machines one at a time from a dedicated connection.
+
+    Rows are fetched in chunks of EXPORT_FETCH_SIZE, so memory stays flat no
+    matter how large the fleet is. WAL mode keeps the long read from
+    blocking ingest.
+    """
+    clauses, params = filter_clauses(os_filter, issue)
+    conn = connect()
+    try:
+        c = conn.execute(f'SELECT {MACHINE_COLUMNS} FROM machines{where_sql(clauses)} ORDER BY machine_id', params)
+        while True:
+            rows = c.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row_to_machine(row, conn)
+    finally:
+        conn.close()
+
+def csv_chunks(machines):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(('machine_id', 'timestamp', 'os') + SECTION_FIELDS)
+    for m in machines:
+        writer.writerow([m['machine_id'], m['timestamp'], m['os']] + [str(m[f]) for f in SECTION_FIELDS])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+def object_chunks(items):
+    """A JSON object written one (key, serialized value) pair per line."""
+    separator = '{\n'
+    for key, value in items:
+        yield f'{separator}  {json.dumps(key)}: {value}'
+        separator = ',\n'
+    yield '{}' if separator == '{\n' else '\n}\n'
+
+def json_chunks(machines):
+    # Same shape as machines_data.json: an object keyed by machine_id
+    return object_chunks((m['machine_id'], json.dumps(m)) for m in machines)
+
+def ndjson_chunks(machines):
+    for m in machines:
+        yield json.dumps(m) + '\n'
+
+def buffered(chunks, size=EXPORT_BUFFER_SIZE):
+    """Join small text chunks into ~size byte blocks to cut per-write overhead."""
+    parts, length = [], 0
+    for chunk in chunks:
+        parts.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(parts).encode()
+            parts, length = [], 0
+    if parts:
+        yield ''.join(parts).encode()
+
+def gzipped(blocks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+EXPORT_FORMATS = {
+    'json': (json_chunks, 'application/json'),
+    'csv': (csv_chunks, 'text/csv'),
+    'ndjson': (ndjson_chunks, 'application/x-ndjson'),
+}
+
+def merge_delta(record, data, now):
+    """Apply a /report/delta body to the stored record of its machine."""
+    observe_timings(data)
+    record.update(data['sections'])
+    if data.get('os'):
+        record['os'] = data['os']
+    record['content_hash'] = data['content_hash']
+    record['timestamp'] = now
+    return record
+
+@metrics.profiled('machines_payload')
+def machines_payload(args):
+    """Response body of /machines for the given query arguments.
+
+    Raises ValueError for invalid arguments.
+    """
+    sort = args.get('sort', 'timestamp')
+    order = args.get('order', 'desc')
+    if sort not in SORT_COLUMNS:
+        raise ValueError(f"sort must be one of: {', '.join(SORT_COLUMNS)}")
+    if order not in ('asc', 'desc'):
+        raise ValueError('order must be asc or desc')
+    fields = None
+    if args.get('fields'):
+        fields = args['fields'].split(',')
+        if fields == ['summary']:
+            fields = list(SUMMARY_FIELDS)
+        unknown = set(fields) - set(SUMMARY_FIELDS + SECTION_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    paginated = 'limit' in args or 'cursor' in args or 'since' in args
+    try:
+        limit = max(min(int(args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE), 1) if paginated else None
+        since = int(args['since']) if 'since' in args else None
+    except ValueError:
+        raise ValueError('limit and since must be integers')
+    if since is not None:
+        # Change feed: summary rows changed after `since`, oldest change first
+        with read_pool.connection() as conn:
+            machines = changed_machines(conn, since, limit=limit + 1)
+            head = current_change_seq(conn)
+        has_more = len(machines) > limit
+        machines = machines[:limit]
+        cursor = machines[-1]['change_seq'] if machines else max(since, 0)
+        return {'items': machines, 'change_cursor': cursor, 'has_more': has_more, 'head': head}
+    machines, next_cursor, total, change_cursor = query_machines(
+        os_filter=args.get('os'), issue=args.get('issue'), status=args.get('status'),
+        search=args.get('search'), sort=sort, order=order, cursor=args.get('cursor'),
+        limit=limit, fields=fields)
+    if not paginated:
+        return machines
+    return {'items': machines, 'next_cursor': next_cursor, 'total': total, 'change_cursor': change_cursor}
+
+def sse_event(machine):
+    return f"id: {machine['change_seq']}\nevent: machine\ndata: {json.dumps(machine)}\n\n"
+
+class AsyncStorage:
+    """asyncio front end to this module, used by the FastAPI app.
+
+    Writes go through a dedicated writer task: it batches queued reports the
+    way WriteBehindQueue does and commits each batch on a single writer
+    thread, so the event loop never blocks on SQLite and thousands of
+    concurrent requests share a handful of fsyncs. Reads run on a thread
+    pool sized to the read connection pool.
+    """
+
+    def __init__(self, flush_size=WRITE_FLUSH_SIZE, flush_latency=WRITE_FLUSH_LATENCY,
+                 read_workers=READ_POOL_SIZE):
+        self.flush_size = flush_size
+        self.flush_latency = flush_latency
+        self.read_workers = read_workers
+        self._queue = None
+        self._task = None
+        self._conn = None
+        # Rows and touches queued but not yet committed or failed
+        self._pending = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-writer')
+        self._read_executor = ThreadPoolExecutor(max_workers=self.read_workers, thread_name_prefix='sqlite-reader')
+        await loop.run_in_executor(self._write_executor, init_db)
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+        metrics.INGEST_QUEUE_DEPTH.set_function(self.depth)
+
+    async def stop(self):
+        """Commit what is queued, then stop the writer."""
+        await self._queue.put(None)
+        await self._task
+        self._write_executor.submit(self._close).result()
+        self._write_executor.shutdown()
+        self._read_executor.shutdown()
+
+    def depth(self):
+        return self._pending
+
+    async def read(self, func, *args, **kwargs):
+        """Run a blocking read helper of this module off the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, functools.partial(func, *args, **kwargs))
+
+    async def save_machines(self, records, touches=(), base_hashes=None):
+        """Queue records for the next group commit and wait until it is durable.
+
+        Raises StaleReport when a base hash or touch no longer matches, as the
+        module-level save_machines and touch_machine do.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        submitted = loop.time()
+        bases = list(base_hashes) if base_hashes is not None else [None] * len(records)
+        rows = [machine_row(r) for r in records]
+        self._pending += len(rows) + len(touches)
+        await self._queue.put((rows, list(touches), bases, future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), WRITE_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise TimeoutError('Timed out waiting for the report to be stored')
+        finally:
+            write_latency.observe(loop.time() - submitted)
+
+    async def save_machine(self, record, base_hash=None):
+        await self.save_machines([record], base_hashes=None if base_hash is None else [base_hash])
+
+    async def touch_machine(self, machine_id, content_hash, timestamp):
+        await self.save_machines([], [(timestamp, machine_id, content_hash)])
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            size = len(item[0]) + len(item[1])
+            deadline = loop.time() + self.flush_latency
+            while size < self.flush_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                size += len(item[0]) + len(item[1])
+            try:
+                await self._commit(loop, batch)
+            finally:
+                self._pending -= size
+
+    async def _commit(self, loop, batch):
+        rows = [row for item in batch for row in item[0]]
+        touches = [touch for item in batch for touch in item[1]]
+        bases = [base for item in batch for base in item[2]]
+        try:
+            stale = await loop.run_in_executor(self._write_executor, self._write, rows, touches, bases)
+        except Exception as e:
+            if len(batch) > 1:
+                # Commit each request on its own so a bad one only fails itself
+                for item in batch:
+                    await self._commit(loop, [item])
+                return
+            logger.error('Write-behind flush of %d reports failed: %s', len(batch), e)
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (*_, future), positions in zip(batch, batch_positions(batch, len(rows))):
+            if future.done():
+                continue
+            if stale & positions:
+                future.set_exception(StaleReport())
+            else:
+                future.set_result(None)
+
+    def _write(self, rows, touches, bases):
+        # Runs on the writer thread, which owns the connection
+        if self._conn is None:
+            self._conn = connect()
+        first_seq, last_seq, stale = commit_batch(self._conn, rows, touches, bases)
+        after_commit(self._conn, rows, touches, first_seq, last_seq)
+        run_maintenance(self._conn)
+        return stale
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,269 @@
+"""Tests for the native Linux probes, run against a fake root filesystem.
+
+    python -m unittest test_linux_probes   (or: python -m pytest test_linux_probes.py)
+"""
+
+import lzma
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import linux_probes
+from linux_probes import ProbeUnavailable
+
+CONFIG_HOME = 'home/user/.config'
+SLEEP_DCONF_KEY = '/org/gnome/settings-daemon/plugins/power/sleep-inactive-ac-timeout'
+
+DPKG_STATUS = """\
+Package: foo
+Status: install ok installed
+Architecture: amd64
+Version: 1.0-1
+Description: upgradable by revision
+ continuation line: ignored
+
+Package: bar
+Status: install ok installed
+Architecture: amd64
+Version: 2:1.0
+
+Package: baz
+Status: install ok installed
+Architecture: all
+Version: 1.0~rc1
+
+Package: removed
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 0.1
+"""
+
+MAIN_PACKAGES = """\
+Package: foo
+Architecture: amd64
+Version: 1.0-2
+
+Package: bar
+Architecture: amd64
+Version: 1.5
+
+Package: baz
+Architecture: all
+Version: 1.0
+
+Package: removed
+Architecture: amd64
+Version: 0.2
+"""
+
+BACKPORTS_PACKAGES = """\
+Package: foo
+Architecture: amd64
+Version: 9.0-1
+"""
+
+POWER_SCHEMA_XML = """\
+<schemalist>
+  <schema id="org.gnome.settings-daemon.plugins.power" path="/org/gnome/settings-daemon/plugins/power/">
+    <key name="sleep-inactive-ac-timeout" type="i">
+      <default>1200</default>
+    </key>
+  </schema>
+</schemalist>
+"""
+
+def gvariant(value, type_string):
+    """A serialized 'v' GVariant holding an int32 ('i') or uint32 ('u')."""
+    return struct.pack('<i' if type_string == 'i' else '<I', value) + b'\0' + type_string.encode()
+
+def gvdb(items):
+    """Minimal GVDB file: a root hash table of (parent index, key, type, value) items."""
+    header_size, table_header_size, item_size = 24, 8, 24
+    start = header_size
+    items_start = start + table_header_size  # No bloom words, no buckets
+    end = items_start + item_size * len(items)
+    table = struct.pack('<II', 0, 0)
+    blobs = b''
+    for parent, key, kind, value in items:
+        key_start = end + len(blobs)
+        blobs += key.encode()
+        value_start = end + len(blobs)
+        blobs += value
+        table += struct.pack('<IIIHccII', 0, parent, key_start, len(key.encode()), kind.encode(), b'\0',
+                             value_start, value_start + len(value))
+    header = b'GVariant' + struct.pack('<IIII', 0, 0, start, end)
+    return header + table + blobs
+
+class FakeRootTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='linux_probes_')
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def write(self, path, content):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb' if isinstance(content, bytes) else 'w') as f:
+            f.write(content)
+
+class CompareVersionsTest(unittest.TestCase):
+    def test_ordering(self):
+        cases = [
+            ('1.0', '1.0', 0),
+            ('1.0-1', '1.0-2', -1),
+            ('1.0-2', '1.0-10', -1),
+            ('1.0~rc1', '1.0', -1),
+            ('1.0~~', '1.0~', -1),
+            ('1.0a', '1.0', 1),
+            ('1.0+b1', '1.0', 1),
+            ('1:0.9', '2.0', 1),
+            ('2:1.0', '1.5', 1),
+            ('0:1.0', '1.0', 0),
+        ]
+        for a, b, expected in cases:
+            with self.subTest(a=a, b=b):
+                self.assertEqual(linux_probes.compare_versions(a, b), expected)
+                self.assertEqual(linux_probes.compare_versions(b, a), -expected)
+
+class GvdbTest(unittest.TestCase):
+    def test_items_resolve_parent_chain(self):
+        data = gvdb([
+            (0xFFFFFFFF, '/org/gnome/', 'L', b''),
+            (0, 'settings-daemon/plugins/power/sleep-inactive-ac-timeout', 'v', gvariant(600, 'i')),
+        ])
+        items = linux_probes._gvdb_items(data)
+        self.assertEqual(set(items), {'/org/gnome/', SLEEP_DCONF_KEY})
+        self.assertEqual(items[SLEEP_DCONF_KEY], ('v', gvariant(600, 'i')))
+
+    def test_rejects_other_files(self):
+        with self.assertRaises(ValueError):
+            linux_probes._gvdb_items(b'not a gvdb file at all!!')
+
+    def test_gvariant_int(self):
+        self.assertEqual(linux_probes._gvariant_int(gvariant(-5, 'i')), -5)
+        self.assertEqual(linux_probes._gvariant_int(gvariant(3600, 'u')), 3600)
+        with self.assertRaises(ValueError):
+            linux_probes._gvariant_int(b'true\0b')
+
+class DiskEncryptionTest(FakeRootTestCase):
+    def test_crypt_device(self):
+        self.write('sys/block/dm-0/dm/uuid', 'CRYPT-LUKS2-0123456789abcdef-luks\n')
+        self.write('sys/block/dm-0/dm/name', 'luks-root\n')
+        self.write('sys/block/dm-1/dm/uuid', 'LVM-abcdef\n')
+        self.write('sys/block/sda/size', '1000\n')
+        result = linux_probes.disk_encryption(self.root)
+        self.assertTrue(result['encrypted'])
+        self.assertEqual(result['details'], 'luks-root (dm-0) crypt CRYPT-LUKS2-0123456789abcdef-luks\n'
+                                            'dm-1 (dm-1) dm LVM-abcdef')
+
+    def test_no_device_mapper(self):
+        self.write('sys/block/sda/size', '1000\n')
+        self.assertEqual(linux_probes.disk_encryption(self.root),
+                         {'encrypted': False, 'details': 'No device-mapper devices'})
+
+    def test_unavailable_without_sysfs(self):
+        with self.assertRaises(ProbeUnavailable):
+            linux_probes.disk_encryption(self.root)
+
+class OsUpdatesTest(FakeRootTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write('var/lib/dpkg/status', DPKG_STATUS)
+
+    def test_pending_upgrades(self):
+        self.write('var/lib/apt/lists/deb.example.org_dists_stable_main_binary-amd64_Packages', MAIN_PACKAGES)
+        # NotAutomatic suites (backports) are not upgrade candidates
+        self.write('var/lib/apt/lists/deb.example.org_dists_stable-backports_InRelease',
+                   'Origin: Example\nNotAutomatic: yes\n\n')
+        self.write('var/lib/apt/lists/deb.example.org_dists_stable-backports_main_binary-amd64_Packages',
+                   BACKPORTS_PACKAGES)
+        result = linux_probes.os_updates(self.root)
+        self.assertFalse(result['up_to_date'])
+        self.assertEqual(result['details'], 'baz/all 1.0~rc1 -> 1.0\nfoo/amd64 1.0-1 -> 1.0-2')
+
+    def test_up_to_date(self):
+        self.write('var/lib/apt/lists/deb.example.org_dists_stable_main_binary-amd64_Packages',
+                   'Package: foo\nArchitecture: amd64\nVersion: 1.0-1\n\nPackage: bar\nArchitecture: amd64\nVersion: 1.9\n')
+        self.assertEqual(linux_probes.os_updates(self.root),
+                         {'up_to_date': True, 'details': 'All packages are up to date.'})
+
+    def test_compressed_lists(self):
+        self.write('var/lib/apt/lists/deb.example.org_dists_stable_main_binary-amd64_Packages.xz',
+                   lzma.compress(MAIN_PACKAGES.encode()))
+        self.write('var/lib/apt/lists/deb.example.org_dists_stable_main_binary-amd64_Packages.diff_Index',
+                   'SHA256-Current: x\n')
+        result = linux_probes.os_updates(self.root)
+        self.assertEqual(result['details'], 'baz/all 1.0~rc1 -> 1.0\nfoo/amd64 1.0-1 -> 1.0-2')
+
+    def test_unavailable_with_unreadable_list(self):
+        # An up-to-date plain list must not hide upgrades in a list we cannot decompress
+        self.write('var/lib/apt/lists/deb.example.org_dists_stable_main_binary-amd64_Packages',
+                   'Package: foo\nArchitecture: amd64\nVersion: 1.0-1\n')
+        self.write('var/lib/apt/lists/deb.example.org_dists_stable-updates_main_binary-amd64_Packages.lz4',
+                   b'\x04\x22\x4d\x18 not really lz4')
+        with mock.patch.dict(linux_probes.LIST_OPENERS, {'.lz4': None}):
+            with self.assertRaises(ProbeUnavailable):
+                linux_probes.os_updates(self.root)
+        self.write('var/lib/apt/lists/deb.example.org_dists_stable-updates_main_binary-amd64_Packages.lz4', b'')
+        self.write('var/lib/apt/lists/deb.example.org_dists_stable-security_main_binary-amd64_Packages.gz', b'corrupt')
+        with mock.patch.dict(linux_probes.LIST_OPENERS, {'.lz4': open}):
+            with self.assertRaises(ProbeUnavailable):
+                linux_probes.os_updates(self.root)
+
+    def test_unavailable_without_lists(self):
+        with self.assertRaises(ProbeUnavailable):
+            linux_probes.os_updates(self.root)
+
+    def test_unavailable_without_dpkg(self):
+        os.remove(os.path.join(self.root, 'var/lib/dpkg/status'))
+        self.write('var/lib/apt/lists/deb.example.org_dists_stable_main_binary-amd64_Packages', MAIN_PACKAGES)
+        with self.assertRaises(ProbeUnavailable):
+            linux_probes.os_updates(self.root)
+
+class AntivirusTest(FakeRootTestCase):
+    def test_running_daemon(self):
+        self.write('proc/1/comm', 'systemd\n')
+        self.write('proc/812/comm', 'clamd\n')
+        self.write('proc/self/comm', 'clamd\n')
+        self.assertEqual(linux_probes.antivirus(self.root),
+                         {'antivirus_present': True, 'status': 'active (clamd pid 812)'})
+
+    def test_started_but_not_running(self):
+        self.write('proc/1/comm', 'systemd\n')
+        os.makedirs(os.path.join(self.root, 'run/systemd/units'))
+        os.symlink('0123456789abcdef', os.path.join(self.root, 'run/systemd/units/invocation:clamav-daemon.service'))
+        self.assertEqual(linux_probes.antivirus(self.root), {
+            'antivirus_present': False,
+            'status': 'inactive (clamav-daemon.service started but not running)',
+        })
+
+    def test_unavailable_without_proc(self):
+        with self.assertRaises(ProbeUnavailable):
+            linux_probes.antivirus(self.root)
+
+class SleepSettingsTest(FakeRootTestCase):
+    def test_dconf_value(self):
+        self.write(f'{CONFIG_HOME}/dconf/user', gvdb([
+            (0xFFFFFFFF, '/org/gnome/', 'L', b''),
+            (0, 'settings-daemon/plugins/power/sleep-inactive-ac-timeout', 'v', gvariant(600, 'i')),
+        ]))
+        self.assertEqual(linux_probes.sleep_settings(self.root, CONFIG_HOME), {
+            'sleep_timeout_minutes': 10, 'compliant': True, 'details': '600 (dconf)'})
+
+    def test_schema_default_with_override(self):
+        self.write('usr/share/glib-2.0/schemas/org.gnome.settings-daemon.plugins.power.gschema.xml',
+                   POWER_SCHEMA_XML)
+        self.assertEqual(linux_probes.sleep_settings(self.root, CONFIG_HOME), {
+            'sleep_timeout_minutes': 20, 'compliant': False, 'details': '1200 (schema default)'})
+        self.write('usr/share/glib-2.0/schemas/90_vendor.gschema.override',
+                   '[org.gnome.settings-daemon.plugins.power]\nsleep-inactive-ac-timeout=int32 300\n')
+        self.assertEqual(linux_probes.sleep_settings(self.root, CONFIG_HOME)['details'], '300 (schema default)')
+
+    def test_unavailable_without_schema(self):
+        with self.assertRaises(ProbeUnavailable):
+            linux_probes.sleep_settings(self.root, CONFIG_HOME)
+
+if __name__ == '__main__':
+    unittest.main()
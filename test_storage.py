@@ -0,0 +1,350 @@
+"""Tests for the SQLite store and the Flask backend, each run against a scratch database.
+
+    python -m unittest test_storage   (or: python -m pytest test_storage.py)
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import storage
+
+# The Flask app runs init_db() at import; keep it off the repository's machines.db
+_scratch = tempfile.mkdtemp(prefix='solsphere_storage_')
+storage.DB_PATH = os.path.join(_scratch, 'import.db')
+storage.snapshot_writer = None
+
+import flask_backend_sqlite
+
+def tearDownModule():
+    shutil.rmtree(_scratch, ignore_errors=True)
+
+def report(machine_id, os_name='Linux', encrypted=True, up_to_date=True, antivirus=True, sleep=True,
+           content_hash=None):
+    """A /report body; None leaves a check's verdict unknown."""
+    return {
+        'machine_id': machine_id,
+        'os': os_name,
+        'disk_encryption': {'encrypted': encrypted, 'details': 'luks'},
+        'os_update': {'up_to_date': up_to_date, 'details': ''},
+        'antivirus': {'antivirus_present': antivirus, 'status': 'clamd'},
+        'sleep_settings': {'sleep_timeout_minutes': 10, 'compliant': sleep, 'details': ''},
+        'content_hash': content_hash or f'{machine_id}-{encrypted}-{up_to_date}-{antivirus}-{sleep}',
+    }
+
+class StorageTestCase(unittest.TestCase):
+    """Gives every test an empty database and its own writer, read pool and response cache."""
+
+    def setUp(self):
+        root = tempfile.mkdtemp(prefix='solsphere_storage_')
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        cache = storage.ResponseCache(storage.RESPONSE_CACHE_SIZE)
+        for module, name, value in [
+            (storage, 'DB_PATH', os.path.join(root, 'machines.db')),
+            (storage, 'read_pool', storage.ConnectionPool(storage.READ_POOL_SIZE)),
+            (storage, 'write_queue', storage.WriteBehindQueue(storage.WRITE_FLUSH_SIZE, 0.005)),
+            (storage, 'response_cache', cache),
+            (flask_backend_sqlite, 'response_cache', cache),
+        ]:
+            patcher = mock.patch.object(module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        storage.init_db()
+        self.client = flask_backend_sqlite.app.test_client()
+
+class FleetComplianceTest(StorageTestCase):
+    NOW = datetime(2024, 5, 15, 13, 30)
+
+    def commit_history(self, reports):
+        """Store (timestamp, record) reports in time order, the way ingest would."""
+        conn = storage.connect()
+        try:
+            for ts, record in sorted(reports, key=lambda item: item[0]):
+                record = dict(record, timestamp=ts.isoformat())
+                storage.commit_batch(conn, [storage.machine_row(record)], [])
+        finally:
+            conn.close()
+
+    def reference(self, reports, days, bucket, os_filter=None):
+        """fleet_compliance() computed the slow way: every machine's last report before each bucket end."""
+        current = {}
+        for ts, record in sorted(reports, key=lambda item: item[0]):
+            current[record['machine_id']] = record
+        tracked = {mid for mid, record in current.items()
+                   if not os_filter or record['os'].lower() == os_filter.lower()}
+        series = []
+        for start, end in storage.bucket_bounds(self.NOW, days, bucket):
+            latest = {}
+            for ts, record in sorted(reports, key=lambda item: item[0]):
+                if ts < end and record['machine_id'] in tracked:
+                    latest[record['machine_id']] = record
+            point = {'start': start.isoformat(), 'end': end.isoformat(), 'machines': len(latest)}
+            flags = [[storage.flag_value(record[section], key) for section, key in storage.FLAG_COLUMNS.values()]
+                     for record in latest.values()]
+            for i, column in enumerate(storage.FLAG_COLUMNS):
+                passing = sum(1 for f in flags if f[i] == 1)
+                point[column] = round(100.0 * passing / len(latest), 1) if latest else None
+            healthy = sum(1 for f in flags if storage.machine_status(f) == 'healthy')
+            point['healthy'] = round(100.0 * healthy / len(latest), 1) if latest else None
+            series.append(point)
+        return series
+
+    def random_history(self, rng, machines=25, reports_per_machine=12, span_days=12):
+        reports = []
+        minutes = rng.sample(range(span_days * 24 * 60), machines * reports_per_machine)
+        for i in range(machines):
+            os_name = rng.choice(['Linux', 'Windows', 'Darwin'])
+            for _ in range(reports_per_machine):
+                ts = self.NOW - timedelta(minutes=minutes.pop())
+                verdicts = [rng.choice([True, True, False, None]) for _ in range(4)]
+                reports.append((ts, report(f'm{i:02d}', os_name, *verdicts)))
+        return reports
+
+    def test_matches_reference(self):
+        rng = random.Random(1234)
+        reports = self.random_history(rng)
+        self.commit_history(reports)
+        for days, bucket, os_filter in [(10, 'day', None), (10, 'day', 'linux'), (2, 'hour', None),
+                                        (14, 'week', 'Windows'), (20, 'day', None)]:
+            with self.subTest(days=days, bucket=bucket, os=os_filter):
+                self.assertEqual(storage.fleet_compliance(days, bucket, os_filter, now=self.NOW),
+                                 self.reference(reports, days, bucket, os_filter))
+
+    def test_report_on_bucket_end_counts_in_next_bucket(self):
+        end = datetime(2024, 5, 15)
+        self.commit_history([
+            (end - timedelta(days=1), report('a', antivirus=False)),
+            (end, report('a', antivirus=True)),
+        ])
+        series = storage.fleet_compliance(2, 'day', now=self.NOW)
+        self.assertEqual([point['antivirus_present'] for point in series], [None, 0.0, 100.0])
+
+    def test_oversized_window_rejected(self):
+        response = self.client.get('/history/compliance?bucket=hour&days=60')
+        self.assertEqual(response.status_code, 400)
+
+class FleetStatsTest(StorageTestCase):
+    def expected_stats(self):
+        """/stats recomputed from the full machine list."""
+        machines = self.client.get('/machines').get_json()
+        stats = {
+            'total': len(machines),
+            'by_os': {},
+            'issues': {issue: 0 for issue in storage.ISSUE_COLUMNS},
+            'status': {'healthy': 0, 'warning': 0, 'critical': 0},
+        }
+        for machine in machines:
+            os_lower = machine['os'].lower()
+            stats['by_os'][os_lower] = stats['by_os'].get(os_lower, 0) + 1
+            flags = [storage.flag_value(machine[section], key) for section, key in storage.FLAG_COLUMNS.values()]
+            for issue, column in storage.ISSUE_COLUMNS.items():
+                if flags[list(storage.FLAG_COLUMNS).index(column)] != 1:
+                    stats['issues'][issue] += 1
+            stats['status'][storage.machine_status(flags)] += 1
+        return stats
+
+    def assert_counters(self):
+        stats = self.client.get('/stats').get_json()
+        stats.pop('last_report')
+        self.assertEqual(stats, self.expected_stats())
+
+    def post(self, body):
+        response = self.client.post('/report', json=body)
+        self.assertEqual(response.status_code, 200)
+
+    def test_insert_update_and_flip(self):
+        self.post(report('a'))
+        self.post(report('b', 'Windows', antivirus=False))
+        self.post(report('c', 'Darwin', sleep=None))
+        self.assert_counters()
+        self.assertEqual(self.client.get('/stats').get_json()['status'],
+                         {'healthy': 1, 'warning': 1, 'critical': 1})
+        # Same verdicts, new output: no counter moves
+        self.post(dict(report('a'), disk_encryption={'encrypted': True, 'details': 'other'}))
+        self.assert_counters()
+        # Verdict flips in both directions, and an OS change
+        self.post(report('b', 'Windows'))
+        self.post(report('a', up_to_date=False))
+        self.post(report('c', 'Linux', sleep=True))
+        self.assert_counters()
+        self.assertEqual(self.client.get('/stats').get_json()['by_os'], {'linux': 2, 'windows': 1})
+
+    def test_heartbeat_and_delta(self):
+        self.post(report('a', content_hash='h1'))
+        self.assertEqual(self.client.post('/report/heartbeat', json={'machine_id': 'a', 'content_hash': 'h1'})
+                         .status_code, 200)
+        self.assert_counters()
+        response = self.client.post('/report/delta', json={
+            'machine_id': 'a', 'base_hash': 'h1', 'content_hash': 'h2',
+            'sections': {'antivirus': {'antivirus_present': False, 'status': ''}},
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assert_counters()
+        self.assertEqual(self.client.get('/stats').get_json()['issues']['no_antivirus'], 1)
+
+    def test_batch_with_repeated_machine(self):
+        # Later reports of a machine in the same batch diff against the earlier ones
+        response = self.client.post('/report/batch', json=[
+            report('a'), report('a', encrypted=False), report('b'), report('a', encrypted=None)])
+        self.assertEqual(response.status_code, 200)
+        self.assert_counters()
+
+    def test_rebuild_matches_incremental(self):
+        rng = random.Random(99)
+        for _ in range(60):
+            verdicts = [rng.choice([True, False, None]) for _ in range(4)]
+            self.post(report(f'm{rng.randrange(10)}', rng.choice(['Linux', 'Windows']), *verdicts))
+        incremental = self.client.get('/stats').get_json()
+        with storage.connect() as conn:
+            storage.rebuild_counters(conn)
+        self.assertEqual(storage.get_fleet_stats(), incremental)
+        self.assert_counters()
+
+class ResyncTest(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.post('/report', json=report('a', content_hash='h1'))
+
+    def heartbeat(self, content_hash):
+        return self.client.post('/report/heartbeat', json={'machine_id': 'a', 'content_hash': content_hash})
+
+    def delta(self, base_hash):
+        return self.client.post('/report/delta', json={
+            'machine_id': 'a', 'base_hash': base_hash, 'content_hash': 'h3',
+            'sections': {'antivirus': {'antivirus_present': False, 'status': ''}},
+        })
+
+    def full_report_lands_after_check(self):
+        """Make a full report (hash h2) commit between an endpoint's hash check and its write."""
+        get_content_hash = flask_backend_sqlite.get_content_hash
+
+        def racing(machine_id):
+            result = get_content_hash(machine_id)
+            self.client.post('/report', json=report('a', encrypted=False, content_hash='h2'))
+            return result
+        return mock.patch.object(flask_backend_sqlite, 'get_content_hash', racing)
+
+    def assert_resync(self, response):
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json(), {'status': 'resync', 'machine_id': 'a'})
+
+    def test_current_hash_accepted(self):
+        self.assertEqual(self.heartbeat('h1').status_code, 200)
+        self.assertEqual(self.delta('h1').status_code, 200)
+        self.assertEqual(storage.get_content_hash('a'), (True, 'h3'))
+        self.assertFalse(storage.get_machine_by_id('a')['antivirus']['antivirus_present'])
+
+    def test_stale_hash(self):
+        self.assert_resync(self.heartbeat('h0'))
+        self.assert_resync(self.delta('h0'))
+        response = self.client.post('/report/heartbeat', json={'machine_id': 'b', 'content_hash': 'h1'})
+        self.assertEqual(response.status_code, 409)
+
+    def test_heartbeat_racing_full_report(self):
+        timestamp = storage.get_machine_by_id('a')['timestamp']
+        with self.full_report_lands_after_check():
+            self.assert_resync(self.heartbeat('h1'))
+        self.assertEqual(storage.get_content_hash('a'), (True, 'h2'))
+        self.assertGreater(storage.get_machine_by_id('a')['timestamp'], timestamp)
+
+    def test_delta_racing_full_report(self):
+        with self.full_report_lands_after_check():
+            self.assert_resync(self.delta('h1'))
+        # The full report is kept, not overwritten by a merge built on h1
+        machine = storage.get_machine_by_id('a')
+        self.assertEqual(storage.get_content_hash('a'), (True, 'h2'))
+        self.assertFalse(machine['disk_encryption']['encrypted'])
+        self.assertTrue(machine['antivirus']['antivirus_present'])
+
+    def test_stale_rows_fail_alone(self):
+        # In one group commit, only the write whose base moved is refused
+        conn = storage.connect()
+        self.addCleanup(conn.close)
+        rows = [storage.machine_row(dict(report('a', content_hash='h4'), timestamp='t')),
+                storage.machine_row(dict(report('b', content_hash='h5'), timestamp='t'))]
+        first_seq, last_seq, stale = storage.commit_batch(
+            conn, rows, [('t', 'a', 'h4'), ('t', 'a', 'h1')], bases=['h0', None])
+        # Row 0 (base h0) and the touch of the hash it would have written (2) are skipped
+        self.assertEqual(stale, {0, 2})
+        self.assertEqual(last_seq - first_seq, 1)
+        self.assertEqual(storage.get_content_hash('a'), (True, 'h1'))
+        self.assertEqual(storage.get_content_hash('b'), (True, 'h5'))
+
+class FilterTest(StorageTestCase):
+    def test_filters_match_reference(self):
+        rng = random.Random(5)
+        records = []
+        for i in range(40):
+            verdicts = [rng.choice([True, False, None]) for _ in range(4)]
+            records.append(report(f'host_{i}%', rng.choice(['Linux', 'Windows', 'darwin']), *verdicts))
+        self.client.post('/report/batch', json=records)
+        machines = self.client.get('/machines').get_json()
+        self.assertEqual(len(machines), 40)
+        for query, keep in [
+            ('os=LINUX', lambda m: m['os'] == 'Linux'),
+            ('os=darwin', lambda m: m['os'] == 'darwin'),
+            ('issue=no_antivirus', lambda m: m['antivirus']['antivirus_present'] is not True),
+            ('issue=sleep_noncompliant&os=windows',
+             lambda m: m['sleep_settings']['compliant'] is not True and m['os'] == 'Windows'),
+            ('status=healthy', lambda m: all(
+                storage.flag_value(m[section], key) == 1 for section, key in storage.FLAG_COLUMNS.values())),
+            ('search=_1%25', lambda m: '_1%' in m['machine_id']),
+        ]:
+            with self.subTest(query=query):
+                found = {m['machine_id'] for m in self.client.get(f'/machines?{query}&limit=1000').get_json()['items']}
+                self.assertEqual(found, {m['machine_id'] for m in machines if keep(m)})
+
+class PaginationTest(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rng = random.Random(7)
+        self.initial = [f'm{i:03d}' for i in range(0, 200, 2)]
+        storage.save_machines([dict(report(mid, self.os_of(mid)), timestamp='2024-01-01T00:00:00')
+                               for mid in self.initial])
+
+    @staticmethod
+    def os_of(machine_id):
+        return ['Linux', 'Windows', 'Darwin'][int(machine_id[1:]) % 3]
+
+    def concurrent_writes(self):
+        """Re-report some machines with new verdicts and add new ones (odd ids land between existing ones)."""
+        records = []
+        for mid in self.rng.sample(self.initial, 10) + [f'm{self.rng.randrange(1, 200, 2):03d}' for _ in range(3)]:
+            verdicts = [self.rng.choice([True, False, None]) for _ in range(4)]
+            records.append(dict(report(mid, self.os_of(mid), *verdicts), timestamp=datetime.utcnow().isoformat()))
+        storage.save_machines(records)
+
+    def page_through(self, query):
+        seen, cursor = [], None
+        while True:
+            url = f'/machines?{query}&limit=7' + (f'&cursor={cursor}' if cursor else '')
+            page = self.client.get(url).get_json()
+            seen += [machine['machine_id'] for machine in page['items']]
+            cursor = page['next_cursor']
+            if cursor is None:
+                return seen
+            self.concurrent_writes()
+
+    def test_no_duplicates_or_gaps_under_writes(self):
+        for query in ['sort=machine_id&order=asc', 'sort=machine_id&order=desc', 'sort=os&order=asc',
+                      'sort=os&order=desc&fields=summary', 'sort=machine_id&order=asc&os=linux']:
+            with self.subTest(query=query):
+                seen = self.page_through(query)
+                self.assertEqual(len(seen), len(set(seen)))
+                expected = {mid for mid in self.initial if 'os=linux' not in query or self.os_of(mid) == 'Linux'}
+                self.assertEqual(expected - set(seen), set())
+
+    def test_pages_follow_sort_order(self):
+        seen = self.page_through('sort=os&order=desc')
+        keys = [(self.os_of(mid).lower(), mid) for mid in seen]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/machines?limit=5&cursor=not-a-cursor').status_code, 400)
+
+if __name__ == '__main__':
+    unittest.main()